@@ -17,23 +17,107 @@ An adapter is instantiated with a model instance. Eg::
 
 """
 import logging
+from functools import lru_cache
 from urllib.parse import urljoin
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import Func
+from django.db.models import Prefetch
+from django.db.models import Q
+from django.db.models import TextField
+from django.db.models import Value
+from django.db.models import When
+from django.db.models.functions import Cast
+from django.db.models.functions import Concat
 from django.urls import reverse
+from django.utils import timezone
 from django import core
 
 from . import constants
+from . import lookups
+from . import membership
+from .dbjson import ISOTimestamp
+from .dbjson import JSONArray
+from .dbjson import JSONBoolean
+from .dbjson import JSONObject
+from .dbjson import RelatedJSONArray
 from .exceptions import PatchError
 from .constants import BASE_PATH
+from .mapping import Computed
+from .mapping import Field
+from .mapping import compile_from_dict
+from .mapping import compile_to_dict
+from .models import Change
+from swa_app.models import Profile
 import json
 
 logger = logging.getLogger(__name__)
 
+UUID_PLACEHOLDER = '__uuid__'
+
+
+@lru_cache(maxsize=None)
+def get_location_template(url_name):
+    """
+    Return a ``str.format`` template for the location of the resources
+    served by ``url_name``, so that it is reversed once rather than per object.
+    """
+    path = reverse(url_name, kwargs={'uuid': UUID_PLACEHOLDER})
+    return urljoin(BASE_PATH, path).replace(UUID_PLACEHOLDER, '{}')
+
+
+def _id(obj):
+    return str(obj.id)
+
+
+_id_sql = Cast('pk', TextField())
+
+
+class Location(Func):
+    """The location of the resource served by ``url_name``, as text."""
+
+    def __init__(self, url_name):
+        super().__init__(Cast('pk', TextField()), output_field=TextField())
+        self.url_name = url_name
+
+    def as_sql(self, compiler, connection):
+        # Reversed when the query is compiled, as the URLconf can't be
+        # loaded while the adapters are being defined.
+        prefix, suffix = get_location_template(self.url_name).split('{}')
+        sql, params = compiler.compile(self.source_expressions[0])
+        return '(%s || {} || %s)'.format(sql), [prefix] + params + [suffix]
+
+
 class SCIMMixin(object):
+    # Operations accepted by ``handle_operations``, each applied by the
+    # ``handle_<op>`` method.
+    patch_operations = ()
+
+    # The SCIM attributes of the resource in output order; see
+    # ``django_scim.mapping``. They are compiled into ``_to_dict`` and
+    # ``_from_dict`` functions when the adapter class is created.
+    attributes = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if 'attributes' in cls.__dict__:
+            cls._to_dict = staticmethod(compile_to_dict(cls.attributes))
+            cls._from_dict = staticmethod(compile_from_dict(cls.attributes))
+            schemas = []
+            for attribute in cls.attributes:
+                if attribute.schema and attribute.writable and attribute.schema not in schemas:
+                    schemas.append(attribute.schema)
+            cls._extension_from_dicts = tuple(
+                compile_from_dict(cls.attributes, schema) for schema in schemas)
+
     def __init__(self, obj, request=None):
         self.obj = obj
         self._request = request
+        self._is_new = obj is not None and obj.pk is None
 
     @property
     def request(self):
@@ -57,13 +141,71 @@ class SCIMMixin(object):
 
     @property
     def location(self):
-        return urljoin(BASE_PATH, self.path)
+        return get_location_template(self.url_name).format(self.obj.id)
+
+    def to_dict(self):
+        """
+        Return a ``dict`` conforming to the resource's SCIM schema, ready for
+        conversion to a JSON object.
+        """
+        return self._to_dict(self.obj)
+
+    @classmethod
+    def load_related(cls, qs):
+        """
+        Return ``qs`` loading the related objects read by ``to_dict`` along
+        with its objects, so that serializing a page of them takes the same
+        number of queries whatever its size. Memberships are left to the
+        membership index when it can be used.
+        """
+        qs = qs.select_related(*cls.select_related)
+        if membership.get_index() is None:
+            qs = qs.prefetch_related(*cls.prefetch_related)
+        return qs
+
+    def from_dict(self, d):
+        """
+        Consume a ``dict`` conforming to the resource's SCIM schema, updating
+        the internal object with data from the ``dict``.
+
+        A new object is saved once its core attributes are set, as extension
+        attributes may live on related objects that need it to exist.
+        """
+        self._from_dict(self.obj, d)
+
+        if self.obj.id is None:
+            self.obj.save()
+
+        for from_dict in self._extension_from_dicts:
+            from_dict(self.obj, d)
 
     def save(self):
-        self.obj.save()
+        operation = Change.CREATE if self._is_new else Change.UPDATE
+        with transaction.atomic():
+            self.obj.save()
+            self.record_change(operation)
+        self._is_new = False
 
     def delete(self):
-        self.obj.__class__.objects.filter(id=self.obj.id).delete()
+        with transaction.atomic():
+            self.obj.__class__.objects.filter(id=self.obj.id).delete()
+            self.record_change(Change.DELETE)
+
+    def record_change(self, operation):
+        """
+        Append ``operation`` on this resource to the change log. Callers are
+        expected to do so inside the transaction that makes the change.
+        """
+        Change.objects.create(resource_type=self.resource_type,
+                              resource_id=self.id,
+                              operation=operation)
+        transaction.on_commit(self.committed)
+
+    @staticmethod
+    def committed():
+        """Drop per-process state derived from the directory after a write."""
+        membership.expire()
+        lookups.invalidate()
 
     def handle_operations(self, operations):
         """
@@ -72,15 +214,84 @@ class SCIMMixin(object):
         operations to be performed on a object.Operations could be 'add',
         'remove', 'replace', etc. This method iterates through all of the
         operations in ``operations`` and calls the appropriate handler (defined
-        on the appropriate adapter) for each.
+        on the appropriate adapter) for each. Operations the adapter doesn't
+        list in ``patch_operations`` are rejected with a ``PatchError``.
         """
         for operation in operations:
-            op_code = operation.get('op')
-            op_code = 'handle_' + op_code
-            handler = getattr(self, op_code)
+            op_code = operation.get('op') if isinstance(operation, dict) else None
+            if not isinstance(op_code, str) or op_code.lower() not in self.patch_operations:
+                raise PatchError('Unsupported patch operation {!r}'.format(op_code))
+            handler = getattr(self, 'handle_' + op_code.lower())
             handler(operation)
 
 
+def _user_schemas(user):
+    return [constants.SchemaURI.USER, constants.SchemaURI.OKTA_USER]
+
+
+_user_schemas_sql = JSONArray(Value(constants.SchemaURI.USER), Value(constants.SchemaURI.OKTA_USER))
+
+
+def _user_display_name(user):
+    if user.first_name and user.last_name:
+        return u'{0.first_name} {0.last_name}'.format(user)
+    return user.username
+
+
+_user_display_name_sql = Case(
+    When(~Q(first_name='') & ~Q(last_name=''),
+         then=Concat('first_name', Value(' '), 'last_name')),
+    default=F('username'),
+    output_field=TextField(),
+)
+
+
+def _user_emails(user):
+    return [{'value': user.email, 'primary': True}]
+
+
+_user_emails_sql = JSONArray(JSONObject([('value', F('email')), ('primary', JSONBoolean(Value(True)))]))
+
+
+def _set_user_emails(user, emails):
+    emails = emails or []
+    primary_emails = [e['value'] for e in emails if e.get('primary')]
+    emails = primary_emails + [e['value'] for e in emails]
+    user.email = emails[0] if emails else ''
+
+
+def _set_user_password(user, cleartext_password):
+    if cleartext_password:
+        user.set_password(cleartext_password)
+
+
+def _user_groups(user):
+    groups = getattr(user, 'scim_groups', None)
+    if groups is None:
+        index = membership.get_index()
+        if index is not None:
+            return index.groups_of(user.id)
+        groups = user.groups.all()
+    return [{'value': str(group.id), 'display': group.name} for group in groups]
+
+
+def _user_meta(user):
+    return {
+        'resourceType': SCIMUser.resource_type,
+        'created': user.date_joined.isoformat(timespec='milliseconds'),
+        'lastModified': user.profile.last_modified.isoformat(timespec='milliseconds'),
+        'location': get_location_template(SCIMUser.url_name).format(user.id),
+    }
+
+
+_user_meta_sql = JSONObject([
+    ('resourceType', Value('User')),
+    ('created', ISOTimestamp(F('date_joined'))),
+    ('lastModified', ISOTimestamp(F('profile__last_modified'))),
+    ('location', Location('scim:users')),
+])
+
+
 class SCIMUser(SCIMMixin):
     """
     Adapter for adding SCIM functionality to a Django User object.
@@ -92,6 +303,60 @@ class SCIMUser(SCIMMixin):
     url_name = 'scim:users'
     resource_type = 'User'
 
+    # SCIM attributes accepted as ``sortBy``, mapped to the indexed fields
+    # backing them.
+    sort_fields = {
+        'id': 'id',
+        'username': 'username',
+        'name.familyname': 'last_name',
+        'meta.created': 'date_joined',
+        'meta.lastmodified': 'profile__last_modified',
+    }
+
+    # Related objects read by ``to_dict``, to be loaded along with a batch of
+    # users. Prefetching into a plain list attribute skips building a
+    # queryset per user.
+    select_related = ('profile',)
+    prefetch_related = (
+        Prefetch('groups', queryset=Group.objects.only('id', 'name'), to_attr='scim_groups'),
+    )
+
+    # Custom Okta attributes are stored on ``swa_app.Profile``; adding one
+    # only takes a ``Field`` entry here (and the model field).
+    attributes = (
+        Computed('schemas', getter=_user_schemas, sql=_user_schemas_sql),
+        Computed('id', getter=_id, sql=_id_sql),
+        Field('userName', 'username', default=''),
+        Field('name.givenName', 'first_name', default=''),
+        Field('name.familyName', 'last_name', default=''),
+        Computed('displayName', getter=_user_display_name, sql=_user_display_name_sql),
+        Computed('emails', getter=_user_emails, setter=_set_user_emails, sql=_user_emails_sql),
+        Computed('password', setter=_set_user_password),
+        Field('active', 'is_active', skip_none=True),
+        Computed('groups', getter=_user_groups, sql=RelatedJSONArray('groups', 'name')),
+        Field('phone_number', 'profile.phone_number', schema=constants.SchemaURI.OKTA_USER),
+        Field('department', 'profile.department', schema=constants.SchemaURI.OKTA_USER),
+        Field('company_name', 'profile.company_name', schema=constants.SchemaURI.OKTA_USER),
+        Field('country', 'profile.country', schema=constants.SchemaURI.OKTA_USER),
+        Field('opt_in', 'profile.opt_in', schema=constants.SchemaURI.OKTA_USER),
+        # ``meta.lastModified`` is the watermark of delta imports.
+        Computed('meta', getter=_user_meta, sql=_user_meta_sql),
+    )
+
+    @classmethod
+    def get_model(cls):
+        return get_user_model()
+
+    def save(self):
+        # Deactivating a user only flags it, so that it is cheap and
+        # reactivating it restores everything; see ``Profile.deactivated_at``.
+        profile = self.obj.profile
+        if self.obj.is_active:
+            profile.deactivated_at = None
+        elif profile.deactivated_at is None:
+            profile.deactivated_at = timezone.now()
+        super().save()
+
     @property
     def user_name(self):
         return self.obj.username
@@ -105,123 +370,28 @@ class SCIMUser(SCIMMixin):
         """
         Return the displayName of the user per the SCIM spec.
         """
-        if self.obj.first_name and self.obj.last_name:
-            return u'{0.first_name} {0.last_name}'.format(self.obj)
-        return self.obj.username
+        return _user_display_name(self.obj)
 
     @property
     def emails(self):
         """
         Return the email of the user per the SCIM spec.
         """
-        return [{'value': self.obj.email, 'primary': True}]
+        return _user_emails(self.obj)
 
     @property
     def groups(self):
         """
         Return the groups of the user per the SCIM spec.
         """
-        group_qs = self.obj.groups.all()
-        scim_groups = [SCIMGroup(g, self.request) for g in group_qs]
-
-        dicts = []
-        for group in scim_groups:
-            d = {
-                'value': group.id,
-                #'$ref': group.location,
-                'display': group.display_name,
-            }
-            dicts.append(d)
-
-        return dicts
+        return _user_groups(self.obj)
 
     @property
     def meta(self):
         """
         Return the meta object of the user per the SCIM spec.
         """
-        d = {
-            'resourceType': self.resource_type,
-            'created': self.obj.date_joined.isoformat(timespec='milliseconds'),
-            'lastModified': self.obj.date_joined.isoformat(timespec='milliseconds'),
-            'location': self.location,
-        }
-
-        return d
-
-    def to_dict(self):
-        """
-        Return a ``dict`` conforming to the SCIM User Schema,
-        ready for conversion to a JSON object.
-        """
-        d = {
-            'schemas': [constants.SchemaURI.USER, constants.SchemaURI.OKTA_USER],
-            'id': self.id,
-            'userName': self.obj.username,
-            'name': {
-                'givenName': self.obj.first_name,
-                'familyName': self.obj.last_name,
-            },
-            'displayName': self.display_name,
-            'emails': self.emails,
-            'active': self.obj.is_active,
-            'groups': self.groups,
-            constants.SchemaURI.OKTA_USER: {
-                "phone_number":self.obj.profile.phone_number,
-                "department": self.obj.profile.department,
-                "company_name": self.obj.profile.company_name,
-                "country": self.obj.profile.country,
-                "opt_in": self.obj.profile.opt_in,
-            },
-        #    'meta': self.meta,
-        }
-
-        return d
-
-    def from_dict(self, d):
-        """
-        Consume a ``dict`` conforming to the SCIM User Schema, updating the
-        internal user object with data from the ``dict``.
-
-        Please note, the user object is not saved within this method. To
-        persist the changes made by this method, please call ``.save()`` on the
-        adapter. Eg::
-
-            scim_user.from_dict(d)
-            scim_user.save()
-        """
-        username = d.get('userName')
-        self.obj.username = username or ''
-
-        first_name = d.get('name', {}).get('givenName')
-        self.obj.first_name = first_name or ''
-
-        last_name = d.get('name', {}).get('familyName')
-        self.obj.last_name = last_name or ''
-
-        emails = d.get('emails', [])
-        primary_emails = [e['value'] for e in emails if e.get('primary')]
-        emails = primary_emails + emails
-        email = emails[0] if emails else None
-        self.obj.email = email
-
-        cleartext_password = d.get('password')
-        if cleartext_password:
-            self.obj.set_password(cleartext_password)
-
-        active = d.get('active')
-        if active is not None:
-            self.obj.is_active = active
-
-        if self.obj.id is None:
-            self.obj.save()
-
-        if d.get("{}".format(constants.SchemaURI.OKTA_USER)) is not None:
-            self.obj.profile.phone_number = d.get("{}".format(constants.SchemaURI.OKTA_USER)).get("phone_number")
-            self.obj.profile.department = d.get("{}".format(constants.SchemaURI.OKTA_USER)).get("department")
-            self.obj.profile.company_name = d.get("{}".format(constants.SchemaURI.OKTA_USER)).get("company_name")
-            self.obj.profile.country = d.get("{}".format(constants.SchemaURI.OKTA_USER)).get("country")
-            self.obj.profile.opt_in = d.get("{}".format(constants.SchemaURI.OKTA_USER)).get("opt_in")
+        return _user_meta(self.obj)
 
     @classmethod
     def resource_type_dict(cls, request=None):
@@ -244,6 +414,38 @@ class SCIMUser(SCIMMixin):
             }
         }
 
+def _group_schemas(group):
+    return [constants.SchemaURI.GROUP, constants.SchemaURI.OKTA_GROUP]
+
+
+_group_schemas_sql = JSONArray(Value(constants.SchemaURI.GROUP), Value(constants.SchemaURI.OKTA_GROUP))
+
+
+def _group_members(group):
+    members = getattr(group, 'scim_members', None)
+    if members is None:
+        index = membership.get_index()
+        if index is not None:
+            return index.members_of(group.id)
+        members = group.user_set.all()
+    return [{'value': str(user.id), 'display': user.username} for user in members]
+
+
+def _member_ids(operation):
+    """Return the user ids in the ``value`` of a patch operation on members."""
+    try:
+        return [int(member['value']) for member in operation.get('value') or []]
+    except (KeyError, TypeError, ValueError):
+        raise PatchError('Invalid members in patch operation')
+
+
+def _group_description(group):
+    return "This is the first group"
+
+
+_group_description_sql = Value(_group_description(None))
+
+
 class SCIMGroup(SCIMMixin):
     """
     Adapter for adding SCIM functionality to a Django Group object.
@@ -255,6 +457,37 @@ class SCIMGroup(SCIMMixin):
     url_name = 'scim:groups'
     resource_type = 'Group'
 
+    # SCIM attributes accepted as ``sortBy``, mapped to the indexed fields
+    # backing them.
+    sort_fields = {
+        'id': 'id',
+        'displayname': 'name',
+    }
+
+    patch_operations = ('add', 'remove')
+
+    # Related objects read by ``to_dict``, to be loaded along with a batch of
+    # groups.
+    select_related = ()
+    prefetch_related = (
+        Prefetch('user_set', queryset=get_user_model().objects.only('id', 'username'),
+                 to_attr='scim_members'),
+    )
+
+    attributes = (
+        Computed('schemas', getter=_group_schemas, sql=_group_schemas_sql),
+        Computed('id', getter=_id, sql=_id_sql),
+        Field('displayName', 'name', default=''),
+        # ``user`` is the query name of the reverse side of ``User.groups``.
+        Computed('members', getter=_group_members, sql=RelatedJSONArray('user', 'username')),
+        Computed('description', getter=_group_description, sql=_group_description_sql,
+                 schema=constants.SchemaURI.OKTA_GROUP),
+    )
+
+    @classmethod
+    def get_model(cls):
+        return Group
+
     @property
     def display_name(self):
         """
@@ -270,21 +503,7 @@ class SCIMGroup(SCIMMixin):
 
         :rtype: list
         """
-        dicts = []
-        users = self.obj.user_set.all()
-        if users is not None:
-            scim_users = [SCIMUser(user, self.request) for user in users]
-
-            for user in scim_users:
-                d = {
-                    'value': user.id,
-                    'display': user.user_name,
-                    #'$ref': user.location,
-                    #'display': user.display_name,
-                }
-                dicts.append(d)
-
-        return dicts
+        return _group_members(self.obj)
 
     @property
     def meta(self):
@@ -298,22 +517,6 @@ class SCIMGroup(SCIMMixin):
 
         return d
 
-    def to_dict(self):
-        """
-        Return a ``dict`` conforming to the SCIM User Schema,
-        ready for conversion to a JSON object.
-        """
-        return {
-            'schemas': [constants.SchemaURI.GROUP, constants.SchemaURI.OKTA_GROUP],
-            'id': self.id,
-            'displayName': self.display_name,
-            'members': self.members,
-            "urn:okta:custom:group:1.0":{
-                "description":"This is the first group"
-            },
-        #    'meta': self.meta,
-        }
-
     def from_dict(self, d):
         """
         Consume a ``dict`` conforming to the SCIM Group Schema, updating the
@@ -326,13 +529,10 @@ class SCIMGroup(SCIMMixin):
             scim_group.from_dict(d)
             scim_group.save()
         """
-        name = d.get('displayName')
-        self.obj.name = name or ''
-
-        if self.obj.id is None:
-            self.obj.save()
+        super().from_dict(d)
 
         members = d.get('members')
+        previous_ids = set(self.obj.user_set.values_list('id', flat=True))
         self.obj.user_set.clear()
         if members is not None:
             ids = [int(member.get('value')) for member in members]
@@ -342,7 +542,16 @@ class SCIMGroup(SCIMMixin):
 
             for user in users:
                 self.obj.user_set.add(user)
+        else:
+            ids = []
+
+        self.touch_members(previous_ids.symmetric_difference(ids))
 
+    def delete(self):
+        with transaction.atomic():
+            # The members lose the group along with it.
+            self.touch_members(set(self.obj.user_set.values_list('id', flat=True)))
+            super().delete()
 
     @classmethod
     def resource_type_dict(cls, request=None):
@@ -365,13 +574,29 @@ class SCIMGroup(SCIMMixin):
             }
         }
 
+    def touch_members(self, user_ids):
+        """
+        Bump ``lastModified`` of users whose group memberships changed and
+        log an update for each of them, so that the change is picked up by
+        delta imports and change log consumers of those users.
+        """
+        if user_ids:
+            Profile.objects.filter(user_id__in=user_ids).update(last_modified=timezone.now())
+            Change.objects.bulk_create([
+                Change(resource_type=SCIMUser.resource_type,
+                       resource_id=str(user_id),
+                       operation=Change.UPDATE)
+                for user_id in sorted(user_ids)
+            ])
+            transaction.on_commit(self.committed)
+
+    @transaction.atomic
     def handle_add(self, operation):
         """
         Handle add operations.
         """
         if operation.get('path') == 'members':
-            members = operation.get('value', [])
-            ids = [int(member.get('value')) for member in members]
+            ids = _member_ids(operation)
             users = get_user_model().objects.filter(id__in=ids)
 
             if len(ids) != users.count():
@@ -380,16 +605,19 @@ class SCIMGroup(SCIMMixin):
             for user in users:
                 self.obj.user_set.add(user)
 
+            self.touch_members(ids)
+            self.record_change(Change.UPDATE)
+
         else:
-            raise NotImplemented
+            raise PatchError('Unsupported patch path {!r}'.format(operation.get('path')))
 
+    @transaction.atomic
     def handle_remove(self, operation):
         """
         Handle remove operations.
         """
         if operation.get('path') == 'members':
-            members = operation.get('value', [])
-            ids = [int(member.get('value')) for member in members]
+            ids = _member_ids(operation)
             users = get_user_model().objects.filter(id__in=ids)
 
             if len(ids) != users.count():
@@ -398,5 +626,8 @@ class SCIMGroup(SCIMMixin):
             for user in users:
                 self.obj.user_set.remove(user)
 
+            self.touch_members(ids)
+            self.record_change(Change.UPDATE)
+
         else:
-            raise NotImplemented
+            raise PatchError('Unsupported patch path {!r}'.format(operation.get('path')))
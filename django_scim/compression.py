@@ -0,0 +1,130 @@
+"""
+Negotiated compression of SCIM responses.
+
+List responses repeat the same schema URNs and keys for every resource, so
+they compress very well. Responses are compressed with brotli (when the
+``brotli`` package is installed) or gzip, whichever the client accepts and
+prefers, provided they are at least ``SCIM_COMPRESSION_MIN_SIZE`` bytes.
+Streaming responses are compressed chunk by chunk as they are sent.
+"""
+import zlib
+from functools import lru_cache
+
+from django.utils.cache import patch_vary_headers
+
+from .utils import get_setting
+
+
+@lru_cache(maxsize=None)
+def get_brotli():
+    """
+    Return the ``brotli`` module, or ``None`` if it is not installed. It is
+    imported on first use to keep it out of process start-up.
+    """
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def accepted_encodings(request):
+    """
+    Return the content codings accepted by the client, mapped to their
+    ``q`` values.
+    """
+    accepted = {}
+    for item in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_encoding(request):
+    accepted = accepted_encodings(request)
+    wildcard = accepted.get('*', 0.0)
+    candidates = ['br', 'gzip'] if get_brotli() is not None else ['gzip']
+    best, best_q = None, 0.0
+    for coding in candidates:
+        q = accepted.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class GzipCompressor(object):
+    def __init__(self):
+        level = get_setting('SCIM_GZIP_LEVEL', 6)
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer.
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def process(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor(object):
+    def __init__(self):
+        quality = get_setting('SCIM_BROTLI_QUALITY', 5)
+        self._compressor = get_brotli().Compressor(quality=quality)
+
+    def process(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+COMPRESSORS = {
+    'gzip': GzipCompressor,
+    'br': BrotliCompressor,
+}
+
+
+def compress_stream(chunks, compressor):
+    for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(request, response):
+    """
+    Compress ``response`` in place with the best encoding accepted by
+    ``request``, and return it.
+    """
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    if response.has_header('Content-Encoding') or response.status_code not in (200, 201):
+        return response
+
+    if not response.streaming and len(response.content) < get_setting('SCIM_COMPRESSION_MIN_SIZE', 1024):
+        return response
+
+    encoding = choose_encoding(request)
+    if encoding is None:
+        return response
+
+    compressor = COMPRESSORS[encoding]()
+    if response.streaming:
+        response.streaming_content = compress_stream(response.streaming_content, compressor)
+        del response['Content-Length']
+    else:
+        response.content = compressor.process(response.content) + compressor.finish()
+        response['Content-Length'] = str(len(response.content))
+
+    response['Content-Encoding'] = encoding
+    return response
@@ -1,6 +1,7 @@
 import os
 ENCODING = 'utf-8'
 SCIM_CONTENT_TYPE = 'application/scim+json'
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
 BASE_PATH = 'https://localhost'
 
 class SchemaURI(object):
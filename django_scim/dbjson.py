@@ -0,0 +1,246 @@
+"""
+Serialization of SCIM resources by the database.
+
+Serializing a page of users through the adapters builds a ``User`` and a
+``Profile`` per row and runs ``to_dict`` on them. With ``SCIM_DB_JSON``
+enabled, list responses are instead assembled by the database: the
+resource's attributes are compiled into a single JSON expression (with
+SQLite's ``json_object`` and ``json_group_array``, or PostgreSQL's
+``json_build_object`` and ``json_agg``), the query returns one JSON document
+per row, and the documents are spliced into the ``ListResponse`` as they
+are, without building any model instance.
+
+The expression is compiled from the adapter's ``attributes``: a ``Field``
+reads its column, joining related models as needed, and a ``Computed``
+attribute gives the equivalent expression as its ``sql``. Eg::
+
+    Computed('groups', getter=_user_groups, sql=RelatedJSONArray('groups', 'name'))
+
+Adapters with a readable attribute that has no ``sql``, and databases other
+than SQLite and PostgreSQL, are serialized in Python as before.
+
+PostgreSQL's ``json`` functions are used rather than the ``jsonb`` ones, as
+``jsonb`` doesn't keep the attributes in order.
+"""
+from collections import OrderedDict
+from functools import lru_cache
+
+from django.db import connection
+from django.db import models
+from django.db.models import F
+from django.db.models import Func
+from django.db.models import Value
+from django.db.models.functions import Cast
+from django.db.utils import DatabaseError
+
+from .mapping import Field
+from .mapping import attribute_tree
+from .utils import get_setting
+
+VENDORS = ('sqlite', 'postgresql')
+
+
+class NotSupported(Exception):
+    """Raised for an attribute that can't be serialized by the database."""
+
+
+class JSONObject(Func):
+    """A JSON object of the ``(key, expression)`` ``pairs``, in order."""
+    function = 'json_object'
+
+    def __init__(self, pairs):
+        args = []
+        for key, value in pairs:
+            args += [Value(key), value]
+        super().__init__(*args, output_field=models.TextField())
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, function='json_build_object')
+
+
+class JSONArray(Func):
+    """A JSON array of the ``expressions``."""
+    function = 'json_array'
+
+    def __init__(self, *expressions):
+        super().__init__(*expressions, output_field=models.TextField())
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, function='json_build_array')
+
+
+class JSONBoolean(Func):
+    """A boolean ``expression`` as JSON ``true``, ``false`` or ``null``."""
+    # SQLite stores booleans as 0 and 1, which would come out as numbers.
+    template = "json(CASE %(expressions)s WHEN 1 THEN 'true' WHEN 0 THEN 'false' ELSE 'null' END)"
+
+    def __init__(self, expression):
+        super().__init__(expression, output_field=models.TextField())
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template='%(expressions)s')
+
+
+class ISOTimestamp(Func):
+    """
+    A UTC ``DateTimeField`` as text, like ``isoformat(timespec='milliseconds')``
+    formats it in Python.
+    """
+    def __init__(self, expression):
+        super().__init__(expression, output_field=models.TextField())
+
+    def as_sqlite(self, compiler, connection):
+        # SQLite holds datetimes as 'YYYY-MM-DD HH:MM:SS[.ffffff]' text; the
+        # fraction is cut rather than rounded as strftime's %f would.
+        sql, params = compiler.compile(self.source_expressions[0])
+        return (
+            "(strftime('%%Y-%%m-%%dT%%H:%%M:%%S', {0}) || '.' || "
+            "substr(substr({0}, 21) || '000', 1, 3) || '+00:00')".format(sql)
+        ), params * 2
+
+    def as_postgresql(self, compiler, connection):
+        sql, params = compiler.compile(self.source_expressions[0])
+        return (
+            "to_char({} AT TIME ZONE 'UTC', "
+            "'YYYY-MM-DD\"T\"HH24:MI:SS.MS\"+00:00\"')".format(sql)
+        ), params
+
+
+def _m2m(model, name):
+    """
+    Return ``(related model, through table, column of the row, column of the
+    related object)`` for the many-to-many relation ``name`` of ``model``,
+    which may be the reverse side of the relation.
+    """
+    field = model._meta.get_field(name)
+    if field.concrete:
+        forward, source, target = field, field.m2m_field_name(), field.m2m_reverse_field_name()
+    else:
+        forward = field.field
+        source, target = forward.m2m_reverse_field_name(), forward.m2m_field_name()
+    through = forward.remote_field.through._meta
+    return (field.related_model, through.db_table,
+            through.get_field(source).column, through.get_field(target).column)
+
+
+class RelatedJSONArray(Func):
+    """
+    The ``{"value": "<id>", "display": <label>}`` references to the objects
+    related to the row by the many-to-many relation ``name``, in id order,
+    as a JSON array.
+    """
+    sqlite_template = (
+        "json((SELECT json_group_array(json_object('value', CAST(scim_r.id AS text), "
+        "'display', scim_r.label)) FROM (SELECT scim_t.{pk} AS id, scim_t.{label} AS label "
+        "FROM {table} scim_t INNER JOIN {through} scim_m ON scim_m.{target} = scim_t.{pk} "
+        "WHERE scim_m.{source} = {row} ORDER BY scim_t.{pk}) scim_r))"
+    )
+    postgresql_template = (
+        "(SELECT coalesce(json_agg(json_build_object('value', scim_t.{pk}::text, "
+        "'display', scim_t.{label}) ORDER BY scim_t.{pk}), '[]') "
+        "FROM {table} scim_t INNER JOIN {through} scim_m ON scim_m.{target} = scim_t.{pk} "
+        "WHERE scim_m.{source} = {row})"
+    )
+
+    def __init__(self, name, label):
+        super().__init__(F('pk'), output_field=models.TextField())
+        self.name = name
+        self.label = label
+
+    def as_sql(self, compiler, connection, template=None):
+        if template is None:
+            raise NotSupported('{} is not supported on {}'.format(
+                self.__class__.__name__, connection.vendor))
+        row, params = compiler.compile(self.source_expressions[0])
+        related, through, source, target = _m2m(compiler.query.model, self.name)
+        qn = connection.ops.quote_name
+        return template.format(
+            pk=qn(related._meta.pk.column),
+            label=qn(related._meta.get_field(self.label).column),
+            table=qn(related._meta.db_table),
+            through=qn(through),
+            source=qn(source),
+            target=qn(target),
+            row=row,
+        ), params
+
+    def as_sqlite(self, compiler, connection):
+        return self.as_sql(compiler, connection, template=self.sqlite_template)
+
+    def as_postgresql(self, compiler, connection):
+        return self.as_sql(compiler, connection, template=self.postgresql_template)
+
+
+def _field_expression(model, attribute):
+    *relations, name = attribute.source.split('.')
+    for relation in relations:
+        model = model._meta.get_field(relation).related_model
+    field = model._meta.get_field(name)
+
+    expression = F('__'.join(relations + [name]))
+    if isinstance(field, (models.BooleanField, models.NullBooleanField)):
+        return JSONBoolean(expression)
+    if isinstance(field, (models.CharField, models.TextField, models.IntegerField)):
+        return expression
+    raise NotSupported('{} has no JSON representation'.format(attribute.path))
+
+
+def _object(node):
+    return JSONObject([(key, _object(value) if isinstance(value, OrderedDict) else value)
+                       for key, value in node.items()])
+
+
+@lru_cache(maxsize=None)
+def get_expression(adapter):
+    """
+    Return the expression serializing a resource of ``adapter`` as JSON
+    text, or ``None`` if one of its attributes can't be serialized by the
+    database.
+    """
+    model = adapter.get_model()
+
+    def value(attribute):
+        if isinstance(attribute, Field):
+            return _field_expression(model, attribute)
+        if attribute.sql is None:
+            raise NotSupported('{} has no sql'.format(attribute.path))
+        return attribute.sql
+
+    try:
+        tree = attribute_tree(adapter.attributes, value)
+    except NotSupported:
+        return None
+    # PostgreSQL returns json, which the driver would decode.
+    return Cast(_object(tree), models.TextField())
+
+
+@lru_cache(maxsize=None)
+def _has_json_functions(vendor):
+    if vendor != 'sqlite':
+        return True
+    # SQLite may be built without the JSON1 extension.
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT json_object('a', 1)")
+    except DatabaseError:
+        return False
+    return True
+
+
+def enabled():
+    return (get_setting('SCIM_DB_JSON', False) and connection.vendor in VENDORS and
+            _has_json_functions(connection.vendor))
+
+
+def documents(adapter, qs):
+    """
+    Return a queryset of the JSON texts of the resources in ``qs``,
+    serialized by the database, or ``None`` if they are to be serialized by
+    ``adapter`` instead.
+    """
+    if not enabled():
+        return None
+    expression = get_expression(adapter)
+    if expression is None:
+        return None
+    return qs.annotate(scim_document=expression).values_list('scim_document', flat=True)
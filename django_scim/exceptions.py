@@ -43,3 +43,26 @@ class PatchError(SCIMException):
 
 class IntegrityError(SCIMException):
     status = 409
+
+
+class RequestInProgressError(SCIMException):
+    status = 409
+
+    def __init__(self, **kwargs):
+        super().__init__('An identical request is still in progress', **kwargs)
+
+
+class TooManyRequestsError(SCIMException):
+    status = 429
+
+    def __init__(self, detail=None, retry_after=1, **kwargs):
+        super().__init__(detail, **kwargs)
+        self.retry_after = retry_after
+
+
+class ServiceUnavailableError(SCIMException):
+    status = 503
+
+    def __init__(self, detail=None, retry_after=1, **kwargs):
+        super().__init__(detail, **kwargs)
+        self.retry_after = retry_after
@@ -0,0 +1,158 @@
+"""
+Deduplication of retried SCIM writes.
+
+Okta retries a write when it times out waiting for the response, even though
+the first attempt may still complete. Write requests are therefore
+fingerprinted by method, path, body and credentials, and the response to the
+first attempt is kept in the cache for ``SCIM_IDEMPOTENCY_WINDOW`` seconds:
+
+* an identical request arriving after the first one finished gets the stored
+  response replayed, without running the write again;
+* an identical request arriving while the first one is still running waits
+  for its response instead of running concurrently.
+
+A stored response is only replayed while the resource it concerns has not
+been changed since, according to the change log, so a legitimate repeat of an
+earlier write (A, then B, then A again) is still applied.
+
+Responses and the markers of requests in progress are kept in the
+``idempotency`` cache. Unless it is shared by all server processes (see
+``SCIM_IDEMPOTENCY_CACHE_TABLE``), a retry only finds them when it reaches
+the process that served the first attempt. Waiting requests are woken when
+the first attempt finishes in the same process, and poll the cache with a
+growing delay when it runs in another.
+"""
+import hashlib
+import json
+import threading
+import time
+
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from . import constants
+from .exceptions import RequestInProgressError
+from .models import Change
+from .utils import get_setting
+
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+KEY_PREFIX = 'scim:idempotency:'
+CACHE_ALIAS = 'idempotency'
+
+# Bounds of the delay between polls for a request running in another process.
+POLL_MIN = 0.01
+POLL_MAX = 0.5
+
+# Events set when the request with a given fingerprint finishes in this
+# process.
+_running = {}
+_running_lock = threading.Lock()
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def get_window():
+    return get_setting('SCIM_IDEMPOTENCY_WINDOW', 0)
+
+
+def applies(request):
+    return request.method in constants.WRITE_METHODS and get_window() > 0
+
+
+def fingerprint(request):
+    digest = hashlib.sha256()
+    for part in (request.method,
+                 request.get_full_path(),
+                 request.META.get('HTTP_AUTHORIZATION', '')):
+        digest.update(part.encode(constants.ENCODING))
+        digest.update(b'\0')
+    digest.update(hashlib.sha256(request.body).digest())
+    return KEY_PREFIX + digest.hexdigest()
+
+
+def changed_since(seq, resource_type, resource_id):
+    changes = Change.objects.filter(seq__gt=seq)
+    if resource_type and resource_id:
+        changes = changes.filter(resource_type=resource_type, resource_id=resource_id)
+    return changes.exists()
+
+
+def freeze(response, resource_type, resource_id):
+    if resource_id is None and response.content:
+        try:
+            resource_id = json.loads(response.content.decode(constants.ENCODING)).get('id')
+        except (ValueError, AttributeError):
+            pass
+
+    return {
+        'status': response.status_code,
+        'content': response.content,
+        'headers': [(h, response[h]) for h in REPLAYED_HEADERS if response.has_header(h)],
+        'resource_type': resource_type,
+        'resource_id': resource_id,
+        'seq': Change.objects.last_seq(),
+    }
+
+
+def thaw(stored):
+    response = HttpResponse(content=stored['content'], status=stored['status'])
+    for header, value in stored['headers']:
+        response[header] = value
+    response['Idempotent-Replay'] = 'true'
+    return response
+
+
+def replay_or_run(request, handler, resource_type=None, resource_id=None):
+    """
+    Return the stored response to an identical earlier request, or run
+    ``handler()`` and store its response. ``resource_type`` and
+    ``resource_id`` identify the resource the request writes to; when the id
+    is not known up front (eg. creates) it is read from the response.
+    """
+    cache = get_cache()
+    key = fingerprint(request)
+    lock_key = key + ':lock'
+    window = get_window()
+    wait = get_setting('SCIM_IDEMPOTENCY_WAIT', 30)
+    deadline = time.monotonic() + wait
+    poll = POLL_MIN
+
+    while True:
+        stored = cache.get(key)
+        if stored is not None:
+            if not changed_since(stored['seq'], stored['resource_type'], stored['resource_id']):
+                return thaw(stored)
+            cache.delete(key)
+
+        if cache.add(lock_key, True, timeout=wait):
+            break
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RequestInProgressError()
+
+        with _running_lock:
+            finished = _running.get(key)
+        if finished is not None:
+            finished.wait(remaining)
+        else:
+            time.sleep(min(poll, remaining))
+            poll = min(poll * 2, POLL_MAX)
+
+    finished = threading.Event()
+    with _running_lock:
+        _running[key] = finished
+    try:
+        response = handler()
+        # Server errors and rejections by admission control are transient;
+        # let a retry run the write again.
+        if response.status_code < 500 and response.status_code != 429 and not response.streaming:
+            cache.set(key, freeze(response, resource_type, resource_id), window)
+        return response
+    finally:
+        cache.delete(lock_key)
+        with _running_lock:
+            del _running[key]
+        finished.set()
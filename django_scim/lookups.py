@@ -0,0 +1,70 @@
+"""
+Cache of single-resource lookups by a unique attribute.
+
+Before creating a user, Okta checks whether it already exists with
+``GET /Users?filter=userName eq "..."``, and most of those checks find
+nothing. Such filters are answered by an indexed lookup of the one matching
+row (see ``SCIMFilterTransformer.exact_lookup``), whose result, the
+serialized resource or the fact that there is none, is kept here for up to
+``SCIM_LOOKUP_CACHE_TTL`` seconds.
+
+Entries are only valid for the version of the directory they were read at:
+the cache is cleared whenever the change log has moved on, which covers
+writes made by any process, and right after this process commits a write.
+"""
+import threading
+import time
+
+from .models import Change
+from .utils import get_setting
+
+# Cached lookups kept at most; the cache is cleared when full.
+MAX_ENTRIES = 10000
+
+_entries = {}
+_seq = None
+_lock = threading.Lock()
+
+
+def invalidate():
+    """Drop all cached lookups. Called after this process commits a write."""
+    global _seq
+    with _lock:
+        _entries.clear()
+        _seq = None
+
+
+def lookup(model, field, value, serialize):
+    """
+    Return the serialized object of ``model`` whose ``field`` equals
+    ``value``, or ``None`` if there is none. ``serialize(obj)`` builds the
+    representation that is cached.
+    """
+    global _seq
+    ttl = get_setting('SCIM_LOOKUP_CACHE_TTL', 0)
+    key = (model._meta.label, field, value)
+    now = time.monotonic()
+
+    if ttl:
+        seq = Change.objects.last_seq()
+        with _lock:
+            if seq != _seq:
+                _entries.clear()
+                _seq = seq
+            entry = _entries.get(key)
+        if entry is not None and entry[1] > now:
+            return entry[0]
+
+    obj = model.objects.filter(**{field: value}).first()
+    result = serialize(obj) if obj is not None else None
+
+    if ttl:
+        with _lock:
+            if len(_entries) >= MAX_ENTRIES:
+                _entries.clear()
+            # A write committed since the version was read clears the cache
+            # (or moves the version), so the entry is only stored if the
+            # version it was read at is still current.
+            if _seq == seq:
+                _entries[key] = (result, now + ttl)
+    return result
@@ -0,0 +1,221 @@
+"""
+Declarative mappings between SCIM attributes and model fields.
+
+An adapter lists the attributes of its resource once, in output order. Eg::
+
+    attributes = (
+        Field('userName', 'username', default=''),
+        Field('name.givenName', 'first_name', default=''),
+        Computed('displayName', getter=get_display_name),
+        Field('department', 'profile.department', schema=OKTA_USER),
+    )
+
+When the adapter class is created, :func:`compile_to_dict` and
+:func:`compile_from_dict` generate plain Python functions from that list, so
+serializing an object is a single dict literal of attribute reads rather than
+a walk over the mapping.
+"""
+from collections import OrderedDict
+
+
+class Attribute(object):
+    """
+    Base class for an entry in an adapter's ``attributes``. ``path`` is the
+    dotted SCIM attribute path; attributes of an extension schema give the
+    schema URN in ``schema`` and are nested under it.
+    """
+    def __init__(self, path, schema=None):
+        self.path = path
+        self.schema = schema
+
+    @property
+    def key(self):
+        keys = path = self.path.split('.')
+        if self.schema:
+            keys = [self.schema] + path
+        return keys
+
+    @property
+    def readable(self):
+        return True
+
+    @property
+    def writable(self):
+        return True
+
+
+class Field(Attribute):
+    """
+    Maps a SCIM attribute to a model attribute. ``source`` may traverse
+    related objects, eg ``profile.phone_number``.
+
+    When consuming a ``dict``, a missing value is replaced with ``default``,
+    or left untouched on the model if ``skip_none`` is set.
+    """
+    def __init__(self, path, source, schema=None, default=None, skip_none=False, read_only=False):
+        super().__init__(path, schema)
+        self.source = source
+        self.default = default
+        self.skip_none = skip_none
+        self.read_only = read_only
+
+    @property
+    def writable(self):
+        return not self.read_only
+
+
+class Computed(Attribute):
+    """
+    An attribute that has no single backing field. ``getter(obj)`` returns
+    the SCIM value and ``setter(obj, value)`` applies one; either may be left
+    out for write-only or read-only attributes.
+
+    ``sql`` is a query expression computing the same value as JSON in the
+    database, for ``django_scim.dbjson``; see there.
+    """
+    def __init__(self, path, getter=None, setter=None, schema=None, sql=None):
+        super().__init__(path, schema)
+        self.getter = getter
+        self.setter = setter
+        self.sql = sql
+
+    @property
+    def readable(self):
+        return self.getter is not None
+
+    @property
+    def writable(self):
+        return self.setter is not None
+
+
+class _Source(object):
+    """Collects the generated source and the objects it refers to."""
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {}
+        self.related = OrderedDict()
+
+    def name(self, value, prefix='_c'):
+        name = '{}{}'.format(prefix, len(self.namespace))
+        self.namespace[name] = value
+        return name
+
+    def relation(self, path):
+        """Return the local variable holding ``obj.<path>``."""
+        if path not in self.related:
+            self.related[path] = '_r{}'.format(len(self.related))
+        return self.related[path]
+
+    def target(self, source):
+        owner, _, attr = source.rpartition('.')
+        return '{}.{}'.format(self.relation(owner) if owner else 'obj', attr)
+
+    def compile(self, name):
+        code = '\n'.join(self.lines)
+        exec(compile(code, '<scim mapping {}>'.format(name), 'exec'), self.namespace)
+        func = self.namespace[name]
+        func.__source__ = code
+        return func
+
+
+def _related_lines(source):
+    return ['    {} = obj.{}'.format(var, path) for path, var in source.related.items()]
+
+
+def attribute_tree(attributes, value):
+    """
+    Return the readable entries of ``attributes`` as nested ``OrderedDict``
+    objects keyed like the SCIM representation, with ``value(attribute)``
+    at the leaves.
+    """
+    tree = OrderedDict()
+    for attribute in attributes:
+        if not attribute.readable:
+            continue
+
+        *parents, leaf = attribute.key
+        node = tree
+        for key in parents:
+            node = node.setdefault(key, OrderedDict())
+        node[leaf] = value(attribute)
+    return tree
+
+
+def compile_to_dict(attributes, name='to_dict'):
+    """
+    Return a function ``to_dict(obj)`` that builds the SCIM representation of
+    ``obj`` from the readable entries of ``attributes``.
+    """
+    source = _Source()
+
+    def expression(attribute):
+        if isinstance(attribute, Field):
+            return source.target(attribute.source)
+        return '{}(obj)'.format(source.name(attribute.getter, '_g'))
+
+    tree = attribute_tree(attributes, expression)
+
+    def literal(node, indent):
+        pad = '    ' * indent
+        items = []
+        for key, value in node.items():
+            if isinstance(value, OrderedDict):
+                value = literal(value, indent + 1)
+            items.append('{}    {!r}: {},'.format(pad, key, value))
+        return '{{\n{}\n{}}}'.format('\n'.join(items), pad)
+
+    body = literal(tree, 1)
+    source.lines = ['def {}(obj):'.format(name)] + _related_lines(source)
+    source.lines.append('    return {}'.format(body))
+    return source.compile(name)
+
+
+def compile_from_dict(attributes, schema=None, name='from_dict'):
+    """
+    Return a function ``from_dict(obj, d)`` that applies the writable
+    entries of ``attributes`` belonging to ``schema`` (``None`` for the core
+    schema) from the SCIM ``dict`` ``d`` onto ``obj``.
+
+    For an extension schema, nothing is changed unless ``d`` contains that
+    schema; if it does, missing attributes are applied as missing values.
+    """
+    source = _Source()
+    lines = []
+
+    for attribute in attributes:
+        if not attribute.writable or attribute.schema != schema:
+            continue
+
+        *parents, leaf = attribute.path.split('.')
+        lookup = '_b'
+        for key in parents:
+            lookup = '({}.get({!r}) or {{}})'.format(lookup, key)
+        lines.append('    _v = {}.get({!r})'.format(lookup, leaf))
+
+        if isinstance(attribute, Computed):
+            lines.append('    {}(obj, _v)'.format(source.name(attribute.setter, '_s')))
+            continue
+
+        if attribute.default is not None:
+            lines.append('    if _v is None:')
+            lines.append('        _v = {}'.format(source.name(attribute.default)))
+
+        assignment = '{} = _v'.format(source.target(attribute.source))
+        if attribute.skip_none:
+            lines.append('    if _v is not None:')
+            lines.append('        ' + assignment)
+        else:
+            lines.append('    ' + assignment)
+
+    source.lines = ['def {}(obj, d):'.format(name)]
+    if schema is None:
+        source.lines.append('    _b = d')
+    else:
+        source.lines.append('    _b = d.get({})'.format(source.name(schema)))
+        source.lines.append('    if _b is None:')
+        source.lines.append('        return')
+    source.lines += _related_lines(source) + lines
+    if not lines:
+        source.lines.append('    pass')
+    return source.compile(name)
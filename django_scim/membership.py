@@ -0,0 +1,221 @@
+"""
+An in-process index of group memberships, so that serializing a page of
+users or groups needs no membership joins.
+
+The index holds, as compact integer arrays, the groups of every user and the
+members of every group, along with the group names and usernames they are
+displayed with. It is built from the database the first time it is needed
+and then kept up to date from the change log, which records every write
+made through the SCIM adapters: each refresh reloads only the users and
+groups changed since the sequence number the index was last brought up to.
+
+A refresh is due at the start of every SCIM request (so changes made by
+other processes show up in the next response, as they would without the
+index) and after a write made by this process commits. Changes made without
+going through the adapters are picked up when the index is rebuilt from
+scratch, every ``SCIM_MEMBERSHIP_INDEX_MAX_AGE`` seconds. Setting it to 0
+disables the index.
+"""
+import threading
+import time
+from array import array
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import connection
+
+from .models import Change
+from .utils import get_setting
+
+# Largest number of parameters put in one ``IN (...)`` lookup; SQLite limits
+# a statement to 999.
+LOOKUP_CHUNK = 900
+
+# Past this many changed users and groups (eg. after a bulk import), the
+# index is rebuilt rather than updated.
+FULL_RELOAD_THRESHOLD = 10000
+
+EMPTY = array('l')
+
+
+def _chunks(ids):
+    ids = sorted(ids)
+    for i in range(0, len(ids), LOOKUP_CHUNK):
+        yield ids[i:i + LOOKUP_CHUNK]
+
+
+class MembershipIndex(object):
+    def __init__(self):
+        self.seq = 0
+        self.built = 0.0
+        self.generation = None
+        self.user_groups = {}
+        self.group_members = {}
+        self.group_names = {}
+        self.usernames = {}
+
+    def build(self):
+        # Read the version first: changes committed while loading are then
+        # applied again by the next refresh, which is harmless. Memberships
+        # are read in (user, group) order, so the arrays come out sorted.
+        self.seq = Change.objects.last_seq()
+
+        user_groups, group_members = {}, {}
+        through = get_user_model().groups.through
+        for user_id, group_id in through.objects.order_by('user_id', 'group_id') \
+                                               .values_list('user_id', 'group_id').iterator():
+            user_groups.setdefault(user_id, array('l')).append(group_id)
+            group_members.setdefault(group_id, array('l')).append(user_id)
+
+        self.group_names = dict(Group.objects.values_list('id', 'name').iterator())
+        self.usernames = dict(get_user_model().objects.values_list('id', 'username').iterator())
+        self.user_groups, self.group_members = user_groups, group_members
+        self.built = time.monotonic()
+
+    def refresh(self):
+        """Apply the changes logged since the index was last refreshed."""
+        user_ids, group_ids = set(), set()
+        seq = self.seq
+        for seq, resource_type, resource_id in Change.objects.since(self.seq) \
+                .values_list('seq', 'resource_type', 'resource_id').iterator():
+            try:
+                id_ = int(resource_id)
+            except ValueError:
+                continue
+            if resource_type == 'User':
+                user_ids.add(id_)
+            elif resource_type == 'Group':
+                group_ids.add(id_)
+
+        if len(user_ids) + len(group_ids) > FULL_RELOAD_THRESHOLD:
+            self.build()
+            return
+        if user_ids:
+            self.reload_users(user_ids)
+        if group_ids:
+            self.reload_groups(group_ids)
+        self.seq = seq
+
+    def reload_users(self, user_ids):
+        model = get_user_model()
+        usernames, memberships = {}, {user_id: array('l') for user_id in user_ids}
+        for chunk in _chunks(user_ids):
+            usernames.update(model.objects.filter(id__in=chunk).values_list('id', 'username'))
+            for user_id, group_id in model.groups.through.objects.filter(user_id__in=chunk) \
+                    .order_by('group_id').values_list('user_id', 'group_id'):
+                memberships[user_id].append(group_id)
+
+        for user_id, group_ids in memberships.items():
+            if user_id in usernames:
+                self.usernames[user_id] = usernames[user_id]
+            else:
+                self.usernames.pop(user_id, None)
+            self.set_user_groups(user_id, group_ids)
+
+    def reload_groups(self, group_ids):
+        model = get_user_model()
+        names, memberships = {}, {group_id: array('l') for group_id in group_ids}
+        for chunk in _chunks(group_ids):
+            names.update(Group.objects.filter(id__in=chunk).values_list('id', 'name'))
+            for group_id, user_id in model.groups.through.objects.filter(group_id__in=chunk) \
+                    .order_by('user_id').values_list('group_id', 'user_id'):
+                memberships[group_id].append(user_id)
+
+        for group_id, user_ids in memberships.items():
+            if group_id in names:
+                self.group_names[group_id] = names[group_id]
+            else:
+                self.group_names.pop(group_id, None)
+            self.set_group_members(group_id, user_ids)
+
+    def set_user_groups(self, user_id, group_ids):
+        old = set(self.user_groups.get(user_id, EMPTY))
+        new = set(group_ids)
+        for group_id in old - new:
+            self._store(self.group_members, group_id,
+                        [m for m in self.group_members.get(group_id, EMPTY) if m != user_id])
+        for group_id in new - old:
+            self._store(self.group_members, group_id,
+                        sorted(set(self.group_members.get(group_id, EMPTY)) | {user_id}))
+        self._store(self.user_groups, user_id, group_ids)
+
+    def set_group_members(self, group_id, user_ids):
+        old = set(self.group_members.get(group_id, EMPTY))
+        new = set(user_ids)
+        for user_id in old - new:
+            self._store(self.user_groups, user_id,
+                        [g for g in self.user_groups.get(user_id, EMPTY) if g != group_id])
+        for user_id in new - old:
+            self._store(self.user_groups, user_id,
+                        sorted(set(self.user_groups.get(user_id, EMPTY)) | {group_id}))
+        self._store(self.group_members, group_id, user_ids)
+
+    @staticmethod
+    def _store(mapping, key, ids):
+        # Arrays are replaced rather than modified, so a reader in another
+        # thread never sees one half updated. Empty ones are dropped, as
+        # build() leaves them out.
+        if ids:
+            mapping[key] = array('l', ids)
+        else:
+            mapping.pop(key, None)
+
+    def groups_of(self, user_id):
+        """Return the SCIM ``groups`` of the user with ``user_id``."""
+        names = self.group_names
+        return [{'value': str(group_id), 'display': names[group_id]}
+                for group_id in self.user_groups.get(user_id, EMPTY) if group_id in names]
+
+    def members_of(self, group_id):
+        """Return the SCIM ``members`` of the group with ``group_id``."""
+        usernames = self.usernames
+        return [{'value': str(user_id), 'display': usernames[user_id]}
+                for user_id in self.group_members.get(group_id, EMPTY) if user_id in usernames]
+
+
+_index = None
+_lock = threading.Lock()
+# Bumped by expire(); the index is fresh when it was last refreshed at the
+# current generation.
+_generation = 0
+
+
+def expire():
+    """
+    Have the index refreshed from the change log before it is next used.
+    Called at the start of every SCIM request and after this process commits
+    a write.
+    """
+    global _generation
+    _generation += 1
+
+
+def get_index():
+    """
+    Return the up to date membership index, or ``None`` when it can't be
+    used, in which case memberships are to be read from the database.
+
+    Inside a transaction, the database may hold uncommitted changes the index
+    must not pick up, so it is not used there.
+    """
+    global _index
+    max_age = get_setting('SCIM_MEMBERSHIP_INDEX_MAX_AGE', 0)
+    if not max_age or connection.in_atomic_block:
+        return None
+
+    index = _index
+    if index is not None and index.generation == _generation and \
+            time.monotonic() - index.built < max_age:
+        return index
+
+    with _lock:
+        generation = _generation
+        if _index is None or time.monotonic() - _index.built >= max_age:
+            index = MembershipIndex()
+            index.build()
+            _index = index
+        elif _index.generation != generation:
+            _index.refresh()
+        # An expire() while refreshing leaves the index due for another.
+        _index.generation = generation
+        return _index
@@ -0,0 +1,17 @@
+# Generated by Django 2.1.2 on 2026-10-19 17:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_scim', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['resource_type', 'resource_id'], name='scim_change_resource_idx'),
+        ),
+    ]
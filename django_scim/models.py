@@ -1,5 +1,6 @@
 from urllib.parse import urljoin
 
+from django.db import models
 from django.urls import reverse
 
 from . import constants
@@ -47,7 +48,7 @@ class SCIMServiceProviderConfig(object):
                 'supported': True,
             },
             'sort': {
-                'supported': False,
+                'supported': True,
             },
             'etag': {
                 'supported': False,
@@ -68,3 +69,58 @@ class SCIMServiceProviderConfig(object):
                 ]
             }
         }
+
+
+class ChangeQuerySet(models.QuerySet):
+    def since(self, seq):
+        """
+        Return the changes recorded after sequence number ``seq``, oldest
+        first.
+        """
+        return self.filter(seq__gt=seq).order_by('seq')
+
+    def last_seq(self):
+        """
+        Return the sequence number of the latest of these changes, or 0 if
+        there are none. The change log's last sequence number serves as a
+        version of the directory.
+        """
+        return self.aggregate(seq=models.Max('seq'))['seq'] or 0
+
+
+class Change(models.Model):
+    """
+    An append-only record of a write made through the SCIM adapters. The
+    ``seq`` column is assigned by the database and only ever increases, so
+    consumers can resume from the last sequence number they have seen.
+    """
+    CREATE = 'create'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    OPERATIONS = (
+        (CREATE, 'Create'),
+        (UPDATE, 'Update'),
+        (DELETE, 'Delete'),
+    )
+
+    seq = models.BigAutoField(primary_key=True)
+    resource_type = models.CharField(max_length=16)
+    resource_id = models.CharField(max_length=64)
+    operation = models.CharField(max_length=6, choices=OPERATIONS)
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    objects = ChangeQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['resource_type', 'resource_id'], name='scim_change_resource_idx'),
+        ]
+
+    def to_dict(self):
+        return {
+            'seq': self.seq,
+            'resourceType': self.resource_type,
+            'id': self.resource_id,
+            'operation': self.operation,
+            'timestamp': self.timestamp.isoformat(timespec='milliseconds'),
+        }
@@ -1,28 +1,300 @@
 """
 Filter transformers are used to convert the SCIM query and filter syntax into
-valid SQL queries.
+Django queries.
+
+Only the subset of the SCIM filter grammar that Okta actually sends is
+supported: attribute comparisons joined with ``and``/``or``, optionally
+negated with ``not`` and grouped with parentheses. Eg::
+
+    userName eq "jdoe@example.com"
+    meta.lastModified gt "2018-12-04T05:10:00Z"
 """
+import re
+from collections import OrderedDict
 
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(\()|(\))|("(?:[^"\\]|\\.)*")|([^\s()"]+))')
+
+# SCIM comparison operator -> Django field lookup.
+OPERATORS = {
+    'eq': 'exact',
+    'ne': 'exact',
+    'co': 'contains',
+    'sw': 'startswith',
+    'ew': 'endswith',
+    'gt': 'gt',
+    'ge': 'gte',
+    'lt': 'lt',
+    'le': 'lte',
+}
+
+
+def to_string(value):
+    if not isinstance(value, str):
+        raise ValueError('Expected a string value, got {!r}'.format(value))
+    return value
+
 
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError('Expected an integer value, got {!r}'.format(value))
 
-#field1=value1 OR field1=value2 to SQL
 
-class SCIMSimpleUserFilterTransformer:
-    """Transforms a PlyPlus parse tree into a tuple containing a raw SQL query
-    and a dict with query parameters to go with the query."""
+def to_bool(value):
+    if not isinstance(value, bool):
+        raise ValueError('Expected a boolean value, got {!r}'.format(value))
+    return value
+
+
+def to_datetime(value):
+    dt = parse_datetime(value) if isinstance(value, str) else None
+    if dt is None:
+        raise ValueError('Expected a date-time value, got {!r}'.format(value))
+    if timezone.is_naive(dt):
+        dt = timezone.make_aware(dt, timezone.utc)
+    return dt
+
+
+class SCIMFilterTransformer:
+    """Transforms a SCIM filter string into a Django ``Q`` object for
+    ``model``. Subclasses declare which SCIM attribute paths may be filtered
+    on in ``attributes``, a mapping of the lower-cased attribute path to a
+    ``(field lookup, value converter)`` tuple."""
+
+    model = None
+    attributes = {}
+    # Attributes backed by a unique column; see ``exact_lookup``.
+    unique_attributes = frozenset()
+    # Set when an attribute spans a multi-valued relation, which can match
+    # the same row more than once.
+    distinct = False
+
+    @classmethod
+    def get_model(cls):
+        return cls.model
 
     @classmethod
     def search(cls, query):
-        """Takes a SCIM 1.1 filter query and returns a Django `QuerySet` that
-        contains zero or more user model instances.
+        """Takes a SCIM filter query and returns a Django `QuerySet` that
+        contains zero or more model instances.
 
         :param unicode query: a `unicode` query string.
         """
-        print("Input Query: " + query)
-        sql_query = query.replace('eq', '=')
-        print("SQL Query: " + sql_query)
+        q = cls.to_q(query)
+        qs = cls.get_model().objects.filter(q)
+        if cls.distinct:
+            qs = qs.distinct()
+        return qs.order_by('id')
+
+    @classmethod
+    def exact_lookup(cls, query):
+        """
+        If ``query`` is a single ``eq`` comparison on one of the
+        ``unique_attributes``, which can match at most one row, return the
+        ``(field, value)`` to look that row up by. Return ``None`` otherwise,
+        including for invalid values, which ``search`` then reports.
+        """
+        try:
+            tokens = cls.tokenize(query)
+        except ValueError:
+            return None
+        if len(tokens) != 3 or tokens[0][0] != 'word' or tokens[1][0] != 'word':
+            return None
+
+        attr, op, (kind, raw) = tokens[0][1].lower(), tokens[1][1].lower(), tokens[2]
+        if op != 'eq' or attr not in cls.unique_attributes or kind not in ('value', 'word'):
+            return None
+
+        field, convert = cls.attributes[attr]
+        try:
+            value = raw if kind == 'value' else cls._literal(raw)
+            return field, convert(value)
+        except ValueError:
+            return None
+
+    @classmethod
+    def to_q(cls, query):
+        tokens = cls.tokenize(query)
+        q, pos = cls._parse_or(tokens, 0)
+        if pos != len(tokens):
+            raise ValueError('Unexpected token {!r}'.format(tokens[pos][1]))
+        return q
+
+    @staticmethod
+    def tokenize(query):
+        tokens = []
+        pos = 0
+        query = query.rstrip()
+        while pos < len(query):
+            match = TOKEN_PATTERN.match(query, pos)
+            if match is None:
+                raise ValueError('Unable to parse filter near {!r}'.format(query[pos:]))
+            lparen, rparen, string, word = match.groups()
+            if lparen:
+                tokens.append(('(', lparen))
+            elif rparen:
+                tokens.append((')', rparen))
+            elif string:
+                tokens.append(('value', string[1:-1].replace('\\"', '"').replace('\\\\', '\\')))
+            else:
+                tokens.append(('word', word))
+            pos = match.end()
+        return tokens
+
+    @classmethod
+    def _parse_or(cls, tokens, pos):
+        q, pos = cls._parse_and(tokens, pos)
+        terms = [q]
+        while cls._is_keyword(tokens, pos, 'or'):
+            q, pos = cls._parse_and(tokens, pos + 1)
+            terms.append(q)
+        return cls._combine_or(terms), pos
+
+    @classmethod
+    def _combine_or(cls, terms):
+        """
+        OR ``terms`` together, collapsing equality comparisons on the same
+        field (``id eq 1 or id eq 2 ...``) into ``IN`` lookups, which the
+        database resolves with one index probe per value instead of
+        evaluating every comparison for every row.
+
+        Long chains are split into several ``IN`` lists, each within the
+        backend's ``max_in_list_size`` and ``max_query_params``, OR-ed
+        together in the same query.
+        """
+        values = OrderedDict()
+        others = []
+        for q in terms:
+            if not q.negated and len(q.children) == 1 and isinstance(q.children[0], tuple) \
+                    and q.children[0][0].endswith('__exact'):
+                lookup, value = q.children[0]
+                values.setdefault(lookup[:-len('__exact')], []).append(value)
+            else:
+                others.append(q)
+
+        combined = []
+        for field, field_values in values.items():
+            field_values = list(OrderedDict.fromkeys(field_values))
+            if len(field_values) == 1:
+                combined.append(Q(**{field + '__exact': field_values[0]}))
+                continue
+
+            size = min(filter(None, (connection.ops.max_in_list_size(),
+                                     connection.features.max_query_params,
+                                     len(field_values))))
+            for i in range(0, len(field_values), size):
+                combined.append(Q(**{field + '__in': field_values[i:i + size]}))
+
+        q = None
+        for term in combined + others:
+            q = term if q is None else q | term
+        return q
+
+    @classmethod
+    def _parse_and(cls, tokens, pos):
+        q, pos = cls._parse_factor(tokens, pos)
+        while cls._is_keyword(tokens, pos, 'and'):
+            rhs, pos = cls._parse_factor(tokens, pos + 1)
+            q = q & rhs
+        return q, pos
+
+    @classmethod
+    def _parse_factor(cls, tokens, pos):
+        if cls._is_keyword(tokens, pos, 'not'):
+            q, pos = cls._parse_factor(tokens, pos + 1)
+            return ~q, pos
+
+        if pos < len(tokens) and tokens[pos][0] == '(':
+            q, pos = cls._parse_or(tokens, pos + 1)
+            if pos >= len(tokens) or tokens[pos][0] != ')':
+                raise ValueError('Unbalanced parentheses in filter')
+            return q, pos + 1
+
+        if pos + 1 >= len(tokens) or tokens[pos][0] != 'word' or tokens[pos + 1][0] != 'word':
+            raise ValueError('Expected an attribute comparison')
+
+        attr = tokens[pos][1]
+        op = tokens[pos + 1][1].lower()
+        if op == 'pr':
+            return cls.build_q(attr, op, None), pos + 2
+
+        if pos + 2 >= len(tokens) or tokens[pos + 2][0] not in ('value', 'word'):
+            raise ValueError('Expected a value after {} {}'.format(attr, op))
+
+        kind, raw = tokens[pos + 2]
+        value = raw if kind == 'value' else cls._literal(raw)
+        return cls.build_q(attr, op, value), pos + 3
+
+    @staticmethod
+    def _is_keyword(tokens, pos, keyword):
+        return pos < len(tokens) and tokens[pos][0] == 'word' and tokens[pos][1].lower() == keyword
+
+    @staticmethod
+    def _literal(raw):
+        literals = {'true': True, 'false': False, 'null': None}
+        if raw.lower() in literals:
+            return literals[raw.lower()]
+        try:
+            return int(raw)
+        except ValueError:
+            raise ValueError('Invalid filter value {!r}'.format(raw))
+
+    @classmethod
+    def build_q(cls, attr, op, value):
+        try:
+            field, convert = cls.attributes[attr.lower()]
+        except KeyError:
+            raise ValueError('Unsupported filter attribute {!r}'.format(attr))
+
+        if op == 'pr':
+            return Q(**{field + '__isnull': False})
+
+        if op not in OPERATORS:
+            raise ValueError('Unsupported filter operator {!r}'.format(op))
+
+        q = Q(**{'{}__{}'.format(field, OPERATORS[op]): convert(value)})
+        return ~q if op == 'ne' else q
+
+
+class SCIMSimpleUserFilterTransformer(SCIMFilterTransformer):
+    """Filters the user model by the SCIM User attributes Okta queries on."""
+
+    attributes = {
+        'id': ('id', to_int),
+        'username': ('username', to_string),
+        'name.givenname': ('first_name', to_string),
+        'name.familyname': ('last_name', to_string),
+        'emails': ('email', to_string),
+        'emails.value': ('email', to_string),
+        'active': ('is_active', to_bool),
+        'meta.created': ('date_joined', to_datetime),
+        'meta.lastmodified': ('profile__last_modified', to_datetime),
+    }
+    unique_attributes = frozenset(['id', 'username'])
+
+    @classmethod
+    def get_model(cls):
+        return get_user_model()
+
+
+class SCIMSimpleGroupFilterTransformer(SCIMFilterTransformer):
+    """Filters groups by the SCIM Group attributes Okta queries on, most
+    notably ``displayName eq "..."`` before every group push."""
 
-        final_query = 'select distinct u.* from auth_user u where {} order by u.id ASC'.format(sql_query)
-        print("Final Query: " + final_query)
-        return get_user_model().objects.raw(final_query, None)
+    model = Group
+    distinct = True
+    attributes = {
+        'id': ('id', to_int),
+        'displayname': ('name', to_string),
+        'members.value': ('user__id', to_int),
+    }
+    unique_attributes = frozenset(['id', 'displayname'])
@@ -0,0 +1,1165 @@
+"""
+Tests of the SCIM endpoints, foremost their query budgets.
+
+Every endpoint is called against directories of several sizes. It must run
+the same number of queries at every size, no more than its budget, and
+allocate about as much memory: an endpoint that does work per user or group
+of the directory, such as an N+1 query, fails here. Behaviour the budget
+tests don't cover is tested after them.
+"""
+import gzip
+import json
+import os
+import threading
+import tracemalloc
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from unittest import skipIf
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management import call_command
+from django import db
+from django.db import connection
+from django.http import HttpResponse
+from django.test import Client
+from django.test import RequestFactory
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from swa_app.models import Profile
+
+from . import compression
+from . import dbjson
+from . import idempotency
+from . import lookups
+from . import membership
+from . import timing
+from .adapters import SCIMUser
+from .models import Change
+from .throttling import AdmissionController
+from .views import RootSearchView
+from .views import get_search_executor
+from .writer import writer
+
+API_KEY = 'Bearer test'
+
+# Directory sizes each endpoint is measured at, in users.
+SIZES = (100, 1000)
+
+# Page size of list and search requests; the smallest directory fills a page
+# of groups.
+PAGE = 10
+
+# Groups each user is a member of. There is a group per ten users, so groups
+# have the same number of members whatever the size of the directory.
+GROUPS_PER_USER = 3
+MEMBERS_PER_GROUP = 10 * GROUPS_PER_USER
+
+# How much more memory a request may allocate in the largest directory than
+# in the smallest, as a ratio and in bytes. Each endpoint also has a ceiling
+# of its own, in KiB, on what it allocates at peak.
+ALLOCATION_RATIO = 1.5
+ALLOCATION_SLACK = 64 * 1024
+
+
+def make_directory(users):
+    """
+    Grow the directory to ``users`` users, called ``user<n>``, and a group,
+    ``group<n>``, per ten users. Group ``n`` has the ``MEMBERS_PER_GROUP``
+    users from ``user<10n>`` on as members.
+    """
+    model = get_user_model()
+    existing = model.objects.count()
+    groups = users // 10
+
+    Group.objects.bulk_create([Group(name='group%d' % i)
+                               for i in range(Group.objects.count(), groups)])
+    model.objects.bulk_create([
+        model(username='user%d' % i, first_name='First%d' % i, last_name='Last%d' % i,
+              email='user%d@example.com' % i, password='!')
+        for i in range(existing, users)
+    ])
+
+    new_users = model.objects.filter(profile__isnull=True).order_by('id')
+    Profile.objects.bulk_create([Profile(user=user, department='Sales') for user in new_users])
+
+    group_ids = list(Group.objects.order_by('id').values_list('id', flat=True))
+    memberships = []
+    for i, user in enumerate(new_users, existing):
+        for group_id in group_ids[max(0, (i - MEMBERS_PER_GROUP) // 10 + 1):i // 10 + 1]:
+            memberships.append(model.groups.through(user_id=user.id, group_id=group_id))
+    model.groups.through.objects.bulk_create(memberships)
+
+
+class InlineExecutor(object):
+    """Runs the root search in the test's thread, where queries are counted."""
+
+    def map(self, fn, *iterables):
+        return list(map(fn, *iterables))
+
+
+# Settings of the tests, which call the endpoints as fast as they can.
+TEST_SETTINGS = {
+    'SCIM_RATE_LIMIT': 0,
+    'SCIM_IDEMPOTENCY_WINDOW': 0,
+    'SCIM_GROUP_COMMIT': False,
+    'SCIM_DB_JSON': False,
+}
+
+
+class SCIMClientMixin(object):
+    """Sets up ``self.client`` to call the SCIM endpoints."""
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, {'API_KEY': API_KEY})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = Client(HTTP_AUTHORIZATION=API_KEY)
+
+
+@override_settings(**TEST_SETTINGS)
+class SCIMTestCase(SCIMClientMixin, TestCase):
+    """Base class of tests calling the SCIM endpoints."""
+
+
+class QueryBudgetTestCase(SCIMTestCase):
+    """
+    Base class of the budget tests. ``assertBudget(call, queries, memory)``
+    calls ``call(client, n)`` at each directory size, once to warm up and once
+    to measure, with a different ``n`` every time so that writes don't
+    collide.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+
+    def call(self, call):
+        self.calls += 1
+        response = call(self.client, self.calls)
+        self.assertLess(response.status_code, 300, response.content)
+        return response
+
+    def measure(self, call):
+        """Return the queries run and the memory allocated at peak by ``call``."""
+        self.call(call)
+        tracemalloc.start()
+        try:
+            with CaptureQueriesContext(connection) as queries:
+                self.call(call)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return queries, peak
+
+    def assertBudget(self, call, queries, memory):
+        """
+        Assert that ``call`` runs the same number of queries, at most
+        ``queries``, and allocates about as much memory at every size, at
+        most ``memory`` KiB at peak.
+        """
+        measurements = []
+        for self.size in SIZES:
+            make_directory(self.size)
+            self.user_ids = list(get_user_model().objects.order_by('id').values_list('id', flat=True)[:10])
+            self.group_ids = list(Group.objects.order_by('id').values_list('id', flat=True)[:10])
+            measurements.append(self.measure(call))
+
+        counts = [len(captured) for captured, _ in measurements]
+        self.assertEqual(len(set(counts)), 1, 'Queries grow with the directory: {}\n{}'.format(
+            dict(zip(SIZES, counts)),
+            '\n'.join(query['sql'] for query in measurements[-1][0].captured_queries)))
+        self.assertLessEqual(counts[0], queries, '\n'.join(
+            query['sql'] for query in measurements[0][0].captured_queries))
+
+        smallest, largest = measurements[0][1], measurements[-1][1]
+        self.assertLessEqual(
+            largest, smallest * ALLOCATION_RATIO + ALLOCATION_SLACK,
+            'Allocations grow with the directory: {}'.format(
+                dict(zip(SIZES, [peak for _, peak in measurements]))))
+        self.assertLessEqual(max(peak for _, peak in measurements), memory * 1024,
+                             'Allocations exceed the budget: {}'.format(
+                                 dict(zip(SIZES, [peak for _, peak in measurements]))))
+
+    def user_id(self, n):
+        return self.user_ids[n % len(self.user_ids)]
+
+    def group_id(self, n):
+        return self.group_ids[n % len(self.group_ids)]
+
+
+def post(path, doc):
+    return lambda client, n: client.post(path, json.dumps(doc(n)),
+                                         content_type='application/scim+json')
+
+
+def search(path, filter):
+    return lambda client, n: client.post('{}?count={}'.format(path, PAGE), json.dumps({
+        'schemas': ['urn:ietf:params:scim:api:messages:2.0:SearchRequest'],
+        'filter': filter(n),
+    }), content_type='application/scim+json')
+
+
+class UserBudgetTests(QueryBudgetTestCase):
+
+    def test_list(self):
+        self.assertBudget(lambda client, n: client.get('/scim/v2/Users', {'count': PAGE}), 3, 256)
+
+    def test_list_last_page(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users', {'count': PAGE, 'startIndex': self.size - PAGE + 1}), 3, 256)
+
+    def test_list_sorted(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users', {'count': PAGE, 'sortBy': 'name.familyName'}), 3, 256)
+
+    def test_filter(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users', {'count': PAGE, 'filter': 'userName sw "user1" and active eq true'}), 3, 256)
+
+    def test_filter_unique(self):
+        # Okta's existence check, with a different userName each time.
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users', {'filter': 'userName eq "user%d"' % n}), 4, 96)
+
+    def test_filter_missing(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users', {'filter': 'userName eq "missing%d"' % n}), 2, 64)
+
+    def test_search(self):
+        self.assertBudget(search('/scim/v2/Users/.search',
+                                 lambda n: 'userName sw "user" or name.familyName eq "Last%d"' % n), 3, 256)
+
+    def test_single(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Users/%d' % self.user_id(n)), 3, 64)
+
+    def test_create(self):
+        self.assertBudget(post('/scim/v2/Users', lambda n: {
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': 'new%d' % n,
+            'name': {'givenName': 'New', 'familyName': 'User'},
+            'emails': [{'value': 'new%d@example.com' % n, 'primary': True}],
+            'groups': [],
+        }), 11, 128)
+
+    def test_update(self):
+        def call(client, n):
+            return client.put('/scim/v2/Users/%d' % self.user_id(n), json.dumps({
+                'schemas': ['urn:scim:schemas:core:1.0'],
+                'userName': 'user%d' % (n % 10),
+                'name': {'givenName': 'Renamed%d' % n, 'familyName': 'Last'},
+                'emails': [{'value': 'renamed%d@example.com' % n, 'primary': True}],
+                'active': True,
+            }), content_type='application/scim+json')
+        self.assertBudget(call, 10, 128)
+
+    def test_deactivate(self):
+        # Deactivating and reactivating don't depend on the user's groups.
+        def call(client, n):
+            return client.put('/scim/v2/Users/%d' % self.user_id(n), json.dumps({
+                'schemas': ['urn:scim:schemas:core:1.0'],
+                'userName': 'user%d' % (n % 10),
+                'active': bool(n // 10 % 2),
+            }), content_type='application/scim+json')
+        self.assertBudget(call, 10, 96)
+
+
+class GroupBudgetTests(QueryBudgetTestCase):
+
+    def test_list(self):
+        self.assertBudget(lambda client, n: client.get('/scim/v2/Groups', {'count': PAGE}), 3, 1024)
+
+    def test_filter(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Groups', {'count': PAGE, 'filter': 'displayName sw "group"'}), 3, 1024)
+
+    def test_filter_unique(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Groups', {'filter': 'displayName eq "group%d"' % (n % 10)}), 3, 128)
+
+    def test_single(self):
+        self.assertBudget(lambda client, n: client.get(
+            '/scim/v2/Groups/%d' % self.group_id(n)), 2, 128)
+
+    def test_create(self):
+        def doc(n):
+            return {
+                'schemas': ['urn:scim:schemas:core:1.0'],
+                'displayName': 'new%d' % n,
+                'members': [{'value': str(self.user_id(n + k))} for k in range(3)],
+            }
+        self.assertBudget(post('/scim/v2/Groups', doc), 20, 128)
+
+    def test_replace(self):
+        def call(client, n):
+            return client.put('/scim/v2/Groups/%d' % self.group_id(n), json.dumps({
+                'schemas': ['urn:scim:schemas:core:1.0'],
+                'displayName': 'replaced%d' % n,
+                'members': [{'value': str(self.user_id(n + k))} for k in range(3)],
+            }), content_type='application/scim+json')
+        self.assertBudget(call, 20, 256)
+
+    def test_patch(self):
+        def call(client, n):
+            op = 'add' if n % 2 else 'remove'
+            return client.patch('/scim/v2/Groups/%d' % self.group_id(0), json.dumps({
+                'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+                'Operations': [{'op': op, 'path': 'members',
+                                'value': [{'value': str(self.user_id(5))}]}],
+            }), content_type='application/scim+json')
+        self.assertBudget(call, 12, 160)
+
+
+@mock.patch('django_scim.views.get_search_executor', InlineExecutor)
+class RootSearchBudgetTests(QueryBudgetTestCase):
+
+    def test_search(self):
+        self.assertBudget(search('/scim/v2/.search', lambda n: 'id pr'), 4, 256)
+
+
+@override_settings(SCIM_DB_JSON=True)
+class DatabaseJSONBudgetTests(QueryBudgetTestCase):
+
+    def test_users(self):
+        self.assertBudget(lambda client, n: client.get('/scim/v2/Users', {'count': PAGE}), 2, 192)
+
+    def test_groups(self):
+        self.assertBudget(lambda client, n: client.get('/scim/v2/Groups', {'count': PAGE}), 2, 160)
+
+
+@override_settings(SCIM_MEMBERSHIP_INDEX_MAX_AGE=3600, **TEST_SETTINGS)
+class MembershipIndexBudgetTests(SCIMClientMixin, TransactionTestCase):
+    """
+    The membership index is only used outside transactions, so these run
+    without the transaction wrapping each ``TestCase`` test.
+    """
+
+    def assertBudget(self, path, queries):
+        counts = []
+        for size in SIZES:
+            make_directory(size)
+            # The directory is grown behind the change log's back, so the
+            # index is rebuilt by the first request.
+            membership._index = None
+            self.client.get(path, {'count': PAGE})
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(path, {'count': PAGE})
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(captured))
+        self.assertEqual(len(set(counts)), 1, 'Queries grow with the directory: {}'.format(
+            dict(zip(SIZES, counts))))
+        self.assertLessEqual(counts[0], queries)
+
+    def test_users(self):
+        self.assertBudget('/scim/v2/Users', 3)
+
+    def test_groups(self):
+        self.assertBudget('/scim/v2/Groups', 3)
+
+
+class DeactivationTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(100)
+        self.user = get_user_model().objects.get(username='user42')
+        self.groups = set(self.user.groups.values_list('id', flat=True))
+
+    def put(self, active):
+        response = self.client.put('/scim/v2/Users/%d' % self.user.id, json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': self.user.username,
+            'active': active,
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.user.refresh_from_db()
+        self.user.profile.refresh_from_db()
+        return json.loads(response.content.decode())
+
+    def search(self, filter):
+        response = self.client.get('/scim/v2/Users', {'filter': filter})
+        return [resource['userName'] for resource in json.loads(response.content.decode())['Resources']]
+
+    def test_deactivate(self):
+        self.assertIs(self.put(False)['active'], False)
+        self.assertFalse(self.user.is_active)
+        self.assertIsNotNone(self.user.profile.deactivated_at)
+        self.assertEqual(set(self.user.groups.values_list('id', flat=True)), self.groups)
+
+        self.assertEqual(self.search('userName eq "user42"'), ['user42'])
+        self.assertEqual(self.search('userName sw "user4" and active eq true'),
+                         ['user4'] + ['user4%d' % i for i in range(10) if i != 2])
+        self.assertEqual(self.search('active eq false'), ['user42'])
+
+    def test_reactivate(self):
+        self.put(False)
+        deactivated_at = self.user.profile.deactivated_at
+        self.put(False)
+        self.assertEqual(self.user.profile.deactivated_at, deactivated_at)
+
+        self.assertIs(self.put(True)['active'], True)
+        self.assertTrue(self.user.is_active)
+        self.assertIsNone(self.user.profile.deactivated_at)
+        self.assertEqual(set(self.user.groups.values_list('id', flat=True)), self.groups)
+
+
+class UserMetaTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(20)
+
+    def resources(self, params=None):
+        response = self.client.get('/scim/v2/Users', dict({'count': 100}, **(params or {})))
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content.decode())['Resources']
+
+    def test_meta(self):
+        user = get_user_model().objects.get(username='user3')
+        # Timestamps are reported to the millisecond.
+        Profile.objects.filter(user=user).update(last_modified=timezone.now().replace(microsecond=123000))
+        response = self.client.get('/scim/v2/Users/%d' % user.id)
+        meta = json.loads(response.content.decode())['meta']
+        self.assertEqual(meta['resourceType'], 'User')
+        self.assertEqual(meta['created'], user.date_joined.isoformat(timespec='milliseconds'))
+        self.assertEqual(meta['location'], response['Location'])
+
+        # The watermark of the next delta import excludes the user until it
+        # changes again.
+        def modified_since(op):
+            return [resource['id'] for resource in self.resources(
+                {'filter': 'meta.lastModified {} "{}"'.format(op, meta['lastModified'])})]
+        self.assertIn(str(user.id), modified_since('ge'))
+        self.assertNotIn(str(user.id), modified_since('gt'))
+
+    def test_database_json(self):
+        # Including timestamps with and without a fraction of a second.
+        Profile.objects.filter(user__username='user1').update(
+            last_modified=timezone.now().replace(microsecond=0))
+        Profile.objects.filter(user__username='user2').update(
+            last_modified=timezone.now().replace(microsecond=999999))
+        expected = self.resources()
+        with override_settings(SCIM_DB_JSON=True):
+            self.assertIsNotNone(dbjson.documents(SCIMUser, get_user_model().objects.all()))
+            self.assertEqual(self.resources(), expected)
+        self.assertIn('lastModified', expected[0]['meta'])
+
+
+@override_settings(**TEST_SETTINGS)
+class RootSearchTests(SCIMClientMixin, TransactionTestCase):
+    """
+    The root search on the thread pool. Its threads have connections of
+    their own, which only see committed rows, so these run without the
+    transaction wrapping each ``TestCase`` test.
+    """
+
+    def setUp(self):
+        super().setUp()
+        make_directory(30)
+        # The directory is made behind the change log's back.
+        membership._index = None
+        self.threads = set()
+        for name in ('_count', '_serialize'):
+            patcher = mock.patch.object(RootSearchView, name, side_effect=self.on_thread(
+                getattr(RootSearchView, name)))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def on_thread(self, fn):
+        def wrapper(*args):
+            self.threads.add(threading.current_thread().name)
+            return fn(*args)
+        return wrapper
+
+    def search(self, filter, start=1, count=PAGE):
+        response = self.client.post('/scim/v2/.search?startIndex={}&count={}'.format(start, count), json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:SearchRequest'],
+            'filter': filter,
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+        return json.loads(response.content.decode())
+
+    def test_search(self):
+        doc = self.search('id pr', start=28, count=5)
+        self.assertEqual(doc['totalResults'], 33)
+        self.assertEqual([(resource.get('userName'), resource.get('displayName'))
+                          for resource in doc['Resources']],
+                         [('user27', 'First27 Last27'), ('user28', 'First28 Last28'),
+                          ('user29', 'First29 Last29'), (None, 'group0'), (None, 'group1')])
+        self.assertEqual(len(doc['Resources'][3]['members']), MEMBERS_PER_GROUP)
+        self.assertTrue(self.threads)
+        self.assertFalse(any(name == threading.current_thread().name for name in self.threads))
+
+    def test_one_resource_type(self):
+        # Users can't be filtered on displayName.
+        doc = self.search('displayName eq "group2"')
+        self.assertEqual([resource['displayName'] for resource in doc['Resources']], ['group2'])
+
+    def test_repeated(self):
+        # More searches than the pool has threads, each of which closes its
+        # connections when done.
+        for _ in range(3 * get_search_executor()._max_workers):
+            self.assertEqual(self.search('userName eq "user3"')['totalResults'], 1)
+
+
+@override_settings(**dict(TEST_SETTINGS, SCIM_IDEMPOTENCY_WINDOW=300))
+class IdempotencyTests(SCIMClientMixin, TransactionTestCase):
+    """
+    Retries run in threads of their own, standing in for other requests of
+    the same process or, with a database cache, of other processes.
+    """
+
+    def run_in_thread(self, fn, *args):
+        result = {}
+
+        def target():
+            try:
+                result['value'] = fn(*args)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread, result
+
+    def create(self, client):
+        return client.post('/scim/v2/Users', json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': 'retried',
+        }), content_type='application/scim+json')
+
+    def test_replay(self):
+        first = self.create(self.client)
+        retry = self.create(self.client)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry['Idempotent-Replay'], 'true')
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(get_user_model().objects.filter(username='retried').count(), 1)
+
+    def test_shared_cache(self):
+        caches_setting = dict(settings.CACHES, idempotency={
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'scim_idempotency',
+        })
+        with override_settings(CACHES=caches_setting):
+            call_command('createcachetable', 'scim_idempotency')
+            self.create(self.client)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM scim_idempotency')
+                self.assertEqual(cursor.fetchone()[0], 1)
+            # Another thread has a cache object and connection of its own.
+            thread, result = self.run_in_thread(self.create, self.client)
+            thread.join()
+        self.assertEqual(result['value']['Idempotent-Replay'], 'true')
+        self.assertEqual(get_user_model().objects.filter(username='retried').count(), 1)
+
+    def test_wait(self):
+        request = RequestFactory().post('/scim/v2/Groups', '{"displayName": "g"}',
+                                        content_type='application/scim+json')
+        started, release = threading.Event(), threading.Event()
+
+        def first():
+            started.set()
+            release.wait(5)
+            return HttpResponse('{"id": "1"}', status=201)
+
+        def retry():
+            raise AssertionError('The retry ran while the first attempt was in progress')
+
+        first_thread, _ = self.run_in_thread(idempotency.replay_or_run, request, first, 'Group')
+        started.wait(5)
+        retry_thread, result = self.run_in_thread(idempotency.replay_or_run, request, retry, 'Group')
+        retry_thread.join(0.2)
+        self.assertTrue(retry_thread.is_alive())
+
+        release.set()
+        first_thread.join()
+        retry_thread.join(1)
+        self.assertFalse(retry_thread.is_alive())
+        self.assertEqual(result['value']['Idempotent-Replay'], 'true')
+
+
+class SortTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(20)
+
+    def names(self, path, params):
+        response = self.client.get(path, dict({'count': 100}, **params))
+        self.assertEqual(response.status_code, 200, response.content)
+        return [resource.get('userName', resource.get('displayName'))
+                for resource in json.loads(response.content.decode())['Resources']]
+
+    def test_sort(self):
+        usernames = sorted('user%d' % i for i in range(20))
+        self.assertEqual(self.names('/scim/v2/Users', {'sortBy': 'userName'}), usernames)
+        self.assertEqual(self.names('/scim/v2/Users', {'sortBy': 'USERNAME', 'sortOrder': 'Descending'}),
+                         usernames[::-1])
+        self.assertEqual(self.names('/scim/v2/Groups', {'sortBy': 'displayName', 'sortOrder': 'descending'}),
+                         ['group1', 'group0'])
+
+        response = self.client.post('/scim/v2/Users/.search?count=3', json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:SearchRequest'],
+            'filter': 'userName sw "user1"',
+            'sortBy': 'userName',
+            'sortOrder': 'descending',
+        }), content_type='application/scim+json')
+        self.assertEqual([resource['userName'] for resource in json.loads(response.content.decode())['Resources']],
+                         ['user19', 'user18', 'user17'])
+
+    def test_ties(self):
+        # Ties are broken on id, in the direction of the sort, so pages
+        # neither repeat nor skip users.
+        get_user_model().objects.update(last_name='Same')
+        by_id = self.names('/scim/v2/Users', {'sortBy': 'id'})
+        pages = [self.names('/scim/v2/Users', {'sortBy': 'name.familyName', 'startIndex': start, 'count': 7})
+                 for start in (1, 8, 15)]
+        self.assertEqual(sum(pages, []), by_id)
+        self.assertEqual(self.names('/scim/v2/Users', {'sortBy': 'name.familyName', 'sortOrder': 'descending'}),
+                         by_id[::-1])
+
+    def test_invalid(self):
+        for params in ({'sortBy': 'title'}, {'sortBy': 'userName', 'sortOrder': 'up'}):
+            response = self.client.get('/scim/v2/Users', params)
+            self.assertEqual(response.status_code, 400, response.content)
+
+
+class FilterTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(20)
+
+    def assertInvalid(self, path, filter):
+        response = self.client.get(path, {'filter': filter})
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertIn('Invalid filter/search query', json.loads(response.content.decode())['detail'])
+
+    def test_invalid_unique_values(self):
+        self.assertInvalid('/scim/v2/Users', 'id eq "abc"')
+        self.assertInvalid('/scim/v2/Users', 'userName eq 5')
+        self.assertInvalid('/scim/v2/Users', 'id eq 1 or id eq "x"')
+        self.assertInvalid('/scim/v2/Groups', 'id eq "x"')
+        self.assertInvalid('/scim/v2/Groups', 'displayName eq true')
+
+    def group_names(self, filter, search=False):
+        if search:
+            response = self.client.post('/scim/v2/Groups/.search', json.dumps({
+                'schemas': ['urn:ietf:params:scim:api:messages:2.0:SearchRequest'],
+                'filter': filter,
+            }), content_type='application/scim+json')
+        else:
+            response = self.client.get('/scim/v2/Groups', {'filter': filter})
+        self.assertEqual(response.status_code, 200, response.content)
+        doc = json.loads(response.content.decode())
+        names = [resource['displayName'] for resource in doc['Resources']]
+        self.assertEqual(doc['totalResults'], len(names))
+        return names
+
+    def test_groups(self):
+        group = Group.objects.get(name='group1')
+        model = get_user_model()
+        user5, user15 = model.objects.get(username='user5'), model.objects.get(username='user15')
+
+        self.assertEqual(self.group_names('displayName eq "group1"'), ['group1'])
+        self.assertEqual(self.group_names('displayName eq "nobody"'), [])
+        self.assertEqual(self.group_names('id eq %d' % group.id, search=True), ['group1'])
+        self.assertEqual(self.group_names('displayName sw "group"', search=True), ['group0', 'group1'])
+        self.assertEqual(self.group_names('not (displayName eq "group0")'), ['group1'])
+        self.assertEqual(self.group_names('members.value eq %d' % user5.id), ['group0'])
+        # Groups the filter matches through several members are listed once.
+        self.assertEqual(self.group_names('members.value eq {} or members.value eq {}'.format(user5.id, user15.id)),
+                         ['group0', 'group1'])
+        self.assertEqual(self.group_names('members.value eq {} and displayName eq "group1"'.format(user15.id),
+                                          search=True), ['group1'])
+
+    def test_long_or_chain(self):
+        # More values than SQLite's nominal limit of parameters.
+        ids = list(get_user_model().objects.order_by('id').values_list('id', flat=True)) + list(range(10 ** 6, 10 ** 6 + 1500))
+        response = self.client.post('/scim/v2/Users/.search?count=5', json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:SearchRequest'],
+            'filter': ' or '.join('id eq %d' % id_ for id_ in ids),
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+        doc = json.loads(response.content.decode())
+        self.assertEqual(doc['totalResults'], 20)
+        self.assertEqual([resource['id'] for resource in doc['Resources']], [str(id_) for id_ in ids[:5]])
+
+
+@override_settings(**dict(TEST_SETTINGS, SCIM_GROUP_COMMIT=True, SCIM_GROUP_COMMIT_DELAY=0.2))
+class GroupCommitTests(SCIMClientMixin, TransactionTestCase):
+    """The writer thread commits on a connection of its own."""
+
+    def create(self, username):
+        return self.client.post('/scim/v2/Users', json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': username,
+        }), content_type='application/scim+json')
+
+    def test_write(self):
+        response = self.create('committed')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(json.loads(response.content.decode())['userName'], 'committed')
+        self.assertTrue(get_user_model().objects.filter(username='committed').exists())
+
+        # A failing write is reported as it is without the writer.
+        response = self.create('committed')
+        self.assertEqual(response.status_code, 409, response.content)
+
+    def test_failed_write_rolled_back_alone(self):
+        def fail():
+            Group.objects.create(name='rolled back')
+            raise ValueError('failed')
+
+        futures = [writer.submit(lambda: Group.objects.create(name='committed')), writer.submit(fail)]
+        self.assertEqual(futures[0].result().name, 'committed')
+        with self.assertRaises(ValueError):
+            futures[1].result()
+        self.assertEqual(list(Group.objects.values_list('name', flat=True)), ['committed'])
+
+    def test_commit_fails(self):
+        with mock.patch.object(type(db.connections['default']), '_commit',
+                               side_effect=db.OperationalError('database is locked')), \
+                self.assertLogs('django_scim.writer', 'ERROR'):
+            response = self.create('uncommitted')
+        self.assertEqual(response.status_code, 503, response.content)
+        self.assertEqual(response['Content-Type'], 'application/scim+json')
+        self.assertIn('database is locked', json.loads(response.content.decode())['detail'])
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(get_user_model().objects.filter(username='uncommitted').exists())
+
+        # The writer carries on.
+        self.assertEqual(self.create('uncommitted').status_code, 201)
+
+    @override_settings(SCIM_TIMING_LOG=True)
+    def test_timed(self):
+        # The queries of the write, run on the writer's connection, are
+        # counted as the request's.
+        def queries(username):
+            with self.assertLogs('django_scim.timing', 'INFO') as logs:
+                self.assertEqual(self.create(username).status_code, 201)
+            return json.loads(logs.records[-1].getMessage())['queries']
+
+        with mock.patch.object(timing, 'bind', side_effect=lambda fn: fn):
+            unbound = queries('unbound')
+        self.assertGreater(queries('bound'), unbound)
+
+
+class GroupPatchTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(40)
+        self.group = Group.objects.get(name='group3')
+        self.members = set(self.group.user_set.values_list('id', flat=True))
+        self.outsider = get_user_model().objects.get(username='user0')
+
+    def patch(self, *operations, status=200):
+        response = self.client.patch('/scim/v2/Groups/%d' % self.group.id, json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+            'Operations': list(operations),
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, status, response.content)
+        return json.loads(response.content.decode())
+
+    def member_ids(self):
+        return set(self.group.user_set.values_list('id', flat=True))
+
+    def test_add_and_remove(self):
+        removed = min(self.members)
+        doc = self.patch(
+            {'op': 'add', 'path': 'members', 'value': [{'value': str(self.outsider.id)}]},
+            {'op': 'Remove', 'path': 'members', 'value': [{'value': str(removed)}]},
+        )
+        expected = self.members - {removed} | {self.outsider.id}
+        self.assertEqual(self.member_ids(), expected)
+        self.assertEqual({int(member['value']) for member in doc['members']}, expected)
+        self.assertEqual(set(Change.objects.filter(resource_type='User').values_list('resource_id', flat=True)),
+                         {str(self.outsider.id), str(removed)})
+
+    def test_rejected(self):
+        for operation in ({'op': 'replace', 'value': {'displayName': 'renamed'}},
+                          {'op': 'operations'},
+                          {'path': 'members'},
+                          'add',
+                          {'op': 'add', 'path': 'displayName', 'value': 'renamed'},
+                          {'op': 'add', 'path': 'members', 'value': [{'value': 'x'}]},
+                          {'op': 'add', 'path': 'members', 'value': [{'display': 'no id'}]},
+                          {'op': 'add', 'path': 'members', 'value': [{'value': '999999'}]}):
+            self.assertTrue(self.patch(operation, status=400)['detail'])
+        response = self.client.patch('/scim/v2/Groups/%d' % self.group.id, json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.member_ids(), self.members)
+        self.assertEqual(self.client.patch('/scim/v2/Users/%d' % self.outsider.id, '{}',
+                                           content_type='application/scim+json').status_code, 405)
+
+    def test_atomic(self):
+        # A failing operation undoes the ones before it.
+        self.patch({'op': 'add', 'path': 'members', 'value': [{'value': str(self.outsider.id)}]},
+                   {'op': 'replace', 'path': 'members', 'value': []}, status=400)
+        self.assertEqual(self.member_ids(), self.members)
+        self.assertFalse(Change.objects.exists())
+
+
+class ChangeLogTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(20)
+
+    def changes(self, params=None, status=200):
+        response = self.client.get('/scim/v2/Changes', params or {})
+        self.assertEqual(response.status_code, status)
+        if status != 200:
+            return json.loads(response.content.decode())
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def post(self, username):
+        return self.client.post('/scim/v2/Users', json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': username,
+        }), content_type='application/scim+json')
+
+    def create(self, username):
+        response = self.post(username)
+        self.assertEqual(response.status_code, 201, response.content)
+        return json.loads(response.content.decode())['id']
+
+    def test_order(self):
+        user_id = self.create('created')
+        group = Group.objects.get(name='group1')
+        members = sorted(group.user_set.values_list('id', flat=True))
+        self.assertEqual(self.client.delete('/scim/v2/Groups/%d' % group.id).status_code, 204)
+        changes = self.changes()
+        # The members of a deleted group lose it, which changes them too.
+        self.assertEqual([(change['resourceType'], change['id'], change['operation']) for change in changes],
+                         [('User', user_id, 'create')] +
+                         [('User', str(member), 'update') for member in members] +
+                         [('Group', str(group.id), 'delete')])
+        self.assertEqual(sorted(change['seq'] for change in changes), [change['seq'] for change in changes])
+
+    def test_paging(self):
+        for i in range(5):
+            self.create('paged%d' % i)
+        seqs = [change['seq'] for change in self.changes()]
+        self.assertEqual([change['seq'] for change in self.changes({'count': 2})], seqs[:2])
+        self.assertEqual([change['seq'] for change in self.changes({'since': seqs[1], 'count': 2})], seqs[2:4])
+        self.assertEqual([change['seq'] for change in self.changes({'since': seqs[3]})], seqs[4:])
+        self.assertEqual(self.changes({'since': seqs[4]}), [])
+        self.assertEqual(self.changes({'count': 0}), [])
+
+    def test_invalid_position(self):
+        for params in ({'since': 'x'}, {'count': '1.5'}, {'since': -1}, {'count': -1}):
+            self.assertIn('Invalid change log position', self.changes(params, status=400)['detail'])
+
+    def test_recorded_with_write(self):
+        # The change is recorded in the transaction of the write, so a write
+        # whose change can't be recorded is undone.
+        with mock.patch.object(Change.objects, 'create', side_effect=db.OperationalError('failed')):
+            response = self.post('unrecorded')
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(get_user_model().objects.filter(username='unrecorded').exists())
+        self.assertEqual(self.changes(), [])
+
+
+class AdmissionTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Buckets and write slots of a controller of these tests' own.
+        patcher = mock.patch('django_scim.views.admission', AdmissionController())
+        self.admission = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, username):
+        return self.client.post('/scim/v2/Users', json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': username,
+        }), content_type='application/scim+json')
+
+    def assertTooManyRequests(self, response, retry_after, detail):
+        self.assertEqual(response.status_code, 429, response.content)
+        self.assertEqual(response['Retry-After'], retry_after)
+        self.assertEqual(json.loads(response.content.decode())['detail'], detail)
+
+    @override_settings(SCIM_RATE_LIMIT=0.5, SCIM_RATE_BURST=2)
+    def test_rate_limit(self):
+        for _ in range(2):
+            self.assertEqual(self.client.get('/scim/v2/Users').status_code, 200)
+        self.assertTooManyRequests(self.client.get('/scim/v2/Users'), '2', 'Rate limit exceeded')
+        # Unauthenticated requests aren't charged to the key.
+        self.assertEqual(Client(HTTP_AUTHORIZATION='Bearer other').get('/scim/v2/Users').status_code, 401)
+
+    @override_settings(SCIM_WRITE_CONCURRENCY=1, SCIM_WRITE_QUEUE=0)
+    def test_write_slots(self):
+        with self.admission.write_slot('users'):
+            self.assertTooManyRequests(self.create('queued'), '1', 'Too many concurrent writes')
+            # Reads and writes to other routes are admitted.
+            self.assertEqual(self.client.get('/scim/v2/Users').status_code, 200)
+            self.assertEqual(self.client.post('/scim/v2/Groups', json.dumps({'displayName': 'other'}),
+                                              content_type='application/scim+json').status_code, 201)
+        self.assertEqual(self.create('queued').status_code, 201)
+
+    @override_settings(SCIM_WRITE_CONCURRENCY=1, SCIM_WRITE_QUEUE=1, SCIM_WRITE_QUEUE_TIMEOUT=0.1)
+    def test_write_queue_timeout(self):
+        with self.admission.write_slot('users'):
+            self.assertTooManyRequests(self.create('queued'), '1', 'Timed out waiting to write')
+        self.assertFalse(get_user_model().objects.filter(username='queued').exists())
+
+
+class CompressionTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(40)
+        self.plain = self.client.get('/scim/v2/Users', {'count': 40}).content
+
+    def get(self, accept_encoding, path='/scim/v2/Users', params=None):
+        response = self.client.get(path, params or {'count': 40}, HTTP_ACCEPT_ENCODING=accept_encoding)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        return response
+
+    def test_gzip(self):
+        response = self.get('gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(gzip.decompress(response.content), self.plain)
+
+    @skipIf(compression.get_brotli() is None, 'brotli is not installed')
+    def test_brotli(self):
+        response = self.get('gzip;q=0.5, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(compression.get_brotli().decompress(response.content), self.plain)
+
+    def test_negotiation(self):
+        def encoding(accept_encoding):
+            return self.get(accept_encoding).get('Content-Encoding')
+
+        self.assertEqual(encoding('br;q=0, gzip'), 'gzip')
+        self.assertEqual(encoding('GZIP;q=0.8, br;q=0.9'), 'br' if compression.get_brotli() else 'gzip')
+        self.assertEqual(encoding('*;q=0.1, br;q=0'), 'gzip')
+        self.assertIsNone(encoding('identity'))
+        self.assertIsNone(encoding('gzip;q=0'))
+        self.assertIsNone(encoding(''))
+        with mock.patch('django_scim.compression.get_brotli', return_value=None):
+            self.assertIsNone(encoding('br'))
+            self.assertEqual(encoding('br, gzip;q=0.1'), 'gzip')
+
+    def test_not_compressed(self):
+        # Small responses and errors are sent as they are.
+        user = get_user_model().objects.get(username='user1')
+        self.assertFalse(self.get('gzip', '/scim/v2/Users/%d' % user.id, {}).has_header('Content-Encoding'))
+        self.assertFalse(self.get('gzip', '/scim/v2/Users/0', {}).has_header('Content-Encoding'))
+        with override_settings(SCIM_COMPRESSION_MIN_SIZE=10 ** 6):
+            self.assertFalse(self.get('gzip').has_header('Content-Encoding'))
+
+    def test_streaming(self):
+        for name in ('streamed0', 'streamed1'):
+            self.client.post('/scim/v2/Groups', json.dumps({'displayName': name}),
+                             content_type='application/scim+json')
+        response = self.get('gzip', '/scim/v2/Changes', {})
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertFalse(response.has_header('Content-Length'))
+        lines = gzip.decompress(b''.join(response.streaming_content)).decode().splitlines()
+        self.assertEqual([json.loads(line)['operation'] for line in lines], ['create', 'create'])
+
+
+class MembershipIndexTests(SCIMTestCase):
+    """The index brought up to date from the change log after SCIM writes."""
+
+    def setUp(self):
+        super().setUp()
+        make_directory(30)
+        self.index = membership.MembershipIndex()
+        self.index.build()
+        self.user = get_user_model().objects.get(username='user5')
+        self.group = Group.objects.get(name='group1')
+
+    def snapshot(self, index):
+        return ({key: list(ids) for key, ids in index.user_groups.items()},
+                {key: list(ids) for key, ids in index.group_members.items()},
+                index.group_names, index.usernames)
+
+    def assertRefreshed(self):
+        """Assert that a refresh brings the index to the state of a rebuild."""
+        self.index.refresh()
+        self.assertEqual(self.index.seq, Change.objects.last_seq())
+        rebuilt = membership.MembershipIndex()
+        rebuilt.build()
+        self.assertEqual(self.snapshot(self.index), self.snapshot(rebuilt))
+
+    def patch(self, op, user):
+        response = self.client.patch('/scim/v2/Groups/%d' % self.group.id, json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+            'Operations': [{'op': op, 'path': 'members', 'value': [{'value': str(user.id)}]}],
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_add_and_remove(self):
+        self.assertNotIn(self.group.id, self.index.user_groups[self.user.id])
+        self.patch('add', self.user)
+        self.assertRefreshed()
+        self.assertIn({'value': str(self.group.id), 'display': 'group1'}, self.index.groups_of(self.user.id))
+
+        member = self.group.user_set.order_by('id').last()
+        self.patch('remove', member)
+        self.patch('remove', self.user)
+        self.assertRefreshed()
+        self.assertNotIn(str(member.id), [m['value'] for m in self.index.members_of(self.group.id)])
+        self.assertNotIn(self.group.id, self.index.user_groups[self.user.id])
+
+    def test_delete(self):
+        group = Group.objects.get(name='group0')
+        self.assertIn(group.id, self.index.user_groups[self.user.id])
+        # Users are deleted by the purge of deactivated users.
+        get_user_model().objects.filter(id=self.user.id).update(is_active=False)
+        Profile.objects.filter(user=self.user).update(deactivated_at=timezone.now() - timedelta(days=2))
+        call_command('scimpurge', retention=1, stdout=StringIO())
+        self.assertRefreshed()
+        self.assertNotIn(self.user.id, self.index.usernames)
+        self.assertNotIn(self.user.id, self.index.user_groups)
+        self.assertNotIn(self.user.id, self.index.group_members[group.id])
+
+        self.assertEqual(self.client.delete('/scim/v2/Groups/%d' % group.id).status_code, 204)
+        self.assertRefreshed()
+        self.assertNotIn(group.id, self.index.group_names)
+        self.assertNotIn(group.id, self.index.group_members)
+        self.assertFalse(any(group.id in group_ids for group_ids in self.index.user_groups.values()))
+
+    def test_only_changes_reloaded(self):
+        with CaptureQueriesContext(connection) as captured:
+            self.index.refresh()
+        self.assertEqual(len(captured), 1)
+
+        self.patch('add', self.user)
+        with CaptureQueriesContext(connection) as captured:
+            self.index.refresh()
+        # The change log, then the user's username and groups, then the
+        # group's name and members.
+        self.assertEqual(len(captured), 5)
+
+
+@override_settings(SCIM_LOOKUP_CACHE_TTL=30)
+class LookupCacheTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        lookups.invalidate()
+        self.addCleanup(lookups.invalidate)
+        make_directory(20)
+
+    def lookup(self, path, filter):
+        """
+        Return the ids the filter matches and whether they were read from the
+        database rather than the cache.
+        """
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get(path, {'filter': filter})
+        self.assertEqual(response.status_code, 200, response.content)
+        table = 'auth_user' if 'Users' in path else 'auth_group'
+        read = any('FROM "{}"'.format(table) in query['sql'] for query in captured.captured_queries)
+        return [resource['id'] for resource in json.loads(response.content.decode())['Resources']], read
+
+    def test_hit(self):
+        user = get_user_model().objects.get(username='user3')
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "user3"'), ([str(user.id)], True))
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "user3"'), ([str(user.id)], False))
+        # Other values and attributes are looked up separately.
+        self.assertEqual(self.lookup('/scim/v2/Users', 'id eq %d' % user.id), ([str(user.id)], True))
+        with override_settings(SCIM_LOOKUP_CACHE_TTL=0):
+            self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "user3"'), ([str(user.id)], True))
+
+    def test_miss(self):
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "new"'), ([], True))
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "new"'), ([], False))
+
+        response = self.client.post('/scim/v2/Users', json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': 'new',
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "new"'),
+                         ([json.loads(response.content.decode())['id']], True))
+
+    def test_invalidated_by_writes(self):
+        user = get_user_model().objects.get(username='user3')
+        self.lookup('/scim/v2/Users', 'userName eq "user3"')
+        response = self.client.put('/scim/v2/Users/%d' % user.id, json.dumps({
+            'schemas': ['urn:scim:schemas:core:1.0'],
+            'userName': 'renamed',
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "user3"'), ([], True))
+        self.assertEqual(self.lookup('/scim/v2/Users', 'userName eq "renamed"'), ([str(user.id)], True))
+
+        group = Group.objects.get(name='group1')
+        self.assertEqual(self.lookup('/scim/v2/Groups', 'displayName eq "group1"'), ([str(group.id)], True))
+        self.assertEqual(self.client.delete('/scim/v2/Groups/%d' % group.id).status_code, 204)
+        self.assertEqual(self.lookup('/scim/v2/Groups', 'displayName eq "group1"'), ([], True))
+
+    def test_sort_checked(self):
+        # The lookup needs no sorting, but invalid sort parameters are still
+        # rejected.
+        for params in ({'sortBy': 'title'}, {'sortBy': 'userName', 'sortOrder': 'up'}):
+            response = self.client.get('/scim/v2/Users', dict(params, filter='userName eq "user3"'))
+            self.assertEqual(response.status_code, 400, response.content)
+        response = self.client.get('/scim/v2/Users', {'filter': 'userName eq "user3"', 'sortBy': 'userName'})
+        self.assertEqual(json.loads(response.content.decode())['totalResults'], 1)
+
+
+class TimingTests(SCIMTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_directory(20)
+
+    def metrics(self, response):
+        """Return the Server-Timing metrics of ``response`` by name."""
+        metrics = {}
+        for metric in response['Server-Timing'].split(', '):
+            name, *params = metric.split(';')
+            metrics[name] = dict(param.split('=', 1) for param in params)
+        return metrics
+
+    def test_off(self):
+        self.assertFalse(self.client.get('/scim/v2/Users').has_header('Server-Timing'))
+
+    @override_settings(SCIM_SERVER_TIMING=True)
+    def test_header(self):
+        with CaptureQueriesContext(connection) as captured:
+            response = self.client.get('/scim/v2/Users', {'count': PAGE}, HTTP_ACCEPT_ENCODING='gzip')
+        metrics = self.metrics(response)
+        self.assertEqual(list(metrics)[-1], 'total')
+        self.assertTrue({'auth', 'log', 'serialize', 'encode', 'compress', 'db'} <= set(metrics))
+        self.assertEqual(metrics['db']['desc'], '"%d queries"' % len(captured))
+        self.assertLessEqual(float(metrics['serialize']['dur']), float(metrics['total']['dur']))
+
+    @override_settings(SCIM_SERVER_TIMING=True, SCIM_RATE_LIMIT=1, SCIM_RATE_BURST=1)
+    def test_refused(self):
+        with mock.patch('django_scim.views.admission', AdmissionController()):
+            self.assertFalse(Client().get('/scim/v2/Users').has_header('Server-Timing'))
+            self.assertTrue(self.client.get('/scim/v2/Users').has_header('Server-Timing'))
+            response = self.client.get('/scim/v2/Users')
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(SCIM_TIMING_LOG=True)
+    def test_log(self):
+        user = get_user_model().objects.get(username='user3')
+        with self.assertLogs('django_scim.timing', 'INFO') as logs:
+            response = self.client.get('/scim/v2/Users/%d' % user.id)
+        self.assertFalse(response.has_header('Server-Timing'))
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual({key: entry[key] for key in ('method', 'path', 'status')},
+                         {'method': 'GET', 'path': '/scim/v2/Users/%d' % user.id, 'status': 200})
+        self.assertGreater(entry['queries'], 0)
+        self.assertTrue({'auth', 'serialize', 'db', 'total'} <= set(entry['timings']))
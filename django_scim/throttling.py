@@ -0,0 +1,120 @@
+"""
+Admission control for SCIM traffic.
+
+Okta pushes arrive in bursts, and every write ends up waiting on the single
+SQLite writer. Rather than letting such requests queue up until the database
+times out, requests are admitted in two steps:
+
+* each API key has a token bucket refilled at ``SCIM_RATE_LIMIT`` requests
+  per second, holding at most ``SCIM_RATE_BURST`` tokens;
+* each write route runs at most ``SCIM_WRITE_CONCURRENCY`` writes at once,
+  with at most ``SCIM_WRITE_QUEUE`` more waiting for up to
+  ``SCIM_WRITE_QUEUE_TIMEOUT`` seconds.
+
+Requests that are not admitted get a ``429`` with a ``Retry-After`` header.
+Limits are per process; a setting of 0 disables the corresponding check.
+"""
+import hashlib
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from .exceptions import TooManyRequestsError
+from .utils import get_setting
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token. Return 0 if one was available, or else the number of
+        seconds until one will be.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class WriteSlots(object):
+    def __init__(self, concurrency):
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+
+class AdmissionController(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.slots = {}
+
+    def admit(self, token):
+        """
+        Charge one request to the bucket of ``token``, raising
+        ``TooManyRequestsError`` when it is empty.
+        """
+        rate = get_setting('SCIM_RATE_LIMIT', 0)
+        if not rate:
+            return
+
+        key = hashlib.sha256(token.encode('utf-8')).hexdigest()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.rate != rate:
+                burst = max(get_setting('SCIM_RATE_BURST', rate), 1)
+                bucket = self.buckets[key] = TokenBucket(rate, burst)
+
+        wait = bucket.take()
+        if wait:
+            raise TooManyRequestsError('Rate limit exceeded', retry_after=math.ceil(wait))
+
+    @contextmanager
+    def write_slot(self, route):
+        """
+        Hold one of the concurrent write slots of ``route`` for the duration
+        of the ``with`` block, waiting in a bounded queue for one to free up.
+        """
+        concurrency = get_setting('SCIM_WRITE_CONCURRENCY', 0)
+        if not concurrency:
+            yield
+            return
+
+        with self.lock:
+            slots = self.slots.get(route)
+            if slots is None:
+                slots = self.slots[route] = WriteSlots(concurrency)
+
+        timeout = get_setting('SCIM_WRITE_QUEUE_TIMEOUT', 10)
+        if not slots.semaphore.acquire(blocking=False):
+            with slots.lock:
+                if slots.waiting >= get_setting('SCIM_WRITE_QUEUE', 0):
+                    raise TooManyRequestsError('Too many concurrent writes', retry_after=1)
+                slots.waiting += 1
+            try:
+                acquired = slots.semaphore.acquire(timeout=timeout)
+            finally:
+                with slots.lock:
+                    slots.waiting -= 1
+            if not acquired:
+                raise TooManyRequestsError('Timed out waiting to write',
+                                           retry_after=max(math.ceil(timeout), 1))
+
+        try:
+            yield
+        finally:
+            slots.semaphore.release()
+
+
+controller = AdmissionController()
@@ -0,0 +1,140 @@
+"""
+Per-request timing of SCIM calls, reported in a ``Server-Timing`` header.
+
+The phases of a request are timed with a monotonic clock as it is handled:
+
+* ``auth``: checking the API key and admission control;
+* ``log``: decoding and logging the request body;
+* ``filter``: compiling a filter into a query;
+* ``serialize``: building the SCIM representation of the resources;
+* ``encode``: encoding the response as JSON;
+* ``compress``: compressing the response;
+* ``db``: executing SQL on the request's database connection, which
+  overlaps with the phases above, with the number of queries;
+* ``total``: the whole request.
+
+Eg. ``Server-Timing: auth;dur=0.05, filter;dur=0.21, db;dur=1.80;desc="3
+queries", serialize;dur=2.34, encode;dur=0.12, total;dur=3.10``.
+
+Queries a write runs on the group commit writer's connection (see
+``writer``) are counted in ``db``; the commit of the writer's batch, shared
+by several requests, is not, and only shows in ``total``. Neither are the
+queries of the root search's worker threads, which show in ``serialize``.
+
+Timing starts once a request is authenticated and admitted, so responses
+refusing a request (401, or 429 from the rate limit) carry no timings.
+``SCIM_SERVER_TIMING`` turns the header on; with ``SCIM_TIMING_LOG``, the
+same figures are logged as JSON to the ``django_scim.timing`` logger.
+"""
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+from .utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Timer(object):
+    def __init__(self, started=None):
+        self.started = time.monotonic() if started is None else started
+        self.phases = {}
+        self.db_time = 0.0
+        self.queries = 0
+
+    def add(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        """A ``connection.execute_wrapper`` that times every query."""
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.monotonic() - started
+            self.queries += 1
+
+    def metrics(self):
+        """Return ``(name, milliseconds, description)`` for each measurement."""
+        metrics = [(name, elapsed * 1000, None) for name, elapsed in self.phases.items()]
+        if self.queries:
+            metrics.append(('db', self.db_time * 1000, '%d quer%s' % (
+                self.queries, 'y' if self.queries == 1 else 'ies')))
+        metrics.append(('total', (time.monotonic() - self.started) * 1000, None))
+        return metrics
+
+
+def enabled():
+    return get_setting('SCIM_SERVER_TIMING', False) or get_setting('SCIM_TIMING_LOG', False)
+
+
+def start(started=None):
+    """
+    Start timing the current request, from the ``time.monotonic()`` value
+    ``started`` if given, and return its ``Timer``.
+    """
+    timer = _local.timer = Timer(started)
+    return timer
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+def bind(fn):
+    """
+    Return ``fn`` wrapped to count the queries it runs, on the connection of
+    whichever thread calls it, as those of the current request. The request
+    must not run queries of its own meanwhile.
+    """
+    timer = current()
+    if timer is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        with connection.execute_wrapper(timer.db_wrapper):
+            return fn(*args, **kwargs)
+    return bound
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to phase ``name`` of the request."""
+    timer = current()
+    if timer is None:
+        yield
+        return
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        timer.add(name, time.monotonic() - started)
+
+
+def finish(request, response):
+    """Report the current request's timings on ``response`` and stop timing."""
+    timer = current()
+    _local.timer = None
+    if timer is None:
+        return response
+
+    metrics = timer.metrics()
+    if get_setting('SCIM_SERVER_TIMING', False):
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.2f}'.format(name, ms) + (';desc="{}"'.format(desc) if desc else '')
+            for name, ms, desc in metrics)
+    if get_setting('SCIM_TIMING_LOG', False):
+        logger.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': timer.queries,
+            'timings': {name: round(ms, 3) for name, ms, _ in metrics},
+        }))
+    return response
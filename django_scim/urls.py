@@ -4,7 +4,9 @@ except ImportError:
     from django.conf.urls import url as re_path
 
 from .simple_filter import SCIMSimpleUserFilterTransformer
+from .simple_filter import SCIMSimpleGroupFilterTransformer
 from .adapters import SCIMUser
+from .adapters import SCIMGroup
 from . import views
 
 
@@ -17,11 +19,11 @@ urlpatterns = [
         name='root'),
 
     re_path(r'^.search$',
-        views.SearchView.as_view(implemented=False),
+        views.RootSearchView.as_view(),
         name='search'),
 
     re_path(r'^Users/.search$',
-        views.SearchView.as_view(scim_adapter=SCIMUser(None), parser=SCIMSimpleUserFilterTransformer),
+        views.SearchView.as_view(scim_adapter=SCIMUser, parser=SCIMSimpleUserFilterTransformer),
         name='users-search'),
 
     re_path(r'^Users(?:/(?P<uuid>[^/]+))?$',
@@ -29,7 +31,7 @@ urlpatterns = [
         name='users'),
 
     re_path(r'^Groups/.search$',
-        views.SearchView.as_view(implemented=False),
+        views.SearchView.as_view(scim_adapter=SCIMGroup, parser=SCIMSimpleGroupFilterTransformer),
         name='groups-search'),
 
     re_path(r'^Groups(?:/(?P<uuid>[^/]+))?$',
@@ -40,6 +42,10 @@ urlpatterns = [
         views.SCIMView.as_view(implemented=False),
         name='me'),
 
+    re_path(r'^Changes$',
+        views.ChangesView.as_view(),
+        name='changes'),
+
     re_path(r'^ServiceProviderConfig$',
         views.ServiceProviderConfigView.as_view(),
         name='service-provider-config'),
@@ -1,5 +1,12 @@
 import json
 
+from django.conf import settings
+
+
+def get_setting(name, default=None):
+    return getattr(settings, name, default)
+
+
 def clean_structure_of_passwords(obj):
     if isinstance(obj, dict):
         new_obj = {}
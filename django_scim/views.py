@@ -1,5 +1,7 @@
 import json
 import logging
+import time
+from functools import lru_cache
 from urllib.parse import urljoin
 import os
 
@@ -8,14 +10,23 @@ from django.core.exceptions import ObjectDoesNotExist
 from django import db
 from django.db import transaction
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
-from django.utils import six
 from django.utils.decorators import method_decorator
 from django.urls import reverse
 
 from . import constants
+from . import compression
+from . import dbjson
+from . import idempotency
+from . import lookups
+from . import membership
+from . import timing
+from .throttling import controller as admission
+from .writer import writer
 from .simple_filter import SCIMSimpleUserFilterTransformer
+from .simple_filter import SCIMSimpleGroupFilterTransformer
 from .exceptions import SCIMException
 from .exceptions import NotFoundError
 from .exceptions import BadRequestError
@@ -28,6 +39,7 @@ from django.contrib.auth import get_user_model
 
 from .adapters import SCIMUser
 from .adapters import SCIMGroup
+from .models import Change
 from .models import SCIMServiceProviderConfig
 
 logger = logging.getLogger(__name__)
@@ -59,6 +71,33 @@ class SCIMView(View):
 
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
+        started = time.monotonic()
+        response = self.refuse(request, *args, **kwargs)
+        if response is not None:
+            # Timings aren't disclosed to unauthenticated or throttled clients.
+            return compression.compress_response(request, response)
+
+        if not timing.enabled():
+            response = self.handle_admitted(request, *args, **kwargs)
+            return compression.compress_response(request, response)
+
+        timer = timing.start(started)
+        timer.add('auth', time.monotonic() - started)
+        try:
+            with db.connection.execute_wrapper(timer.db_wrapper):
+                response = self.handle_admitted(request, *args, **kwargs)
+                with timing.phase('compress'):
+                    response = compression.compress_response(request, response)
+        except BaseException:
+            timing.finish(request, HttpResponse(status=500))
+            raise
+        return timing.finish(request, response)
+
+    def refuse(self, request, *args, **kwargs):
+        """
+        Return the response refusing ``request`` when it is not implemented,
+        not authenticated or over the rate limit, or ``None`` to handle it.
+        """
         if not self.implemented:
             return self.status_501(request, *args, **kwargs)
 
@@ -66,39 +105,90 @@ class SCIMView(View):
             return self.status_401(request)
 
         try:
+            admission.admit(request.META['HTTP_AUTHORIZATION'])
+        except SCIMException as e:
+            return self.error_response(e)
+
+    def handle_admitted(self, request, *args, **kwargs):
+        def handler():
+            if request.method not in constants.WRITE_METHODS:
+                return self.handle_request(request, *args, **kwargs)
+
             try:
-                body = get_loggable_body(request.body.decode(constants.ENCODING))
-                logger.debug(
-                    u'REQUEST '
-                    u'PATH >>>>>{}<<<<< '
-                    u'METHOD >>>>>{}<<<<< '
-                    u'BODY >>>>>{}<<<<<'.format(
-                        request.path,
-                        request.method,
-                        body,
+                with admission.write_slot(request.resolver_match.url_name):
+                    return self.handle_request(request, *args, **kwargs)
+            except SCIMException as e:
+                return self.error_response(e)
+
+        if not idempotency.applies(request):
+            return handler()
+
+        scim_adapter = getattr(self, 'scim_adapter', None)
+        try:
+            return idempotency.replay_or_run(
+                request, handler,
+                resource_type=getattr(scim_adapter, 'resource_type', None),
+                resource_id=kwargs.get(self.lookup_url_kwarg),
+            )
+        except SCIMException as e:
+            return self.error_response(e)
+
+    def handle_request(self, request, *args, **kwargs):
+        # Pick up memberships changed by other processes.
+        membership.expire()
+        try:
+            with timing.phase('log'):
+                try:
+                    body = get_loggable_body(request.body.decode(constants.ENCODING))
+                    logger.debug(
+                        u'REQUEST '
+                        u'PATH >>>>>{}<<<<< '
+                        u'METHOD >>>>>{}<<<<< '
+                        u'BODY >>>>>{}<<<<<'.format(
+                            request.path,
+                            request.method,
+                            body,
+                        )
+                    )
+                except:
+                    logger.debug(
+                        u'REQUEST '
+                        u'PATH >>>>>{}<<<<< '
+                        u'METHOD >>>>>{}<<<<< '
+                        u'ERROR >>>>>Could not get loggable body<<<<<'.format(
+                            request.path,
+                            request.method,
+                        ),
+                        exc_info=1,
                     )
-                )
-            except:
-                logger.debug(
-                    u'REQUEST '
-                    u'PATH >>>>>{}<<<<< '
-                    u'METHOD >>>>>{}<<<<< '
-                    u'ERROR >>>>>Could not get loggable body<<<<<'.format(
-                        request.path,
-                        request.method,
-                    ),
-                    exc_info=1,
-                )
             return super(SCIMView, self).dispatch(request, *args, **kwargs)
         except Exception as e:
             logger.debug('Unable to complete SCIM call.', exc_info=1)
             if not isinstance(e, SCIMException):
-                e = SCIMException(six.text_type(e))
+                e = SCIMException(str(e))
+
+            return self.error_response(e)
 
-            content = json.dumps(e.to_dict())
-            return HttpResponse(content=content,
+    def write(self, mutation):
+        """
+        Run ``mutation()``, the database changes of a write request, in a
+        transaction and return its result. With group commit, the writer
+        runs it in a savepoint of its batch; the response is then built
+        once the batch has committed.
+        """
+        if writer.enabled:
+            return writer.run(mutation)
+        with transaction.atomic():
+            return mutation()
+
+    def error_response(self, e):
+        content = json.dumps(e.to_dict())
+        response = HttpResponse(content=content,
                                 content_type=constants.SCIM_CONTENT_TYPE,
                                 status=e.status)
+        if getattr(e, 'retry_after', None):
+            response['Retry-After'] = str(e.retry_after)
+        return response
 
     def status_501(self, request, *args, **kwargs):
         """
@@ -143,33 +233,110 @@ class FilterMixin(object):
         except ValueError as e:
             raise BadRequestError('Invalid pagination values: ' + str(e))
 
-    def _search(self, request, query, start, count):
+    def _sort_params(self, *sources):
+        sort_by = sort_order = None
+        for source in sources:
+            sort_by = sort_by or source.get('sortBy')
+            sort_order = sort_order or source.get('sortOrder')
+
+        return sort_by, sort_order
+
+    def _ordering(self, sort_by=None, sort_order=None):
+        """
+        Return the fields to order by the SCIM attribute ``sort_by``, or
+        ``None`` to keep the default order. Only attributes listed in the
+        adapter's ``sort_fields`` are accepted, as those are backed by an
+        index; sorting by anything else would need a full table sort.
+        """
+        if not sort_by:
+            return None
+
+        field = self.scim_adapter.sort_fields.get(sort_by.lower())
+        if field is None:
+            raise BadRequestError('Sorting by {} is not supported'.format(sort_by))
+
+        sort_order = (sort_order or 'ascending').lower()
+        if sort_order not in ('ascending', 'descending'):
+            raise BadRequestError('Invalid sortOrder (must be ascending or descending)')
+
+        prefix = '-' if sort_order == 'descending' else ''
+        # Break ties on id so that paging through the results is stable.
+        return prefix + field, prefix + 'id'
+
+    def _sort(self, qs, sort_by=None, sort_order=None):
+        """Order ``qs`` by the SCIM attribute ``sort_by``."""
+        ordering = self._ordering(sort_by, sort_order)
+        return qs.order_by(*ordering) if ordering else qs
+
+    def _search(self, request, query, start, count, sort=(None, None)):
+        # Sort parameters are checked even when the filter is answered by a
+        # lookup, which matches one resource at most and needs no sorting.
+        ordering = self._ordering(*sort)
+
+        exact = self.parser.exact_lookup(query)
+        if exact is not None:
+            return self._exact_lookup_response(request, exact, start, count)
+
         try:
-            qs = self.parser.search(query)
+            with timing.phase('filter'):
+                qs = self.parser.search(query)
         except ValueError as e:
             raise BadRequestError('Invalid filter/search query: ' + str(e))
 
+        if ordering:
+            qs = qs.order_by(*ordering)
         return self._build_response(request, qs, start, count)
 
+    def _exact_lookup_response(self, request, exact, start, count):
+        """
+        Answer a filter matching at most one resource, typically Okta's
+        ``userName eq "..."`` existence check, from an indexed lookup.
+        """
+        field, value = exact
+        with timing.phase('serialize'):
+            resource = lookups.lookup(
+                self.parser.get_model(), field, value,
+                lambda obj: self.scim_adapter(obj, request=request).to_dict())
+        resources = [resource] if resource is not None else []
+        return self._list_response(resources[start - 1:start - 1 + count],
+                                   len(resources), start, count)
+
     def _build_response(self, request, qs, start, count):
         try:
-            total_count = sum(1 for _ in qs)
-            qs = qs[start-1:(start-1) + count]
-            resources = [self.scim_adapter(o, request=request).to_dict() for o in qs]
-            doc = {
-                'schemas': [constants.SchemaURI.LIST_RESPONSE],
-                'totalResults': total_count,
-                'itemsPerPage': count,
-                'startIndex': start,
-                'Resources': resources,
-            }
+            total_count = qs.count()
+            documents = dbjson.documents(self.scim_adapter, qs)
+            with timing.phase('serialize'):
+                if documents is not None:
+                    resources = list(documents[start-1:(start-1) + count])
+                else:
+                    qs = self.scim_adapter.load_related(qs)[start-1:(start-1) + count]
+                    resources = [self.scim_adapter(o, request=request).to_dict() for o in qs]
         except ValueError as e:
-            raise BadRequestError(six.text_type(e))
+            raise BadRequestError(str(e))
         else:
-            content = json.dumps(doc)
-            print(content)
-            return HttpResponse(content=content,
-                                content_type=constants.SCIM_CONTENT_TYPE)
+            return self._list_response(resources, total_count, start, count,
+                                       encoded=documents is not None)
+
+    def _list_response(self, resources, total_count, start, count, encoded=False):
+        """
+        Return a ``ListResponse`` of ``resources``, which are already
+        encoded as JSON if ``encoded`` is set.
+        """
+        doc = {
+            'schemas': [constants.SchemaURI.LIST_RESPONSE],
+            'totalResults': total_count,
+            'itemsPerPage': count,
+            'startIndex': start,
+        }
+        with timing.phase('encode'):
+            if encoded:
+                content = json.dumps(doc)[:-1] + ', "Resources": [' + ', '.join(resources) + ']}'
+            else:
+                doc['Resources'] = resources
+                content = json.dumps(doc)
+        logger.debug(u"RESPONSE >>>>>%s<<<<<", content)
+        return HttpResponse(content=content,
+                            content_type=constants.SCIM_CONTENT_TYPE)
 
 class SearchView(FilterMixin, SCIMView):
     http_method_names = ['post']
@@ -186,12 +353,93 @@ class SearchView(FilterMixin, SCIMView):
         if not query:
             raise BadRequestError('No filter query specified')
         else:
-            response = self._search(request, query, *self._page(request))
-            path = reverse(self.scim_adapter.url_name)
-            url = urljoin("https://localhost", path).rstrip('/')
-            response['Location'] = url + '/.search'
+            sort = self._sort_params(body, request.GET)
+            response = self._search(request, query, *self._page(request), sort=sort)
+            response['Location'] = self.get_location()
             return response
 
+    def get_location(self):
+        path = reverse(self.scim_adapter.url_name)
+        url = urljoin("https://localhost", path).rstrip('/')
+        return url + '/.search'
+
+
+@lru_cache(maxsize=None)
+def get_search_executor():
+    # Created on first use; most processes never serve a root search.
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix='scim-search')
+
+
+class RootSearchView(SearchView):
+    """
+    Searches all resource types at once. The filter is run against each
+    type in ``resources`` concurrently, and the matches are paged through as
+    if they were one list of all users followed by all groups.
+
+    A resource type that does not support an attribute used in the filter
+    simply contributes no results.
+    """
+    resources = (
+        (SCIMUser, SCIMSimpleUserFilterTransformer),
+        (SCIMGroup, SCIMSimpleGroupFilterTransformer),
+    )
+
+    def _search(self, request, query, start, count, sort=(None, None)):
+        if sort[0]:
+            raise BadRequestError('sortBy is not supported when searching all resource types')
+
+        searches = []
+        errors = []
+        for adapter, parser in self.resources:
+            try:
+                with timing.phase('filter'):
+                    searches.append((adapter, parser.search(query)))
+            except ValueError as e:
+                errors.append(e)
+
+        if not searches:
+            raise BadRequestError('Invalid filter/search query: ' + str(errors[0]))
+
+        executor = get_search_executor()
+        totals = list(executor.map(self._count, [qs for _, qs in searches]))
+
+        pages = []
+        offset = start - 1
+        remaining = count
+        for (adapter, qs), total in zip(searches, totals):
+            if remaining <= 0:
+                break
+            if offset >= total:
+                offset -= total
+                continue
+            pages.append((adapter, adapter.load_related(qs)[offset:offset + remaining]))
+            remaining -= min(total - offset, remaining)
+            offset = 0
+
+        with timing.phase('serialize'):
+            serialized = executor.map(self._serialize, [request] * len(pages), *zip(*pages))
+            resources = [resource for page in serialized for resource in page]
+        return self._list_response(resources, sum(totals), start, count)
+
+    @staticmethod
+    def _count(qs):
+        try:
+            return qs.count()
+        finally:
+            # Worker threads hold their own connection; don't leak it.
+            db.connection.close()
+
+    @staticmethod
+    def _serialize(request, adapter, qs):
+        try:
+            return [adapter(o, request=request).to_dict() for o in qs]
+        finally:
+            db.connection.close()
+
+    def get_location(self):
+        return urljoin(BASE_PATH, reverse('scim:search'))
+
 
 class GetView(object):
     def get(self, request, *args, **kwargs):
@@ -203,7 +451,10 @@ class GetView(object):
     def get_single(self, request):
         obj = self.get_object()
         scim_obj = self.scim_adapter(obj, request=request)
-        content = json.dumps(scim_obj.to_dict())
+        with timing.phase('serialize'):
+            doc = scim_obj.to_dict()
+        with timing.phase('encode'):
+            content = json.dumps(doc)
         response = HttpResponse(content=content,
                                 content_type=constants.SCIM_CONTENT_TYPE)
         response['Location'] = scim_obj.location
@@ -211,10 +462,12 @@ class GetView(object):
 
     def get_many(self, request):
         query = request.GET.get('filter')
+        sort = self._sort_params(request.GET)
         if query:
-            return self._search(request, query, *self._page(request))
+            return self._search(request, query, *self._page(request), sort=sort)
 
         qs = self.model_cls.objects.all().order_by(self.lookup_field)
+        qs = self._sort(qs, *sort)
         return self._build_response(request, qs, *self._page(request))
 
 
@@ -224,7 +477,7 @@ class DeleteView(object):
 
         scim_obj = self.scim_adapter(obj, request=request)
 
-        scim_obj.delete()
+        self.write(scim_obj.delete)
 
         return HttpResponse(status=204)
 
@@ -237,16 +490,21 @@ class PostView(object):
 
         body = json.loads(request.body.decode(constants.ENCODING))
 
-        scim_obj.from_dict(body)
+        def create():
+            scim_obj.from_dict(body)
+            scim_obj.save()
 
         try:
-            scim_obj.save()
+            self.write(create)
         except db.utils.IntegrityError as e:
             # Cast error to a SCIM IntegrityError to use the status
             # attribute on the SCIM IntegrityError.
             raise IntegrityError(str(e))
 
-        content = json.dumps(scim_obj.to_dict())
+        with timing.phase('serialize'):
+            doc = scim_obj.to_dict()
+        with timing.phase('encode'):
+            content = json.dumps(doc)
         response = HttpResponse(content=content,
                                 content_type=constants.SCIM_CONTENT_TYPE,
                                 status=201)
@@ -263,14 +521,37 @@ class PutView(object):
         print(request.body.decode(constants.ENCODING))
         body = json.loads(request.body.decode(constants.ENCODING))
 
-        scim_obj.from_dict(body)
-        print(scim_obj)
-        if hasattr(scim_obj, 'is_active') and getattr(scim_obj, 'is_active') == False:
-            scim_obj.delete()
-        else:
+        def update():
+            scim_obj.from_dict(body)
             scim_obj.save()
 
-        content = json.dumps(scim_obj.to_dict())
+        self.write(update)
+
+        with timing.phase('serialize'):
+            doc = scim_obj.to_dict()
+        with timing.phase('encode'):
+            content = json.dumps(doc)
+        response = HttpResponse(content=content,
+                                content_type=constants.SCIM_CONTENT_TYPE)
+        response['Location'] = scim_obj.location
+        return response
+
+class PatchView(object):
+    def patch(self, request, *args, **kwargs):
+        obj = self.get_object()
+
+        scim_obj = self.scim_adapter(obj, request=request)
+        body = json.loads(request.body.decode(constants.ENCODING))
+        operations = body.get('Operations')
+        if not isinstance(operations, list):
+            raise BadRequestError('No Operations specified')
+
+        self.write(lambda: scim_obj.handle_operations(operations))
+
+        with timing.phase('serialize'):
+            doc = scim_obj.to_dict()
+        with timing.phase('encode'):
+            content = json.dumps(doc)
         response = HttpResponse(content=content,
                                 content_type=constants.SCIM_CONTENT_TYPE)
         response['Location'] = scim_obj.location
@@ -285,19 +566,53 @@ class UsersView(FilterMixin, GetView, PostView, PutView, DeleteView, SCIMView):
     parser = SCIMSimpleUserFilterTransformer
 
 
-class GroupsView(FilterMixin, GetView, PostView, PutView, DeleteView, SCIMView):
+class GroupsView(FilterMixin, GetView, PostView, PutView, PatchView, DeleteView, SCIMView):
     http_method_names = ['get', 'post', 'put', 'patch', 'delete']
 
     scim_adapter = SCIMGroup
     model_cls = Group
-    parser = None
+    parser = SCIMSimpleGroupFilterTransformer
+
+
+@lru_cache(maxsize=None)
+def get_service_provider_config_content():
+    """
+    The ServiceProviderConfig does not vary per request, so it is serialized
+    once per process.
+    """
+    return json.dumps(SCIMServiceProviderConfig().to_dict())
 
 
 class ServiceProviderConfigView(SCIMView):
     http_method_names = ['get']
 
     def get(self, request):
-        config = SCIMServiceProviderConfig(request=request)
-        content = json.dumps(config.to_dict())
+        content = get_service_provider_config_content()
         return HttpResponse(content=content,
                             content_type=constants.SCIM_CONTENT_TYPE)
+
+
+class ChangesView(SCIMView):
+    """
+    Streams the change log as newline delimited JSON, starting after the
+    sequence number given in ``since``. Consumers should remember the ``seq``
+    of the last entry they processed and pass it on their next call.
+    """
+    http_method_names = ['get']
+
+    def get(self, request):
+        try:
+            since = int(request.GET.get('since', 0))
+            count = request.GET.get('count')
+            count = int(count) if count is not None else None
+        except ValueError as e:
+            raise BadRequestError('Invalid change log position: ' + str(e))
+        if since < 0 or (count is not None and count < 0):
+            raise BadRequestError('Invalid change log position (since and count must be >= 0)')
+
+        changes = Change.objects.since(since)
+        if count is not None:
+            changes = changes[:count]
+
+        lines = (json.dumps(change.to_dict()) + '\n' for change in changes.iterator())
+        return StreamingHttpResponse(lines, content_type='application/x-ndjson')
@@ -0,0 +1,32 @@
+"""
+Warm-up of the per-process state that SCIM requests otherwise build lazily
+on the first request: the URL resolvers, the adapters' location templates and
+the discovery documents.
+"""
+import logging
+
+from django.db import connection
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+
+def warm_up(database=True):
+    """
+    Build the lazily created state needed to serve SCIM requests. With
+    ``database``, also open this process's database connection.
+    """
+    from .adapters import SCIMGroup
+    from .adapters import SCIMUser
+    from .adapters import get_location_template
+    from .views import get_service_provider_config_content
+
+    reverse('scim:root')
+    for adapter in (SCIMUser, SCIMGroup):
+        get_location_template(adapter.url_name)
+    get_service_provider_config_content()
+
+    if database:
+        connection.ensure_connection()
+
+    logger.debug('SCIM warm-up complete')
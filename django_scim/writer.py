@@ -0,0 +1,146 @@
+"""
+Group commit of SCIM writes.
+
+With SQLite, each write request otherwise takes the database's write lock
+and syncs its own transaction to disk, so concurrent writes queue up on the
+lock (or fail with "database is locked") and throughput is bounded by the
+disk's sync rate. With ``SCIM_GROUP_COMMIT`` enabled, the database changes
+of write requests are instead handed to a single writer thread per process
+(see ``SCIMView.write``), which runs whatever has queued up, up to
+``SCIM_GROUP_COMMIT_MAX_BATCH`` writes, in one transaction, waiting at most
+``SCIM_GROUP_COMMIT_DELAY`` seconds for more to arrive. Each write runs in a
+savepoint of its own, so a write that raises is rolled back alone and its
+exception is re-raised in the request.
+
+Only the changes run in the writer: the request builds its response once the
+transaction holding its write has committed, so the write lock isn't held
+while responses are serialized, and a client never sees a write
+acknowledged that could still be lost. When the commit itself fails, every
+write of the batch fails with ``ServiceUnavailableError``.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.db import close_old_connections
+from django.db import connection
+from django.db import transaction
+
+from . import timing
+from .exceptions import ServiceUnavailableError
+from .utils import get_setting
+
+logger = logging.getLogger(__name__)
+
+
+class _Rollback(Exception):
+    """Raised to roll back the savepoint of a failed write."""
+
+
+class GroupCommitWriter(object):
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    @property
+    def enabled(self):
+        return get_setting('SCIM_GROUP_COMMIT', False)
+
+    def submit(self, write):
+        """
+        Queue ``write()`` to run in the writer thread and return a
+        ``Future`` resolved with its return value once it is committed.
+        """
+        future = Future()
+        self.ensure_started()
+        # The request waits on the future, so the write's queries can be
+        # timed as the request's.
+        self.queue.put((timing.bind(write), future))
+        return future
+
+    def run(self, write):
+        """
+        Run ``write()`` through the writer and return its result once it is
+        committed, or raise the exception it raised.
+        """
+        return self.submit(write).result()
+
+    def ensure_started(self):
+        # The thread doesn't survive a fork, so a forked worker starts its
+        # own.
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive() or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.loop, name='scim-writer', daemon=True)
+                self.thread.start()
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        max_batch = get_setting('SCIM_GROUP_COMMIT_MAX_BATCH', 64)
+        deadline = time.monotonic() + get_setting('SCIM_GROUP_COMMIT_DELAY', 0.002)
+        while len(batch) < max_batch:
+            try:
+                # Take what is already queued without waiting, then wait for
+                # stragglers until the deadline.
+                batch.append(self.queue.get_nowait())
+                continue
+            except queue.Empty:
+                pass
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def loop(self):
+        while True:
+            batch = self.next_batch()
+            close_old_connections()
+            results = []
+            try:
+                with transaction.atomic():
+                    for write, future in batch:
+                        if not future.set_running_or_notify_cancel():
+                            continue
+                        results.append((future, self.run_in_savepoint(write)))
+            except Exception as e:
+                logger.exception('Group commit of %d writes failed', len(batch))
+                if connection.connection is not None and not connection.is_usable():
+                    connection.close()
+                error = ServiceUnavailableError('The write could not be committed: {}'.format(e))
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            for future, (result, error) in results:
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+    @staticmethod
+    def run_in_savepoint(write):
+        """Run ``write()``, rolling back its changes alone if it fails."""
+        outcome = [None, None]
+        try:
+            with transaction.atomic():
+                try:
+                    outcome[0] = write()
+                except Exception as e:
+                    outcome[1] = e
+                    raise _Rollback()
+        except _Rollback:
+            pass
+        return outcome
+
+
+writer = GroupCommitWriter()
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class SwaAppConfig(AppConfig):
     name = 'swa_app'
+
+    def ready(self):
+        # Registers the system check of the static files manifest.
+        from . import storage  # noqa
@@ -0,0 +1,136 @@
+"""
+Report how long a fresh process takes to serve its first SCIM response.
+
+The measurement runs in a new interpreter, so nothing imported by
+``manage.py`` itself is counted. It is broken down into the phases of a cold
+start (interpreter and Django setup, loading the WSGI application and URL
+configuration, warm-up, first and second request), followed by the slowest
+imports as reported by ``python -X importtime``.
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+PROBE = r'''
+import io, json, os, sys, time
+t0 = time.perf_counter()
+phases = []
+
+def mark(name):
+    global t0
+    now = time.perf_counter()
+    phases.append((name, (now - t0) * 1000))
+    t0 = now
+
+import django
+django.setup()
+mark('django.setup()')
+
+from django.core.wsgi import get_wsgi_application
+application = get_wsgi_application()
+mark('load WSGI application')
+
+from django.conf import settings
+from django.urls import get_resolver
+get_resolver().url_patterns
+mark('import URL configuration')
+
+if {warm_up!r}:
+    from django_scim.warmup import warm_up
+    warm_up()
+    mark('warm-up')
+
+def request(path):
+    environ = {{
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '443', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost', 'HTTP_AUTHORIZATION': os.environ.get('API_KEY', ''),
+        'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr, 'wsgi.url_scheme': 'https',
+        'wsgi.version': (1, 0), 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }}
+    status = []
+    body = b''.join(application(environ, lambda s, h, e=None: status.append(s)))
+    return status[0]
+
+status = request({path!r})
+mark('first request ({{}})'.format(status))
+request({path!r})
+mark('second request')
+print(json.dumps(phases))
+'''
+
+
+class Command(BaseCommand):
+    help = 'Measures import time and first-request latency of a fresh process.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path', default='/scim/v2/ServiceProviderConfig',
+            help='Path of the request to time (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--no-warm-up', action='store_false', dest='warm_up',
+            help='Do not run the SCIM warm-up before the first request.',
+        )
+        parser.add_argument(
+            '--imports', type=int, default=15,
+            help='Number of slowest imports to list (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=5,
+            help='Number of fresh processes to measure; the median of each phase is '
+                 'reported (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--budget', type=float,
+            help='Fail if time to the first response exceeds this many milliseconds.',
+        )
+
+    def probe(self, options):
+        probe = PROBE.format(path=options['path'], warm_up=options['warm_up'])
+        python_path = os.pathsep.join(filter(None, [settings.BASE_DIR, os.environ.get('PYTHONPATH')]))
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', probe],
+            env=dict(os.environ, PYTHONPATH=python_path),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+        )
+        if result.returncode:
+            raise CommandError('Startup probe failed:\n' + result.stderr[-2000:])
+
+        return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+    def handle(self, *args, **options):
+        runs = [self.probe(options) for _ in range(max(options['repeat'], 1))]
+
+        self.stdout.write('Phase (median of %d runs)          ms' % len(runs))
+        total = 0
+        for i, (name, _) in enumerate(runs[0][0]):
+            elapsed = statistics.median(phases[i][1] for phases, _ in runs)
+            if name != 'second request':
+                total += elapsed
+            self.stdout.write('{:<32} {:>6.1f}'.format(name, elapsed))
+        self.stdout.write('{:<32} {:>6.1f}'.format('time to first response', total))
+
+        result = runs[-1][1]
+
+        imports = []
+        for line in result.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            self_us, _, name = line.split(':', 1)[1].split('|', 2)
+            imports.append((int(self_us), name.strip()))
+        imports.sort(reverse=True)
+
+        self.stdout.write('\nSlowest imports (self time)        ms')
+        for self_us, name in imports[:options['imports']]:
+            self.stdout.write('{:<32} {:>6.1f}'.format(name, self_us / 1000))
+
+        if options['budget'] is not None and total > options['budget']:
+            raise CommandError('Time to first response %.1f ms exceeds the budget of %.1f ms'
+                               % (total, options['budget']))
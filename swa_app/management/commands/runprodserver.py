@@ -0,0 +1,303 @@
+"""
+Serve the project over HTTPS with a pre-forking, multi-process server.
+
+The WSGI application is loaded and warmed up once in the master process
+before the workers are forked, so every worker starts with the project
+imported and its URL resolvers, SCIM adapters and discovery documents built.
+Each worker then serves requests on the shared listening socket with a pool
+of threads.
+
+The master restarts workers that die. Send it SIGHUP to replace all workers
+gracefully, or SIGTERM/SIGINT to stop; in both cases workers finish the
+requests they are serving before exiting.
+
+Every ``SESSION_CLEANUP_INTERVAL`` seconds the master also forks a short-lived
+process that removes expired sessions, like ``manage.py clearsessions``, and
+every ``SCIM_PURGE_INTERVAL`` seconds one that deletes long deactivated
+users, like ``manage.py scimpurge``.
+"""
+import os
+import signal
+import socket
+import ssl
+import threading
+import time
+import traceback
+from importlib import import_module
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer
+from django.core.servers.basehttp import WSGIRequestHandler
+from django.core.servers.basehttp import get_internal_wsgi_application
+from django.db import connections
+
+from django_scim import idempotency
+from django_scim.warmup import warm_up
+
+from .scimpurge import purge_deactivated
+
+
+class WorkerServer(ThreadedWSGIServer):
+    """
+    A threaded WSGI server accepting connections on an already bound socket,
+    optionally wrapping them in TLS.
+    """
+    # Let in-flight requests complete when the worker shuts down.
+    daemon_threads = False
+
+    def __init__(self, listener, ssl_context=None):
+        super().__init__(listener.getsockname()[:2], WSGIRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = listener
+        self.ssl_context = ssl_context
+        self.server_address = listener.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+
+    def get_request(self):
+        sock, address = self.socket.accept()
+        if self.ssl_context is not None:
+            # The handshake happens on first read, in the request's thread,
+            # so a slow client can't hold up the accept loop.
+            sock = self.ssl_context.wrap_socket(sock, server_side=True,
+                                                do_handshake_on_connect=False)
+        return sock, address
+
+
+class Command(BaseCommand):
+    help = 'Starts a pre-forking multi-process HTTPS server for production use.'
+
+    default_addrport = '0.0.0.0:8000'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'addrport', nargs='?', default=self.default_addrport,
+            help='Address and port to listen on (default: %s).' % self.default_addrport,
+        )
+        parser.add_argument(
+            '--workers', type=int,
+            default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)),
+            help='Number of worker processes (default: $WEB_WORKERS or the number of CPUs).',
+        )
+        parser.add_argument(
+            '--certificate', default=os.path.join(settings.BASE_DIR, 'swa_app', 'ssl', 'cert'),
+            help='Path to the TLS certificate.',
+        )
+        parser.add_argument(
+            '--key', default=os.path.join(settings.BASE_DIR, 'swa_app', 'ssl', 'key'),
+            help='Path to the TLS private key.',
+        )
+        parser.add_argument(
+            '--key-password', default=os.environ.get('SSL_KEY_PASSWORD'),
+            help='Passphrase of an encrypted TLS private key (default: $SSL_KEY_PASSWORD).',
+        )
+        parser.add_argument(
+            '--http', action='store_true',
+            help='Serve plain HTTP, eg. behind a TLS terminating proxy.',
+        )
+        parser.add_argument(
+            '--graceful-timeout', type=float, default=30,
+            help='Seconds workers get to finish in-flight requests before being killed.',
+        )
+
+    def handle(self, *args, **options):
+        host, _, port = options['addrport'].rpartition(':')
+        try:
+            port = int(port)
+        except ValueError:
+            raise CommandError('"%s" is not a valid address:port.' % options['addrport'])
+        if options['workers'] < 1:
+            raise CommandError('--workers must be at least 1.')
+
+        ssl_context = None
+        if not options['http']:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            try:
+                ssl_context.load_cert_chain(options['certificate'], options['key'],
+                                            password=options['key_password'])
+            except (OSError, ssl.SSLError) as e:
+                raise CommandError('Unable to load the TLS certificate: %s' % e)
+
+        # Preload: everything imported or built here is shared with the
+        # workers through fork().
+        self.application = get_internal_wsgi_application()
+        warm_up(database=False)
+        connections.close_all()
+
+        self.listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host or '0.0.0.0', port))
+        self.listener.listen(128)
+
+        self.ssl_context = ssl_context
+        self.options = options
+        self.workers = set()
+        self.stopping = False
+        self.reloading = False
+
+        if options['workers'] > 1 and self.sessions_per_process():
+            self.stderr.write('Warning: sessions are kept in a per-process memory cache, so they '
+                              'will not be shared between workers. Set SESSION_CACHE_DIR or '
+                              'SESSION_STORE=db/signed_cookies.')
+        if options['workers'] > 1 and idempotency.get_window() and \
+                isinstance(idempotency.get_cache(), LocMemCache):
+            self.stderr.write('Warning: responses to SCIM writes are kept in a per-process memory '
+                              'cache, so a retry reaching another worker runs the write again. '
+                              'Set SCIM_IDEMPOTENCY_CACHE_TABLE.')
+
+        self.stdout.write('Serving %s://%s:%s with %d workers (pid %d)' % (
+            'http' if ssl_context is None else 'https', host or '0.0.0.0', port,
+            options['workers'], os.getpid()))
+        self.run_master()
+
+    def run_master(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        for _ in range(self.options['workers']):
+            self.spawn_worker()
+
+        tasks = [(interval, task) for interval, task in (
+            (getattr(settings, 'SESSION_CLEANUP_INTERVAL', 0), self.clear_sessions),
+            (getattr(settings, 'SCIM_PURGE_INTERVAL', 0), self.purge_users),
+        ) if interval]
+        next_runs = [time.monotonic() + interval for interval, _ in tasks]
+
+        while not self.stopping:
+            for i, (interval, task) in enumerate(tasks):
+                if time.monotonic() >= next_runs[i]:
+                    next_runs[i] = time.monotonic() + interval
+                    self.spawn_task(task)
+
+            if self.reloading:
+                self.reloading = False
+                self.reload_workers()
+
+            for pid in self.reap_workers():
+                if not self.stopping:
+                    self.stderr.write('Worker %d exited; restarting it' % pid)
+                    self.spawn_worker()
+            time.sleep(0.5)
+
+        self.stop_workers(self.workers)
+        self.listener.close()
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def spawn_worker(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+
+        status = 0
+        try:
+            self.run_worker()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def sessions_per_process(self):
+        engine = settings.SESSION_ENGINE.rpartition('.')[2]
+        return engine in ('cache', 'cached_db') and \
+            isinstance(caches[settings.SESSION_CACHE_ALIAS], LocMemCache)
+
+    def clear_sessions(self):
+        import_module(settings.SESSION_ENGINE).SessionStore.clear_expired()
+
+    def purge_users(self):
+        purge_deactivated(getattr(settings, 'SCIM_PURGE_RETENTION', 30))
+
+    def spawn_task(self, task):
+        # A separate process keeps the master free of database connections,
+        # which forked workers would otherwise inherit, and responsive to
+        # signals while a large table is cleaned.
+        pid = os.fork()
+        if pid:
+            return pid
+
+        status = 0
+        try:
+            task()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+    def reap_workers(self):
+        exited = []
+        while self.workers:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in self.workers:
+                self.workers.discard(pid)
+                exited.append(pid)
+        return exited
+
+    def reload_workers(self):
+        old = set(self.workers)
+        self.workers.clear()
+        for _ in range(self.options['workers']):
+            self.spawn_worker()
+        self.stop_workers(old)
+        self.stdout.write('Replaced %d workers' % len(old))
+
+    def stop_workers(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        deadline = time.monotonic() + self.options['graceful_timeout']
+        remaining = set(pids)
+        while remaining and time.monotonic() < deadline:
+            for pid in list(remaining):
+                try:
+                    done, _ = os.waitpid(pid, os.WNOHANG)
+                except ChildProcessError:
+                    done = pid
+                if done:
+                    remaining.discard(pid)
+            time.sleep(0.1)
+
+        for pid in remaining:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+
+    def run_worker(self):
+        server = WorkerServer(self.listener, self.ssl_context)
+        server.set_app(self.application)
+
+        def shutdown(signum, frame):
+            # shutdown() waits for serve_forever() to return, which runs in
+            # this (the main) thread, so it has to be called from another.
+            threading.Thread(target=server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        warm_up()
+        server.serve_forever()
+        server.server_close()
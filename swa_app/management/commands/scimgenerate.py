@@ -0,0 +1,199 @@
+"""
+Generate a synthetic directory for scale testing.
+
+Creates ``--users`` users, each with a populated profile, and ``--groups``
+groups. Group sizes are skewed like real directories, where a few groups
+("All employees", a large department) hold most users and most groups are
+small: each user joins on average ``--groups-per-user`` groups, picked with
+a probability proportional to ``1 / rank ** skew`` (a Zipf distribution),
+so the first groups are the largest. ``--skew 0`` spreads users evenly.
+
+The directory is a function of ``--seed``, the other options and the ids
+the rows start from, so a run into an empty database can be reproduced
+exactly. Usernames and group names are numbered after their ids, so that
+further runs add to the directory. Rows are inserted with one multi-row
+statement per batch and table in a single transaction, bypassing model
+instances and signals, and are logged as created in the change log.
+"""
+import random
+import time
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import IntegrityError
+from django.db import connection
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from django_scim.adapters import SCIMGroup
+from django_scim.adapters import SCIMUser
+from django_scim.models import Change
+from swa_app.models import Profile
+
+FIRST_NAMES = (
+    'James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda',
+    'David', 'Elizabeth', 'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica',
+    'Thomas', 'Sarah', 'Carlos', 'Maria', 'Wei', 'Mei', 'Arjun', 'Priya', 'Olga', 'Ivan',
+)
+LAST_NAMES = (
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis',
+    'Rodriguez', 'Martinez', 'Hernandez', 'Lopez', 'Wilson', 'Anderson', 'Taylor', 'Moore',
+    'Nguyen', 'Chen', 'Wang', 'Patel', 'Kumar', 'Ivanova', 'Schmidt', 'Kowalski',
+)
+DEPARTMENTS = (
+    'Engineering', 'Sales', 'Marketing', 'Finance', 'Human Resources', 'Legal',
+    'Support', 'Operations', 'Product', 'IT',
+)
+COMPANIES = ('Acme', 'Globex', 'Initech', 'Umbrella', 'Hooli', 'Stark Industries')
+COUNTRIES = ('US', 'US', 'US', 'GB', 'DE', 'FR', 'IN', 'JP', 'BR', 'CA', 'AU')
+TEAMS = ('Team', 'Project', 'Committee', 'Guild', 'Working Group', 'Chapter')
+
+
+class Command(BaseCommand):
+    help = 'Generates a reproducible synthetic directory of users and groups.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=10000,
+            help='Number of users (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--groups', type=int, default=100,
+            help='Number of groups (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--groups-per-user', type=int, default=3,
+            help='Average number of groups a user is a member of (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--skew', type=float, default=1.0,
+            help='Exponent of the Zipf distribution of group sizes; 0 for even sizes '
+                 '(default: %(default)s).',
+        )
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Seed of the random generator (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--domain', default='example.com',
+            help='Domain of the usernames and email addresses (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--password',
+            help='Password of every user (default: none, so they cannot log in).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=10000,
+            help='Number of rows inserted per statement (default: %(default)s).',
+        )
+
+    def handle(self, *args, **options):
+        for name in ('users', 'groups', 'groups_per_user', 'batch_size'):
+            if options[name] < (1 if name == 'batch_size' else 0):
+                raise CommandError('--{} is out of range.'.format(name.replace('_', '-')))
+        if options['groups_per_user'] and not options['groups']:
+            raise CommandError('--groups-per-user needs --groups.')
+
+        self.rng = random.Random(options['seed'])
+        self.options = options
+        self.batch_size = options['batch_size']
+        # The clock is read once, so that all rows share a timestamp.
+        self.now = connection.ops.adapt_datetimefield_value(timezone.now())
+        # Hashing is slow, so all users share one hash of the password.
+        self.password = make_password(options['password'])
+        self.memberships = 0
+
+        started = time.monotonic()
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                # Without the query logging of the cursor used with DEBUG,
+                # which would take about as long as the inserts themselves.
+                self.cursor = cursor = connection.make_cursor(cursor.cursor)
+                group_ids = self.create_groups(options['groups'])
+                self.create_users(options['users'], group_ids)
+                for sql in connection.ops.sequence_reset_sql(
+                        no_style(), [get_user_model(), Group, Profile]):
+                    cursor.execute(sql)
+        except IntegrityError as e:
+            raise CommandError('The directory already has some of these users or groups: {}'.format(e))
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Created %d users, %d groups and %d memberships in %.2f s (%.0f users/s)' % (
+            options['users'], options['groups'], self.memberships, elapsed,
+            options['users'] / elapsed if elapsed else 0))
+
+    def insert(self, model, fields, rows):
+        """Insert ``rows`` of values of ``fields`` of ``model``, a batch at a time."""
+        opts = model._meta
+        qn = connection.ops.quote_name
+        columns = ', '.join(qn(opts.get_field(name).column) for name in fields)
+        placeholder = '({})'.format(', '.join(['%s'] * len(fields)))
+        # SQLite caps the parameters of a statement; see
+        # DatabaseFeatures.max_query_params.
+        max_params = connection.features.max_query_params or len(fields) * self.batch_size
+        per_statement = max(1, min(self.batch_size, max_params // len(fields)))
+        for i in range(0, len(rows), per_statement):
+            batch = rows[i:i + per_statement]
+            self.cursor.execute(
+                'INSERT INTO {} ({}) VALUES {}'.format(
+                    qn(opts.db_table), columns, ', '.join([placeholder] * len(batch))),
+                [value for row in batch for value in row])
+
+    def log_created(self, resource_type, ids):
+        self.insert(Change, ('resource_type', 'resource_id', 'operation', 'timestamp'),
+                    [(resource_type, str(id_), Change.CREATE, self.now) for id_ in ids])
+
+    @staticmethod
+    def next_id(model):
+        return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+    def create_groups(self, count):
+        first = self.next_id(Group)
+        ids = list(range(first, first + count))
+        self.insert(Group, ('id', 'name'), [
+            (id_, '{} {} {}'.format(self.rng.choice(DEPARTMENTS), self.rng.choice(TEAMS), id_))
+            for id_ in ids
+        ])
+        self.log_created(SCIMGroup.resource_type, ids)
+        return ids
+
+    def create_users(self, count, group_ids):
+        model = get_user_model()
+        rng = self.rng
+        domain = self.options['domain']
+        per_user = self.options['groups_per_user']
+        cum_weights = list(accumulate(
+            rank ** -self.options['skew'] for rank in range(1, len(group_ids) + 1)))
+
+        first_user, first_profile = self.next_id(model), self.next_id(Profile)
+        for start in range(0, count, self.batch_size):
+            users, profiles, memberships = [], [], []
+            for i in range(start, min(start + self.batch_size, count)):
+                user_id = first_user + i
+                first_name, last_name = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+                username = '{}.{}{}@{}'.format(first_name, last_name, user_id, domain).lower()
+                users.append((user_id, self.password, False, username, first_name, last_name,
+                              username, False, True, self.now))
+                profiles.append((
+                    first_profile + i, user_id, rng.choice(DEPARTMENTS), rng.choice(COMPANIES),
+                    '+1 555 {:03d} {:04d}'.format(rng.randrange(1000), rng.randrange(10000)),
+                    rng.choice(COUNTRIES), rng.choice(('yes', 'no')), self.now, self.now,
+                ))
+                # Between 0 and twice the average, drawn with replacement.
+                k = rng.randint(0, 2 * per_user) if per_user else 0
+                for group_id in sorted(set(rng.choices(group_ids, cum_weights=cum_weights, k=k))):
+                    memberships.append((user_id, group_id))
+
+            self.insert(model, ('id', 'password', 'is_superuser', 'username', 'first_name',
+                                'last_name', 'email', 'is_staff', 'is_active', 'date_joined'), users)
+            self.insert(Profile, ('id', 'user', 'department', 'company_name', 'phone_number',
+                                  'country', 'opt_in', 'created', 'last_modified'), profiles)
+            self.insert(model.groups.through, ('user', 'group'), memberships)
+            self.log_created(SCIMUser.resource_type, [row[0] for row in users])
+            self.memberships += len(memberships)
+            self.stderr.write('%d users created' % min(start + self.batch_size, count))
@@ -0,0 +1,252 @@
+"""
+Bulk load users into the directory.
+
+The input is read in batches of ``--batch-size`` users. Each batch is
+inserted with a handful of ``bulk_create`` queries (users, profiles, group
+memberships and change log entries) in one transaction, instead of one SCIM
+request, and its ``post_save`` signals, per user. Passwords, the only
+expensive part of creating a user, are hashed in a pool of processes.
+
+Two input formats are supported:
+
+* ``ndjson``: one SCIM User resource per line, as accepted by the Users
+  endpoint or written by ``scimexport``. Group resources in the same file
+  are created (without members) too.
+* ``csv``: one user per row, with SCIM attribute paths as column names, eg.
+  ``userName,name.givenName,name.familyName,emails,password,department``.
+  ``emails`` holds a single address and ``groups`` the names of the user's
+  groups separated by ``;``.
+
+Users are added to groups by group name; missing groups are created. Users
+whose ``userName`` already exists are skipped, as are users without a
+``userName`` and groups without a ``displayName``.
+"""
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from django_scim import constants
+from django_scim.adapters import SCIMGroup
+from django_scim.adapters import SCIMUser
+from django_scim.models import Change
+from swa_app.models import Profile
+
+# Largest number of parameters put in one ``IN (...)`` lookup; SQLite limits
+# a statement to 999.
+LOOKUP_CHUNK = 900
+
+
+def chunked(items, size):
+    items = iter(items)
+    chunk = list(islice(items, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, size))
+
+
+def read_ndjson(f):
+    for number, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise CommandError('Line %d is not valid JSON: %s' % (number, e))
+
+
+def read_csv(f):
+    schemas = {attribute.path: attribute.schema for attribute in SCIMUser.attributes}
+    for row in csv.DictReader(f):
+        d = {}
+        for column, value in row.items():
+            if column is None or value == '':
+                continue
+            if column == 'emails':
+                value = [{'value': value, 'primary': True}]
+            elif column == 'groups':
+                value = [{'display': name.strip()} for name in value.split(';') if name.strip()]
+            elif column == 'active':
+                value = value.lower() in ('1', 'true', 'yes')
+
+            node = d
+            if schemas.get(column):
+                node = d.setdefault(schemas[column], {})
+            *parents, leaf = column.split('.')
+            for key in parents:
+                node = node.setdefault(key, {})
+            node[leaf] = value
+        yield d
+
+
+class Command(BaseCommand):
+    help = 'Bulk loads users (and their groups) from NDJSON or CSV.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read, or - for standard input.')
+        parser.add_argument(
+            '--format', choices=('ndjson', 'csv'),
+            help='Input format (default: from the file extension, else ndjson).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Number of users inserted per transaction (default: %(default)s).',
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of processes hashing passwords (default: the number of CPUs).',
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        path = options['input']
+        fmt = options['format'] or ('csv' if path.lower().endswith('.csv') else 'ndjson')
+        f = sys.stdin if path == '-' else open(path, newline='' if fmt == 'csv' else None)
+
+        self.groups = {}
+        self.created = self.skipped = 0
+        self.now = timezone.now()
+        self.workers = options['workers']
+        self.pool = ProcessPoolExecutor(self.workers) if self.workers > 1 else None
+        started = time.monotonic()
+        try:
+            resources = read_csv(f) if fmt == 'csv' else read_ndjson(f)
+            for batch in chunked(resources, options['batch_size']):
+                self.import_batch(batch)
+                self.stderr.write('%d users created, %d skipped' % (self.created, self.skipped))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+            if self.pool is not None:
+                self.pool.shutdown()
+
+        elapsed = time.monotonic() - started
+        self.stdout.write('Created %d users (%d skipped) in %.2f s (%.0f users/s)' % (
+            self.created, self.skipped, elapsed, self.created / elapsed if elapsed else 0))
+
+    def import_batch(self, resources):
+        users = []
+        for d in resources:
+            # The core User and Group schemas share a URN, so groups are told
+            # apart by their attributes.
+            if 'userName' not in d and (d.get('displayName') or
+                                        constants.SchemaURI.OKTA_GROUP in (d.get('schemas') or [])):
+                if d.get('displayName'):
+                    self.get_group_ids([d['displayName']])
+                else:
+                    self.skipped += 1
+            else:
+                users.append(d)
+
+        existing = self.existing_usernames(d.get('userName') for d in users)
+        pending = {}
+        for d in users:
+            username = d.get('userName')
+            if not username or username in existing or username in pending:
+                self.skipped += 1
+                continue
+            pending[username] = d
+        if not pending:
+            return
+
+        objs = [self.build_user(d) for d in pending.values()]
+        self.hash_passwords(objs, [d.get('password') for d in pending.values()])
+
+        with transaction.atomic():
+            model = SCIMUser.get_model()
+            model.objects.bulk_create([user for user, _ in objs])
+            ids = self.user_ids(pending)
+
+            for user, profile in objs:
+                user.pk = ids[user.username]
+                profile.user = user
+            Profile.objects.bulk_create([profile for _, profile in objs])
+
+            memberships = []
+            for username, d in pending.items():
+                names = [group.get('display') for group in d.get('groups') or []]
+                for group_id in self.get_group_ids(filter(None, names)):
+                    memberships.append(model.groups.through(user_id=ids[username], group_id=group_id))
+            model.groups.through.objects.bulk_create(memberships)
+
+            Change.objects.bulk_create([
+                Change(resource_type=SCIMUser.resource_type, resource_id=str(ids[username]),
+                       operation=Change.CREATE)
+                for username in pending
+            ])
+        self.created += len(pending)
+
+    def build_user(self, d):
+        """
+        Return an unsaved ``(user, profile)`` pair for the SCIM dict ``d``,
+        applying its attributes as a SCIM create would, except the password.
+        """
+        user = SCIMUser.get_model()()
+        user.profile = profile = Profile()
+        d = dict(d, password=None)
+        SCIMUser._from_dict(user, d)
+        for from_dict in SCIMUser._extension_from_dicts:
+            from_dict(user, d)
+        if not user.is_active:
+            profile.deactivated_at = self.now
+        return user, profile
+
+    def hash_passwords(self, objs, passwords):
+        indexes = [i for i, password in enumerate(passwords) if password]
+        cleartexts = [passwords[i] for i in indexes]
+        if self.pool is not None and len(cleartexts) > 1:
+            chunksize = max(1, len(cleartexts) // (self.workers * 4))
+            hashes = self.pool.map(make_password, cleartexts, chunksize=chunksize)
+        else:
+            hashes = map(make_password, cleartexts)
+        for i, hashed in zip(indexes, hashes):
+            objs[i][0].password = hashed
+
+    def existing_usernames(self, usernames):
+        model = SCIMUser.get_model()
+        existing = set()
+        for chunk in chunked(filter(None, usernames), LOOKUP_CHUNK):
+            existing.update(model.objects.filter(username__in=chunk).values_list('username', flat=True))
+        return existing
+
+    def user_ids(self, usernames):
+        # bulk_create only sets primary keys on PostgreSQL, so read them back.
+        model = SCIMUser.get_model()
+        ids = {}
+        for chunk in chunked(usernames, LOOKUP_CHUNK):
+            ids.update(model.objects.filter(username__in=chunk).values_list('username', 'id'))
+        return ids
+
+    def get_group_ids(self, names):
+        """Return the ids of the groups called ``names``, creating missing ones."""
+        names = list(names)
+        missing = [name for name in set(names) if name not in self.groups]
+        if missing:
+            model = SCIMGroup.get_model()
+            for chunk in chunked(missing, LOOKUP_CHUNK):
+                self.groups.update(model.objects.filter(name__in=chunk).values_list('name', 'id'))
+
+            new = [name for name in missing if name not in self.groups]
+            if new:
+                with transaction.atomic():
+                    model.objects.bulk_create([model(name=name) for name in new])
+                    created = {}
+                    for chunk in chunked(new, LOOKUP_CHUNK):
+                        created.update(model.objects.filter(name__in=chunk).values_list('name', 'id'))
+                    Change.objects.bulk_create([
+                        Change(resource_type=SCIMGroup.resource_type, resource_id=str(group_id),
+                               operation=Change.CREATE)
+                        for group_id in created.values()
+                    ])
+                self.groups.update(created)
+        return [self.groups[name] for name in names]
@@ -0,0 +1,75 @@
+"""
+Delete users that have been deactivated for longer than the retention period.
+
+Deactivating a user through SCIM only flags it (see
+``Profile.deactivated_at``), so that it stays cheap and can be undone. This
+removes the users deactivated more than ``--retention`` days ago (by default
+``SCIM_PURGE_RETENTION``), along with their profiles and group memberships,
+``--batch-size`` users per transaction so that writers are never held up for
+long, and logs their deletion in the change log. ``runprodserver`` runs it
+every ``SCIM_PURGE_INTERVAL`` seconds.
+"""
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from django_scim.adapters import SCIMUser
+from django_scim.models import Change
+
+
+def purge_deactivated(retention, batch_size=500):
+    """
+    Delete the users deactivated more than ``retention`` days ago, in
+    batches of ``batch_size``, and return how many were deleted.
+    """
+    model = get_user_model()
+    cutoff = timezone.now() - timedelta(days=retention)
+    purged = 0
+    while True:
+        with transaction.atomic():
+            # Users reactivated meanwhile no longer match.
+            ids = list(model.objects.select_for_update()
+                       .filter(is_active=False, profile__deactivated_at__lt=cutoff)
+                       .order_by('id').values_list('id', flat=True)[:batch_size])
+            if not ids:
+                return purged
+            model.objects.filter(id__in=ids).delete()
+            Change.objects.bulk_create([
+                Change(resource_type=SCIMUser.resource_type, resource_id=str(id_),
+                       operation=Change.DELETE)
+                for id_ in ids
+            ])
+        purged += len(ids)
+
+
+class Command(BaseCommand):
+    help = 'Deletes users deactivated for longer than the retention period.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention', type=float, default=None,
+            help='Days deactivated users are kept for (default: SCIM_PURGE_RETENTION).',
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of users deleted per transaction (default: %(default)s).',
+        )
+
+    def handle(self, *args, **options):
+        retention = options['retention']
+        if retention is None:
+            retention = getattr(settings, 'SCIM_PURGE_RETENTION', 30)
+        if retention < 0:
+            raise CommandError('--retention must not be negative.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+
+        started = time.monotonic()
+        purged = purge_deactivated(retention, options['batch_size'])
+        self.stdout.write('Purged %d users deactivated more than %g days ago in %.2f s' % (
+            purged, retention, time.monotonic() - started))
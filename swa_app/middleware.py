@@ -0,0 +1,113 @@
+"""
+Serves collected static files straight from ``STATIC_ROOT``, so the portal's
+assets don't need a separate web server in front of Django.
+
+* Content-hashed names written by ``collectstatic`` (see
+  :mod:`swa_app.storage`) are served with a far-future, ``immutable``
+  ``Cache-Control``; other names are revalidated after ``STATIC_MAX_AGE``
+  seconds.
+* When the client accepts it, the pre-compressed ``.br`` or ``.gz`` variant
+  of a file is served instead of the original.
+* ``If-Modified-Since`` is honoured with ``304 Not Modified``.
+
+The files under ``STATIC_ROOT`` are indexed once per process, so requests for
+anything else pass through with a single dictionary lookup.
+"""
+import json
+import mimetypes
+import os
+from functools import lru_cache
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.http import FileResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+from django_scim.compression import accepted_encodings
+
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 365
+
+# Content coding -> suffix of the pre-compressed variant, in order of
+# preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+VARIANT_SUFFIXES = tuple(suffix for _, suffix in ENCODINGS)
+
+
+class StaticFile(object):
+    def __init__(self, path, immutable):
+        self.path = path
+        self.immutable = immutable
+        self.content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self.variants = {}
+
+    def select(self, accepted):
+        """Return ``(path, content coding)`` of the variant to send."""
+        wildcard = accepted.get('*', 0.0)
+        for coding, _ in ENCODINGS:
+            if coding in self.variants and accepted.get(coding, wildcard) > 0:
+                return self.variants[coding], coding
+        return self.path, None
+
+
+@lru_cache(maxsize=None)
+def get_static_files():
+    """Index ``STATIC_ROOT``, mapping each URL path to a :class:`StaticFile`."""
+    root = settings.STATIC_ROOT
+    if not root or not os.path.isdir(root):
+        return {}
+
+    hashed = set()
+    manifest = os.path.join(root, ManifestStaticFilesStorage.manifest_name)
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            hashed.update(json.load(f).get('paths', {}).values())
+
+    files = {}
+    for directory, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root).replace(os.sep, '/')
+            if relative.endswith(VARIANT_SUFFIXES):
+                continue
+            static_file = StaticFile(path, immutable=relative in hashed)
+            for coding, suffix in ENCODINGS:
+                if os.path.exists(path + suffix):
+                    static_file.variants[coding] = path + suffix
+            files[settings.STATIC_URL + relative] = static_file
+    return files
+
+
+class StaticFilesMiddleware(object):
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        static_file = None
+        if request.method in ('GET', 'HEAD'):
+            static_file = get_static_files().get(request.path_info)
+        if static_file is None:
+            return self.get_response(request)
+        return self.serve(request, static_file)
+
+    def serve(self, request, static_file):
+        path, coding = static_file.select(accepted_encodings(request))
+        stat = os.stat(path)
+
+        if was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime, stat.st_size):
+            response = FileResponse(open(path, 'rb'), content_type=static_file.content_type)
+            response['Content-Length'] = stat.st_size
+            if coding:
+                response['Content-Encoding'] = coding
+        else:
+            response = HttpResponseNotModified()
+
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if static_file.immutable:
+            response['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            response['Cache-Control'] = 'public, max-age=%d' % settings.STATIC_MAX_AGE
+        if static_file.variants:
+            patch_vary_headers(response, ('Accept-Encoding',))
+        return response
@@ -0,0 +1,25 @@
+# Generated by Django 2.1.2 on 2026-10-19 17:06
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('swa_app', '0004_auto_20181204_0510'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='last_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
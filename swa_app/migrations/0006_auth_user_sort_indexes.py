@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    """
+    Index the auth_user columns that SCIM clients may sort on (see
+    ``SCIMUser.sort_fields``). auth_user belongs to django.contrib.auth, so
+    the indexes are created with plain SQL.
+    """
+
+    dependencies = [
+        ('auth', '0009_alter_user_last_name_max_length'),
+        ('swa_app', '0005_profile_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            ['CREATE INDEX swa_app_auth_user_last_name_idx ON auth_user (last_name)'],
+            ['DROP INDEX swa_app_auth_user_last_name_idx'],
+        ),
+        migrations.RunSQL(
+            ['CREATE INDEX swa_app_auth_user_date_joined_idx ON auth_user (date_joined)'],
+            ['DROP INDEX swa_app_auth_user_date_joined_idx'],
+        ),
+    ]
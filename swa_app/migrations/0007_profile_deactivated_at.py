@@ -0,0 +1,26 @@
+# Generated by Django 2.1.2 on 2026-10-19 18:02
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def flag_inactive_users(apps, schema_editor):
+    # Start the retention period of users deactivated by other means now.
+    Profile = apps.get_model('swa_app', 'Profile')
+    Profile.objects.filter(user__is_active=False).update(deactivated_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('swa_app', '0006_auth_user_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='deactivated_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(flag_inactive_users, migrations.RunPython.noop),
+    ]
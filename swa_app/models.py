@@ -10,6 +10,14 @@ class Profile(models.Model):
     phone_number = models.CharField(max_length=20, blank=True, null=True)
     country = models.CharField(max_length=2, blank=True, null=True)
     opt_in = models.CharField(max_length=3, blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    # Bumped on every user/profile save and on group membership changes so
+    # that Okta can run delta imports with ``meta.lastModified gt "<ts>"``.
+    last_modified = models.DateTimeField(auto_now=True, db_index=True)
+    # Set when the user is deactivated (``active: false``) and cleared when
+    # reactivated. Deactivated users are kept, memberships and all, until
+    # ``manage.py scimpurge`` deletes them after SCIM_PURGE_RETENTION days.
+    deactivated_at = models.DateTimeField(blank=True, null=True, db_index=True)
 
     @receiver(post_save, sender=User)
     def create_user_profile(sender, instance, created, **kwargs):
@@ -0,0 +1,92 @@
+"""
+Static files storage for the SWA portal.
+
+``collectstatic`` copies every asset into ``STATIC_ROOT`` under a name that
+contains a hash of its content (``home.css`` -> ``home.3c2f8a1b9e04.css``)
+and records the mapping in ``staticfiles.json``, which ``{% static %}`` uses.
+Since a hashed name never changes content, the files can be cached by
+browsers indefinitely; see :class:`swa_app.middleware.StaticFilesMiddleware`.
+
+Text assets are also written pre-compressed next to the original, as
+``<name>.gz`` and, when the ``brotli`` package is installed, ``<name>.br``,
+so they never have to be compressed while serving a request.
+
+Until ``collectstatic`` has written the manifest, assets keep their original
+names, and the ``swa_app.W001`` check warns about it at startup.
+"""
+import gzip
+import zlib
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestFilesMixin
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.checks import Warning
+from django.core.checks import register
+from django.core.files.base import ContentFile
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.html', '.json', '.map')
+
+# Variants that don't save at least this fraction of the original are not
+# worth a separate file.
+MIN_SAVING = 0.05
+
+
+def compressors():
+    yield '.gz', lambda data: gzip.compress(data, compresslevel=zlib.Z_BEST_COMPRESSION)
+    try:
+        import brotli
+    except ImportError:
+        return
+    yield '.br', lambda data: brotli.compress(data, quality=11)
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ``ManifestStaticFilesStorage`` that also writes gzip and brotli variants
+    of compressible files.
+    """
+
+    def stored_name(self, name):
+        # Without a manifest, every {% static %} would raise.
+        if not self.hashed_files:
+            return name
+        return super().stored_name(name)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run=dry_run, **options)
+        if dry_run:
+            return
+
+        for name in paths:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            # Compress both the original and the hashed copy, so that either
+            # name can be served compressed.
+            for target in {name, self.stored_name(name)}:
+                self.compress(target)
+
+    def compress(self, name):
+        with self.open(name) as f:
+            data = f.read()
+
+        for suffix, compress in compressors():
+            compressed = compress(data)
+            if len(compressed) > len(data) * (1 - MIN_SAVING):
+                continue
+            if self.exists(name + suffix):
+                self.delete(name + suffix)
+            self._save(name + suffix, ContentFile(compressed))
+
+
+@register('staticfiles')
+def check_manifest(app_configs, **kwargs):
+    if settings.DEBUG or not isinstance(staticfiles_storage, ManifestFilesMixin) or \
+            staticfiles_storage.hashed_files:
+        return []
+    return [Warning(
+        'The static files manifest is missing, so assets are served without '
+        'hashed names or long caching.',
+        hint='Run `manage.py collectstatic` before starting the server.',
+        id='swa_app.W001',
+    )]
@@ -1,3 +1,330 @@
+"""
+Query budgets and caching of the portal pages (see ``django_scim.tests``),
+the synthetic directory generator, the purge of deactivated users, the
+serving of static files and the import and export commands.
+
+The admin page lists the whole directory, so only its number of queries is
+held constant.
+"""
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.core.management import CommandError
+from django.core.management import call_command
+from django.db import connection
+from django.test import Client
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from django_scim import constants
+from django_scim.adapters import SCIMGroup
+from django_scim.adapters import SCIMUser
+from django_scim.models import Change
+from django_scim.tests import API_KEY
+from django_scim.tests import SIZES
+from django_scim.tests import TEST_SETTINGS
+from django_scim.tests import make_directory
+from swa_app.middleware import get_static_files
+from swa_app.models import Profile
+from swa_app import views
+from swa_app.storage import check_manifest
+
+
+class PortalBudgetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_directory(SIZES[0])
+        self.user = get_user_model().objects.order_by('id').first()
+        self.user.groups.add(Group.objects.create(name='Catalog Admin'))
+        self.client.force_login(self.user)
+
+    def assertBudget(self, path, queries):
+        counts = []
+        for size in SIZES:
+            make_directory(size)
+            self.client.get(path)
+            with CaptureQueriesContext(connection) as captured:
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(captured))
+        self.assertEqual(len(set(counts)), 1, 'Queries grow with the directory: {}\n{}'.format(
+            dict(zip(SIZES, counts)), '\n'.join(query['sql'] for query in captured.captured_queries)))
+        self.assertLessEqual(counts[0], queries)
+
+    @override_settings(PORTAL_CACHE_TIMEOUT=0)
+    def test_home(self):
+        self.assertBudget('/swa_app/', 5)
+
+    @override_settings(PORTAL_CACHE_TIMEOUT=0)
+    def test_admin(self):
+        self.assertBudget('/swa_app/admin', 8)
+
+    @override_settings(PORTAL_CACHE_TIMEOUT=300)
+    def test_home_cached(self):
+        self.assertBudget('/swa_app/', 3)
+
+    @override_settings(PORTAL_CACHE_TIMEOUT=300)
+    def test_admin_cached(self):
+        self.assertBudget('/swa_app/admin', 3)
+
+
+
+@override_settings(PORTAL_CACHE_TIMEOUT=300, **TEST_SETTINGS)
+class PortalCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        make_directory(20)
+        # user5 is a member of group0 only.
+        self.user = get_user_model().objects.get(username='user5')
+        self.client.force_login(self.user)
+        patcher = mock.patch.dict(os.environ, {'API_KEY': API_KEY})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scim = Client(HTTP_AUTHORIZATION=API_KEY)
+
+        # Renders are counted, with a header the cached page must keep.
+        def render_home(request, u, render=views._render_home):
+            response = render(request, u)
+            response['Content-Language'] = 'en'
+            return response
+        patcher = mock.patch('swa_app.views._render_home', side_effect=render_home)
+        self.render_home = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def home(self):
+        """Return the home page and whether it was rendered for this view."""
+        renders = self.render_home.call_count
+        response = self.client.get('/swa_app/')
+        self.assertEqual(response.status_code, 200)
+        return response, self.render_home.call_count > renders
+
+    def add_member(self, group_name, username):
+        group = Group.objects.get(name=group_name)
+        user = get_user_model().objects.get(username=username)
+        response = self.scim.patch('/scim/v2/Groups/%d' % group.id, json.dumps({
+            'schemas': ['urn:ietf:params:scim:api:messages:2.0:PatchOp'],
+            'Operations': [{'op': 'add', 'path': 'members', 'value': [{'value': str(user.id)}]}],
+        }), content_type='application/scim+json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_hit(self):
+        rendered, was_rendered = self.home()
+        self.assertTrue(was_rendered)
+        cached, was_rendered = self.home()
+        self.assertFalse(was_rendered)
+        self.assertEqual(cached.content, rendered.content)
+        self.assertEqual(cached['Content-Type'], rendered['Content-Type'])
+        self.assertEqual(cached['Content-Language'], 'en')
+
+    def test_invalidated(self):
+        self.home()
+        # Writes to the user's groups and to the user.
+        self.add_member('group0', 'user15')
+        self.assertTrue(self.home()[1])
+        self.add_member('group1', 'user5')
+        response, was_rendered = self.home()
+        self.assertTrue(was_rendered)
+        self.assertContains(response, 'group1')
+
+        response = self.scim.delete('/scim/v2/Groups/%d' % Group.objects.get(name='group1').id)
+        self.assertEqual(response.status_code, 204)
+        response, was_rendered = self.home()
+        self.assertTrue(was_rendered)
+        self.assertNotContains(response, 'group1')
+
+    def test_unrelated_write(self):
+        self.home()
+        self.add_member('group1', 'user0')
+        self.assertFalse(self.home()[1])
+
+    @override_settings(PORTAL_CACHE_TIMEOUT=0)
+    def test_disabled(self):
+        self.home()
+        self.assertTrue(self.home()[1])
+
+class GenerateDirectoryTests(TestCase):
+
+    def generate(self, **options):
+        options = dict({'users': 500, 'groups': 50, 'seed': 1}, **options)
+        call_command('scimgenerate', stdout=StringIO(), stderr=StringIO(), **options)
+
+    def snapshot(self):
+        users = get_user_model().objects.order_by('username')
+        return (
+            list(users.values_list('username', 'first_name', 'last_name', 'email')),
+            list(Profile.objects.order_by('user__username').values_list(
+                'user__username', 'department', 'company_name', 'phone_number', 'country', 'opt_in')),
+            list(get_user_model().groups.through.objects.order_by('user__username', 'group__name')
+                 .values_list('user__username', 'group__name')),
+        )
+
+    def group_sizes(self):
+        return sorted((group.user_set.count() for group in Group.objects.all()), reverse=True)
+
+    def test_generate(self):
+        self.generate(batch_size=100)
+        self.assertEqual(get_user_model().objects.count(), 500)
+        self.assertEqual(Profile.objects.filter(department__isnull=False).count(), 500)
+        self.assertEqual(Group.objects.count(), 50)
+        self.assertEqual(Change.objects.filter(operation=Change.CREATE).count(), 550)
+        # Created rows don't collide with the next ones saved through the ORM.
+        get_user_model().objects.create(username='after')
+        Group.objects.create(name='after')
+
+    def test_deterministic(self):
+        self.generate()
+        first = self.snapshot()
+        get_user_model().objects.all().delete()
+        Group.objects.all().delete()
+        self.generate()
+        self.assertEqual(self.snapshot(), first)
+        self.generate(seed=2)
+        self.assertNotEqual(self.snapshot()[1][500:], first[1])
+
+    def test_skew(self):
+        self.generate()
+        sizes = self.group_sizes()
+        self.assertGreater(sizes[0], 10 * sizes[len(sizes) // 2])
+
+        Group.objects.all().delete()
+        self.generate(skew=0)
+        sizes = self.group_sizes()
+        self.assertLess(sizes[0], 3 * sizes[-1])
+
+
+class PurgeTests(TestCase):
+
+    def setUp(self):
+        make_directory(100)
+        users = get_user_model().objects.order_by('id')
+        now = timezone.now()
+        self.old = list(users[:25])
+        self.recent = list(users[25:30])
+        for users, deactivated_at in ((self.old, now - timedelta(days=31)),
+                                      (self.recent, now - timedelta(days=29))):
+            ids = [user.id for user in users]
+            get_user_model().objects.filter(id__in=ids).update(is_active=False)
+            Profile.objects.filter(user_id__in=ids).update(deactivated_at=deactivated_at)
+        # Reactivated since; deactivated_at is cleared when that goes through
+        # SCIM.
+        get_user_model().objects.filter(id=self.old[0].id).update(is_active=True)
+
+    def test_purge(self):
+        out = StringIO()
+        call_command('scimpurge', retention=30, batch_size=10, stdout=out)
+        self.assertIn('Purged 24 users', out.getvalue())
+
+        remaining = set(get_user_model().objects.values_list('id', flat=True))
+        self.assertFalse(remaining & {user.id for user in self.old[1:]})
+        self.assertIn(self.old[0].id, remaining)
+        self.assertTrue(remaining >= {user.id for user in self.recent})
+        self.assertFalse(get_user_model().groups.through.objects.filter(
+            user_id__in=[user.id for user in self.old[1:]]).exists())
+        self.assertEqual(Profile.objects.count(), 76)
+        self.assertEqual(Change.objects.filter(operation=Change.DELETE).count(), 24)
+
+
+class StaticFilesTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        settings = override_settings(STATIC_ROOT=self.root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        get_static_files.cache_clear()
+        self.addCleanup(get_static_files.cache_clear)
+
+    def test_without_manifest(self):
+        response = self.client.get('/swa_app/login')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '/static/signin.css')
+        self.assertEqual([warning.id for warning in check_manifest(None)], ['swa_app.W001'])
+
+    def test_collected(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.assertEqual(check_manifest(None), [])
+        get_static_files.cache_clear()
+
+        response = self.client.get('/swa_app/login')
+        url = re.search(r'/static/signin\.[0-9a-f]{12}\.css', response.content.decode()).group(0)
+        response = self.client.get(url, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response['Cache-Control'])
+
+
+class ImportTests(TestCase):
+
+    def import_lines(self, *resources):
+        with tempfile.NamedTemporaryFile('w', suffix='.ndjson', delete=False) as f:
+            for resource in resources:
+                f.write(json.dumps(resource) + '\n')
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('scimimport', f.name, workers=1, stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_import(self):
+        out = self.import_lines(
+            {'schemas': ['urn:scim:schemas:core:1.0'], 'userName': 'imported',
+             'groups': [{'display': 'members'}]},
+            {'schemas': ['urn:scim:schemas:core:1.0', 'urn:okta:custom:group:1.0'],
+             'displayName': 'empty'},
+            # Invalid rows are skipped without stopping the import.
+            {'schemas': ['urn:scim:schemas:core:1.0', 'urn:okta:custom:group:1.0']},
+            {'schemas': ['urn:scim:schemas:core:1.0'], 'name': {'givenName': 'Nameless'}},
+        )
+        self.assertIn('Created 1 users (2 skipped)', out)
+        self.assertEqual(list(get_user_model().objects.get(username='imported')
+                              .groups.values_list('name', flat=True)), ['members'])
+        self.assertEqual(sorted(Group.objects.values_list('name', flat=True)), ['empty', 'members'])
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        make_directory(25)
+        self.users = [SCIMUser(user).to_dict() for user in get_user_model().objects.order_by('id')]
+        self.groups = [SCIMGroup(group).to_dict() for group in Group.objects.order_by('id')]
+
+    def export(self, **options):
+        out = StringIO()
+        call_command('scimexport', stdout=out, stderr=StringIO(), **options)
+        return out.getvalue()
+
+    def test_ndjson(self):
+        # Chunks smaller than the directory, and than a group's members.
+        lines = self.export(chunk_size=7).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], self.users + self.groups)
+        self.assertEqual([json.loads(line) for line in self.export(resources='groups').splitlines()],
+                         self.groups)
+
+    def test_list_response(self):
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as f:
+            self.assertEqual(self.export(format='scim', chunk_size=10, output=f.name), '')
+            doc = json.load(f)
+        self.assertEqual(doc['schemas'], [constants.SchemaURI.LIST_RESPONSE])
+        self.assertEqual(doc['totalResults'], 27)
+        self.assertEqual(doc['Resources'], self.users + self.groups)
+
+        doc = json.loads(self.export(format='scim', resources='users, groups', chunk_size=100))
+        self.assertEqual(doc['Resources'], self.users + self.groups)
 
-# Create your tests here.
+    def test_invalid(self):
+        for options in ({'resources': 'users,devices'}, {'resources': ','}, {'chunk_size': 0}):
+            with self.assertRaises(CommandError):
+                self.export(**options)
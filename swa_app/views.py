@@ -1,34 +1,49 @@
 from django.shortcuts import render
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponseRedirect, HttpResponse
 from django.contrib.auth import authenticate, login, logout
 from django.views.decorators.csrf import csrf_exempt
 from django.urls import reverse
 from django.contrib.auth.models import User, Group
+from django.db.models import CharField, Prefetch, Q
+from django.db.models.functions import Cast
 from django.http import HttpResponseForbidden
 
 import json
 
+from django_scim.models import Change
+
 # Create your views here.
 def view_main(request):
     if _is_logged_in(request):
-        u = User.objects.get(username=request.user)
-        ctx = {'profile': json.dumps(_get_user_profile(u))}
-        return render(request, 'swa_app/home.html', ctx)
+        u = request.user
+        version = _user_version(u)
+        return _cached_page(_page_key('home', u.pk, version), lambda: _render_home(request, u))
     else:
         return HttpResponseRedirect(reverse('login'))
 
 def view_admin(request):
     if _is_logged_in(request):
-        u = User.objects.get(username=request.user)
-        if _is_admin(u):
-            ctx = {'all_users': json.dumps(_get_all_users()),
-                   'all_groups': json.dumps(_get_all_groups())}
-            return render(request, 'swa_app/admin.html', ctx)
+        u = request.user
+        version = Change.objects.last_seq()
+        is_admin = _cached(_page_key('is_admin', u.pk, version), lambda: _is_admin(u))
+        if is_admin:
+            return _cached_page(_page_key('admin', version), lambda: _render_admin(request))
         else:
             return HttpResponseForbidden()
     else:
         return HttpResponseRedirect(reverse('login'))
 
+def _render_home(request, u):
+    ctx = {'profile': json.dumps(_get_user_profile(u))}
+    return render(request, 'swa_app/home.html', ctx)
+
+def _render_admin(request):
+    ctx = {'all_users': json.dumps(_get_all_users()),
+           'all_groups': json.dumps(_get_all_groups())}
+    return render(request, 'swa_app/admin.html', ctx)
+
 @csrf_exempt
 def view_login(request):
     if request.method == 'POST':
@@ -82,19 +97,63 @@ def _get_group_info(grp):
     grp_dict = {}
     grp_dict['name'] = grp.name
     grp_dict['members'] = []
-    for mem in User.objects.filter(groups__name=grp.name):
+    for mem in grp.user_set.all():
         grp_dict['members'].append(mem.username)
 
     return grp_dict
 
+# The admin page lists the whole directory, but for deactivated users;
+# profiles, groups and members are loaded along with it so that the number of
+# queries doesn't grow with it.
+
 def _get_all_users():
     retVal = []
-    for usr in User.objects.all():
+    users = User.objects.filter(is_active=True).select_related('profile').prefetch_related(
+        Prefetch('groups', queryset=Group.objects.only('name')))
+    for usr in users:
         retVal.append(_get_user_profile(usr))
     return retVal
 
 def _get_all_groups():
     retVal = []
-    for grp in Group.objects.all():
+    groups = Group.objects.prefetch_related(
+        Prefetch('user_set', queryset=User.objects.filter(is_active=True).only('username')))
+    for grp in groups:
         retVal.append(_get_group_info(grp))
     return retVal
+
+# Rendered pages are cached under a version of the directory taken from the
+# SCIM change log, which every write through the SCIM adapters appends to:
+# the home page of a user changes with that user (their profile or group
+# memberships, which are logged as changes of the user) or one of their
+# groups, the admin page with anything. The cache thus never needs to be
+# cleared; a write makes the next page view render afresh.
+
+def _user_version(usr):
+    group_ids = usr.groups.annotate(change_id=Cast('id', CharField())).values('change_id')
+    return Change.objects.filter(Q(resource_type='User', resource_id=str(usr.pk)) |
+                                 Q(resource_type='Group', resource_id__in=group_ids)).last_seq()
+
+def _page_key(*parts):
+    return 'swa_app:page:' + ':'.join(str(part) for part in parts)
+
+def _cached(key, compute):
+    timeout = settings.PORTAL_CACHE_TIMEOUT
+    if not timeout:
+        return compute()
+    value = cache.get(key)
+    if value is None:
+        value = compute()
+        cache.set(key, value, timeout)
+    return value
+
+def _cached_page(key, render_page):
+    def render():
+        response = render_page()
+        return response.status_code, list(response.items()), response.content
+
+    status, headers, content = _cached(key, render)
+    response = HttpResponse(content, status=status)
+    for header, value in headers:
+        response[header] = value
+    return response
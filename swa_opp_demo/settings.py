@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -23,7 +25,9 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 SECRET_KEY = 'zj*cax4@qb13ozog5(m(xt&3ho77)qo1qm-@3d*!zs6bv60()_'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Set DEBUG=false to serve the assets collected by `manage.py collectstatic`
+# under hashed names.
+DEBUG = os.environ.get('DEBUG', 'true').lower() in ('1', 'true', 'yes')
 ALLOWED_HOSTS = ['*']
 #ALLOWED_HOSTS = ['docker.for.mac.localhost','localhost']
 
@@ -43,6 +47,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'swa_app.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -113,7 +118,149 @@ USE_TZ = True
 
 LOGIN_URL = '/swa_app/login'
 
+# Sessions
+# https://docs.djangoproject.com/en/2.1/topics/http/sessions/
+#
+# SESSION_STORE selects where portal sessions are kept, so that page views
+# don't have to read and write the SQLite file SCIM provisioning writes to:
+#
+#   db              the django_session table
+#   cached_db       the session cache, falling back to the database on a miss
+#   cache           the session cache only
+#   signed_cookies  the session cookie itself, signed with SECRET_KEY
+#
+# The session cache is in memory, or in SESSION_CACHE_DIR when that is set.
+# An in-memory cache is private to each server process: with several worker
+# processes, set SESSION_CACHE_DIR so that they all see the same sessions.
+
+SESSION_ENGINES = {
+    'db': 'django.contrib.sessions.backends.db',
+    'cached_db': 'django.contrib.sessions.backends.cached_db',
+    'cache': 'django.contrib.sessions.backends.cache',
+    'signed_cookies': 'django.contrib.sessions.backends.signed_cookies',
+}
+SESSION_STORE = os.environ.get('SESSION_STORE', 'db').strip().lower()
+if SESSION_STORE not in SESSION_ENGINES:
+    raise ImproperlyConfigured('SESSION_STORE must be one of {}, not {!r}.'.format(
+        ', '.join(SESSION_ENGINES), os.environ['SESSION_STORE']))
+SESSION_ENGINE = SESSION_ENGINES[SESSION_STORE]
+SESSION_CACHE_ALIAS = 'sessions'
+SESSION_COOKIE_AGE = int(os.environ.get('SESSION_COOKIE_AGE', 60 * 60 * 24 * 14))
+
+# Seconds between removals of expired sessions by runprodserver; 0 disables
+# it. `manage.py clearsessions` does the same on demand.
+SESSION_CLEANUP_INTERVAL = int(os.environ.get('SESSION_CLEANUP_INTERVAL', 60 * 60))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'sessions': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'TIMEOUT': SESSION_COOKIE_AGE,
+    },
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'idempotency',
+    },
+}
+if os.environ.get('SESSION_CACHE_DIR'):
+    CACHES['sessions'] = {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ['SESSION_CACHE_DIR'],
+        'TIMEOUT': SESSION_COOKIE_AGE,
+    }
+
+# Seconds for which rendered portal pages are cached. They are invalidated
+# by SCIM writes, so this only bounds how long changes made by other means
+# take to show. 0 disables the cache.
+PORTAL_CACHE_TIMEOUT = int(os.environ.get('PORTAL_CACHE_TIMEOUT', 300))
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# `manage.py collectstatic` writes content-hashed, pre-compressed copies of
+# the assets to STATIC_ROOT, from where StaticFilesMiddleware serves them.
+# Hashed names are cached by browsers for a year; anything else for
+# STATIC_MAX_AGE seconds.
+STATIC_ROOT = os.environ.get('STATIC_ROOT', os.path.join(BASE_DIR, 'staticfiles'))
+STATICFILES_STORAGE = 'swa_app.storage.CompressedManifestStaticFilesStorage'
+STATIC_MAX_AGE = int(os.environ.get('STATIC_MAX_AGE', 60 * 60))
+
+# SCIM
+
+# Seconds for which the response to a SCIM write is kept, so that an
+# identical retry from Okta is answered without running the write again.
+# 0 disables deduplication.
+#
+# Responses are kept in the 'idempotency' cache, in memory by default. That
+# cache is private to each server process: with several runprodserver
+# workers, a retry reaching another worker than the first attempt runs the
+# write again. Set SCIM_IDEMPOTENCY_CACHE_TABLE to keep them in that
+# database table instead (create it with `manage.py createcachetable`),
+# shared by all workers.
+SCIM_IDEMPOTENCY_WINDOW = int(os.environ.get('SCIM_IDEMPOTENCY_WINDOW', 300))
+if os.environ.get('SCIM_IDEMPOTENCY_CACHE_TABLE'):
+    CACHES['idempotency'] = {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': os.environ['SCIM_IDEMPOTENCY_CACHE_TABLE'],
+    }
+
+# Admission control for SCIM requests, per server process. Each write route
+# runs SCIM_WRITE_CONCURRENCY writes at once with up to SCIM_WRITE_QUEUE more
+# waiting SCIM_WRITE_QUEUE_TIMEOUT seconds. Set SCIM_RATE_LIMIT to let each
+# API key make that many requests per second, with bursts of SCIM_RATE_BURST;
+# it is off by default. Anything beyond that is answered with 429 and
+# Retry-After. 0 disables a limit.
+SCIM_RATE_LIMIT = float(os.environ.get('SCIM_RATE_LIMIT', 0))
+SCIM_RATE_BURST = int(os.environ.get('SCIM_RATE_BURST', 100))
+SCIM_WRITE_CONCURRENCY = int(os.environ.get('SCIM_WRITE_CONCURRENCY', 2))
+SCIM_WRITE_QUEUE = int(os.environ.get('SCIM_WRITE_QUEUE', 32))
+SCIM_WRITE_QUEUE_TIMEOUT = float(os.environ.get('SCIM_WRITE_QUEUE_TIMEOUT', 10))
+
+# With SCIM_GROUP_COMMIT, the database changes of SCIM writes are run by a
+# single writer thread per process, which commits up to
+# SCIM_GROUP_COMMIT_MAX_BATCH of them in one transaction, waiting up to
+# SCIM_GROUP_COMMIT_DELAY seconds for more to arrive. Responses are built once
+# their write is committed, and are a 503 if the commit fails. Raise
+# SCIM_WRITE_CONCURRENCY along with it, as it bounds the writes queued at once.
+SCIM_GROUP_COMMIT = os.environ.get('SCIM_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+SCIM_GROUP_COMMIT_MAX_BATCH = int(os.environ.get('SCIM_GROUP_COMMIT_MAX_BATCH', 64))
+SCIM_GROUP_COMMIT_DELAY = float(os.environ.get('SCIM_GROUP_COMMIT_DELAY', 0.002))
+
+# Users deactivated through SCIM (active: false) are kept, and can be
+# reactivated, for SCIM_PURGE_RETENTION days, then deleted by runprodserver
+# every SCIM_PURGE_INTERVAL seconds (0 disables it) or by `manage.py scimpurge`.
+SCIM_PURGE_RETENTION = float(os.environ.get('SCIM_PURGE_RETENTION', 30))
+SCIM_PURGE_INTERVAL = int(os.environ.get('SCIM_PURGE_INTERVAL', 60 * 60 * 24))
+
+# With SCIM_SERVER_TIMING, responses to authenticated SCIM requests carry a
+# Server-Timing header breaking the request down into phases (auth, log,
+# filter, serialize, encode, compress, db). With SCIM_TIMING_LOG, the same
+# figures are logged as JSON to the django_scim.timing logger. Both are off
+# by default.
+SCIM_SERVER_TIMING = os.environ.get('SCIM_SERVER_TIMING', '').lower() in ('1', 'true', 'yes')
+SCIM_TIMING_LOG = os.environ.get('SCIM_TIMING_LOG', '').lower() in ('1', 'true', 'yes')
+
+# With SCIM_DB_JSON, pages of users and groups are serialized to JSON by the
+# database (SQLite or PostgreSQL) instead of through the adapters.
+SCIM_DB_JSON = os.environ.get('SCIM_DB_JSON', '').lower() in ('1', 'true', 'yes')
+
+# The groups of users and members of groups are served from an in-process
+# index kept up to date from the change log, and rebuilt from the database
+# every SCIM_MEMBERSHIP_INDEX_MAX_AGE seconds. 0 disables the index.
+SCIM_MEMBERSHIP_INDEX_MAX_AGE = int(os.environ.get('SCIM_MEMBERSHIP_INDEX_MAX_AGE', 3600))
+
+# Seconds for which the result of a lookup by a unique attribute, such as
+# Okta's `userName eq "..."` existence check, is cached. Any write clears the
+# cache. 0 disables it.
+SCIM_LOOKUP_CACHE_TTL = float(os.environ.get('SCIM_LOOKUP_CACHE_TTL', 30))
+
+# SCIM responses of at least SCIM_COMPRESSION_MIN_SIZE bytes are compressed
+# with brotli (if installed) or gzip, as negotiated with Accept-Encoding.
+SCIM_COMPRESSION_MIN_SIZE = int(os.environ.get('SCIM_COMPRESSION_MIN_SIZE', 1024))
+SCIM_GZIP_LEVEL = int(os.environ.get('SCIM_GZIP_LEVEL', 6))
+SCIM_BROTLI_QUALITY = int(os.environ.get('SCIM_BROTLI_QUALITY', 5))
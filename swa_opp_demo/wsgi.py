@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "swa_opp_demo.settings")
 
 application = get_wsgi_application()
+
+# Build the URL resolvers and SCIM discovery documents now rather than while
+# serving the first request.
+from django_scim.warmup import warm_up  # noqa: E402
+warm_up(database=False)